@@ -0,0 +1,230 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    async_platform.py: asyncio front end for the DA platform backend.
+    Writes, reports and recorded audio are available as futures/coroutines,
+    and libusb's file descriptors are watched by the event loop, so USB
+    transfers can share one loop with e.g. a control server or metering.
+
+    This code targets Python 2, so it uses trollius (the asyncio backport):
+    coroutines are written as generators with "yield From(...)".
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import collections
+import select
+
+import numpy
+import usb1
+import trollius as asyncio
+from trollius import From, Return
+
+from backends.ezusb import EZUSBBackend, IO_DISPLAY
+from backends.da_platform import DAPlatformBackend
+
+
+class AudioBlockIterator(object):
+    """ Fixed-size blocks of recorded audio from one slot.
+        With trollius: "block = yield From(blocks.next_block())".
+    """
+
+    def __init__(self, backend, slot, num_samples, blocks_ahead=2):
+        self.backend = backend
+        self.slot = slot
+        self.num_samples = num_samples
+        self.blocks_ahead = blocks_ahead
+        #   Samples requested from the FPGA but not yet returned by next_block()
+        self.samples_requested = 0
+
+    @asyncio.coroutine
+    def next_block(self):
+        #   Keep reads for the next few blocks queued so the FPGA always has a request pending
+        while self.samples_requested < self.num_samples * self.blocks_ahead:
+            self.backend.request_audio(self.slot, self.num_samples)
+            self.samples_requested += self.num_samples
+        data = yield From(self.backend.read_audio(self.slot, self.num_samples))
+        self.samples_requested -= self.num_samples
+        raise Return(data)
+
+
+class AsyncDAPlatformBackend(DAPlatformBackend):
+
+    #   Note: write() returns a future here.  ModuleBase functions that only send
+    #   commands work unchanged, but those that block waiting for a response
+    #   (spi_read, audio_read, ...) should be replaced with read_report()/read_audio().
+
+    def __init__(self, loop=None, num_slots=4, reset=False, ring_transfers=8, ring_transfer_words=4096):
+        super(AsyncDAPlatformBackend, self).__init__(num_slots=num_slots, reset=reset)
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+
+        #   Futures waiting for audio, per slot; they are checked whenever a slot's audio arrives.
+        #   (Futures for other reports are handled by DAPlatformBackend.expect_report.)
+        self.audio_waiters = [collections.deque() for i in range(num_slots)]
+        for slot in range(num_slots):
+            self.subscribe(slot, DAPlatformBackend.AUD_FIFO_REPORT, self.audio_received)
+        self.async_write_transfers = collections.deque()
+        self.async_writes_in_flight = 0
+        self.timeout_handle = None
+
+        #   Have the event loop watch libusb's file descriptors, and keep that set up to date
+        for (fd, events) in self.context.getPollFDList():
+            self.add_pollfd(fd, events)
+        self.context.setPollFDNotifiers(self.add_pollfd, self.remove_pollfd)
+
+        #   All incoming data arrives through the read ring
+        self.start_read_ring(ring_transfers, ring_transfer_words)
+        self.schedule_timeout()
+
+    def add_pollfd(self, fd, events, user_data=None):
+        if events & select.POLLIN:
+            self.loop.add_reader(fd, self.process_events)
+        if events & select.POLLOUT:
+            self.loop.add_writer(fd, self.process_events)
+
+    def remove_pollfd(self, fd, user_data=None):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+    def schedule_timeout(self):
+        #   libusb also has to run when its next transfer timeout expires
+        if self.timeout_handle is not None:
+            self.timeout_handle.cancel()
+            self.timeout_handle = None
+        timeout = self.context.getNextTimeout()
+        if timeout is not None:
+            self.timeout_handle = self.loop.call_later(timeout, self.process_events)
+
+    def process_events(self):
+        #   Called by the event loop when a libusb fd is ready: complete transfers without
+        #   blocking, then parse what the read ring received (which resolves waiting futures).
+        self.handle_events(0)
+        for chunk in self.read_ring_chunks(timeout=0):
+            self.parse_report(chunk)
+            self.release_buffer(chunk)
+        self.schedule_timeout()
+
+    def close(self):
+        for (fd, events) in self.context.getPollFDList():
+            self.remove_pollfd(fd)
+        self.context.setPollFDNotifiers(None, None)
+        if self.timeout_handle is not None:
+            self.timeout_handle.cancel()
+        super(AsyncDAPlatformBackend, self).close()
+
+    def write(self, data, display=IO_DISPLAY):
+        """ Submit data to EP_OUT.  Returns a future for the number of words written.
+            In a batch (see begin_batch), the data is only sent by end_batch().
+        """
+        future = asyncio.Future(loop=self.loop)
+        batch = self.current_batch()
+        if batch is not None:
+            batch.append(data)
+            batch.write_futures.append((future, data.shape[0]))
+            if display: print 'Batched %d words: %s' % (data.shape[0], data)
+            return future
+        if self.recorder is not None:
+            self.recorder.record_out(data)
+        if len(self.async_write_transfers) > 0:
+            transfer = self.async_write_transfers.popleft()
+        else:
+            transfer = self.handle.getTransfer()
+        transfer.setBulk(EZUSBBackend.EP_OUT, self.byte_view(data), callback=self.async_write_callback, user_data=(future, data))
+        transfer.submit()
+        self.async_writes_in_flight += 1
+        if display: print 'Submitted %d words: %s' % (data.shape[0], data)
+        return future
+
+    def async_write_callback(self, transfer):
+        (future, data) = transfer.getUserData()
+        transfer.setUserData(None)
+        self.async_write_transfers.append(transfer)
+        self.async_writes_in_flight -= 1
+        #   Written data may be a pool buffer handed over by write_owned()
+        self.release_buffer(data)
+        if future.cancelled():
+            return
+        status = transfer.getStatus()
+        if status == usb1.TRANSFER_COMPLETED:
+            future.set_result(transfer.getActualLength() / self.bytes_per_word)
+        else:
+            future.set_exception(usb1.USBError(status))
+
+    def write_owned(self, data):
+        future = self.write(data)
+        if self.current_batch() is not None:
+            #   (The data was copied into the batch)
+            self.release_buffer(data)
+        return future
+
+    def send_batch(self, batch):
+        #   The batched writes are done when the whole batch has been written
+        def batch_written(future):
+            for (write_future, num_words) in batch.write_futures:
+                if write_future.cancelled():
+                    continue
+                if future.cancelled():
+                    write_future.cancel()
+                elif future.exception() is not None:
+                    write_future.set_exception(future.exception())
+                else:
+                    write_future.set_result(num_words)
+        self.write(batch.data()).add_done_callback(batch_written)
+
+    def abort_batch(self):
+        batch = self.current_batch()
+        super(AsyncDAPlatformBackend, self).abort_batch()
+        if batch.depth == 0:
+            for (write_future, num_words) in batch.write_futures:
+                write_future.cancel()
+
+    def write_flush(self):
+        self.wait_events(lambda: self.async_writes_in_flight == 0)
+
+    def read_report(self, slot, report_id):
+        """ Returns a future for the next report with the given slot and report ID
+            (use GLOBAL_TARGET_INDEX as the slot for global reports).
+        """
+        return self.expect_report(slot, report_id, asyncio.Future(loop=self.loop))
+
+    #   DAPlatformBackend.read_report, which blocks until the report arrives
+    read_report_blocking = DAPlatformBackend.read_report
+
+    def request_audio(self, slot, num_samples):
+        #   Ask the FPGA to send num_samples recorded samples for the slot
+        msg = numpy.array([slot, DAPlatformBackend.AUD_FIFO_READ, num_samples / 65536, num_samples % 65536], dtype=self.dtype)
+        return self.write(msg)
+
+    def read_audio(self, slot, num_samples):
+        """ Returns a future for the next num_samples received samples (int32) for the slot.
+            Doesn't request them; see request_audio() and audio_blocks().
+        """
+        future = asyncio.Future(loop=self.loop)
+        self.audio_waiters[slot].append((num_samples, future))
+        self.check_audio_waiters(slot)
+        return future
+
+    def audio_blocks(self, slot, num_samples, blocks_ahead=2):
+        return AudioBlockIterator(self, slot, num_samples, blocks_ahead)
+
+    def check_audio_waiters(self, slot):
+        waiters = self.audio_waiters[slot]
+        while len(waiters) > 0:
+            (num_samples, future) = waiters[0]
+            if future.cancelled():
+                waiters.popleft()
+            elif self.audio_words_available(slot) >= num_samples * 2:
+                waiters.popleft()
+                future.set_result(self.pop_audio(slot, num_samples))
+            else:
+                break
+
+    def audio_received(self, slot_id, report_id, msg):
+        self.check_audio_waiters(slot_id)
@@ -0,0 +1,68 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    buffers.py: Pool of preallocated, page-aligned buffers used for USB
+    transfers, so that the backend can fill and drain them in place rather
+    than allocating and copying on every read/write.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import mmap
+import collections
+import threading
+import numpy
+
+
+class BufferPool(object):
+
+    def __init__(self, num_buffers=32, buffer_words=(1 << 15), dtype=numpy.uint16):
+        self.dtype = numpy.dtype(dtype)
+        self.num_buffers = num_buffers
+        self.buffer_words = buffer_words
+
+        #   Round each buffer up to a whole number of pages.  Anonymous mmaps
+        #   start on a page boundary, so every buffer in the pool is page-aligned.
+        buffer_bytes = buffer_words * self.dtype.itemsize
+        self.stride = ((buffer_bytes + mmap.PAGESIZE - 1) // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.storage = mmap.mmap(-1, self.stride * num_buffers)
+        self.buffers = [numpy.frombuffer(self.storage, dtype=self.dtype, count=buffer_words, offset=i * self.stride) for i in range(num_buffers)]
+        self.base_address = self.buffers[0].ctypes.data
+
+        self.free = collections.deque(range(num_buffers))
+        self.misses = 0
+        #   Buffers are acquired and released both by callers and by the USB event thread
+        self.lock = threading.Lock()
+
+    def index_of(self, buf):
+        #   Returns the pool index of buf (or a view into it), or None if it isn't from this pool.
+        offset = buf.ctypes.data - self.base_address
+        if offset < 0 or offset >= self.stride * self.num_buffers:
+            return None
+        return offset // self.stride
+
+    def acquire(self, num_words):
+        """ Return a writable array of num_words words.  Comes from the pool when
+            possible; otherwise a regular (unpooled) array is allocated.
+        """
+        with self.lock:
+            if num_words <= self.buffer_words and len(self.free) > 0:
+                return self.buffers[self.free.popleft()][:num_words]
+            self.misses += 1
+        return numpy.empty((num_words,), dtype=self.dtype)
+
+    def release(self, buf):
+        #   Unpooled arrays are just left for the garbage collector.
+        index = self.index_of(buf)
+        if index is not None:
+            with self.lock:
+                assert index not in self.free
+                self.free.append(index)
+
+    def num_free(self):
+        return len(self.free)
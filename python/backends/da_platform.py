@@ -13,9 +13,70 @@
 
 import numpy
 import libusb1
+import usb1
 import time
+import threading
+import collections
 
-from backends.ezusb import EZUSBBackend
+from backends.ezusb import EZUSBBackend, IO_DISPLAY
+from backends.fifo_status import FIFOStatusService
+from backends.parser import ReportParser
+from backends.ringbuffer import AudioRingBuffer
+
+
+class ReportFuture(object):
+    """ The next report for a (slot, report ID), as returned by
+        DAPlatformBackend.expect_report().  Implements the parts of the
+        future interface that the backend uses (done, set_result), so
+        e.g. asyncio futures can be used in its place.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.msg = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def set_result(self, msg):
+        self.msg = msg
+        self.event.set()
+
+    def result(self, timeout=None):
+        #   Timeout is in seconds; this only waits, so someone else has to be receiving.
+        if not self.event.wait(timeout):
+            raise usb1.USBErrorTimeout()
+        return self.msg
+
+
+class CommandBatch(object):
+    """ Commands written by one thread between begin_batch() and end_batch(),
+        collected into one buffer to be sent in a single transfer, and the
+        futures for the reports they will produce.
+    """
+
+    def __init__(self, dtype, capacity=4096):
+        self.buffer = numpy.empty((capacity,), dtype=dtype)
+        self.num_words = 0
+        self.num_commands = 0
+        self.futures = []
+        #   Futures for the batched writes, as (future, number of words), on backends
+        #   whose write() returns one (see AsyncDAPlatformBackend)
+        self.write_futures = []
+        self.depth = 1
+
+    def append(self, data):
+        N = data.shape[0]
+        if self.num_words + N > self.buffer.shape[0]:
+            new_buffer = numpy.empty((2 * (self.num_words + N),), dtype=self.buffer.dtype)
+            new_buffer[:self.num_words] = self.buffer[:self.num_words]
+            self.buffer = new_buffer
+        self.buffer[self.num_words:self.num_words + N] = data
+        self.num_words += N
+        self.num_commands += 1
+
+    def data(self):
+        return self.buffer[:self.num_words]
 
 
 class DAPlatformBackend(EZUSBBackend):
@@ -46,6 +107,8 @@ class DAPlatformBackend(EZUSBBackend):
     SPI_WRITE_REG			= 0x60
     SPI_READ_REG			= 0x61
     SPI_REPORT			    = 0x62
+    #   SPI_REPORT, address (2 words), data (2 words)
+    SPI_REPORT_LENGTH       = 5
     SLOT_START_PLAYBACK     = 0x70
     SLOT_STOP_PLAYBACK      = 0x71
     SLOT_START_RECORDING    = 0x72
@@ -63,76 +126,309 @@ class DAPlatformBackend(EZUSBBackend):
     MSB_JUSTIFIED = 1
     LSB_JUSTIFIED = 2
 
-    def __init__(self, num_slots=4, reset=False):
+    def __init__(self, num_slots=4, reset=False, threaded=False, check_checksums=True, audio_buffer_words=(1 << 22), report_queue_length=256):
         super(DAPlatformBackend, self).__init__()
+
+        #   Locks so the backend can be shared between threads (audio, control, status):
+        #   - state_lock protects the receive state and the unparsed report data
+        #   - receive_lock serializes reads from EP_IN, so reports are parsed in order
+        #   - transaction_lock is held across command/response exchanges (e.g. SPI reads)
+        self.state_lock = threading.RLock()
+        self.receive_lock = threading.RLock()
+        self.transaction_lock = threading.RLock()
+
+        #   Reports are dispatched by (slot, report ID) to subscribed handlers and to
+        #   futures waiting for them (see subscribe and expect_report).  Reports that no
+        #   future claims are kept in bounded queues; the oldest are dropped (and counted).
+        self.report_handlers = collections.defaultdict(list)
+        self.report_waiters = collections.defaultdict(collections.deque)
+        self.report_queue_length = report_queue_length
+        self.reports_dropped = collections.defaultdict(int)
         self.receive_state_global = {}
         self.receive_state_slots = [{} for i in range(num_slots)]
+        #   Each thread's CommandBatch, if it has one open (see begin_batch)
+        self.batch_local = threading.local()
         for i in range(num_slots):
-            for key in [DAPlatformBackend.AUD_FIFO_REPORT, DAPlatformBackend.CMD_FIFO_REPORT]:
-                self.receive_state_slots[i][key] = []
-        self.report_unparsed = numpy.array([], dtype=self.dtype)
+            self.receive_state_slots[i][DAPlatformBackend.CMD_FIFO_REPORT] = collections.deque(maxlen=report_queue_length)
+        #   Received audio goes into a fixed-size ring buffer for each slot
+        self.audio_buffers = [AudioRingBuffer(audio_buffer_words, dtype=self.dtype) for i in range(num_slots)]
+        self.parser = ReportParser(dtype=self.dtype, num_slots=num_slots, check_checksums=check_checksums)
         
         #   TODO: Figure out
         self.cur_slot_id = -1
         self.cur_report_id = -1
+
+        #   Last known value of each SPI register, per slot: {address: value}.
+        #   Filled by reads and writes (see ModuleBase.spi_read/spi_write) and
+        #   cleared when the modules are reset.
+        self.register_shadow = [{} for i in range(num_slots)]
+        self.register_lock = threading.RLock()
+        #   Last HWCON/ACON value written to each slot, which may select another chip
+        self.slot_hwcon = [0] * num_slots
+        #   Last UPDATE_BLOCKING mask (bit i set if slot i's FIFO is running)
+        self.enable_mask = 0x0F
+
+        #   Cached DRAM FIFO status, shared by everything using this backend
+        self.fifo_status = FIFOStatusService(self)
         
         if reset:
             self.reset()
             time.sleep(0.4)
+
+        #   In threaded mode a background thread runs the libusb event loop, so
+        #   calls from other threads don't have to take turns driving it.
+        if threaded:
+            self.start_event_thread()
     
+    def invalidate_registers(self, slot=None):
+        #   Forget the register values for one slot, or all of them
+        with self.register_lock:
+            for i in range(len(self.register_shadow)):
+                if slot is None or slot == i:
+                    self.register_shadow[i] = {}
+
+    def reset(self):
+        self.invalidate_registers()
+        super(DAPlatformBackend, self).reset()
+
+    @property
+    def report_unparsed(self):
+        return self.parser.unparsed()
+
+    def report_stats(self):
+        """ Returns ({(slot, report ID): [good, bad, resync]}, number of words discarded
+            while resynchronizing).  See ReportParser.
+        """
+        with self.state_lock:
+            counters = dict([(key, list(value)) for (key, value) in self.parser.counters.items()])
+            return (counters, self.parser.words_discarded)
+
     def receive_state_available(self, slot, key):
-        return (len(self.receive_state_slots[slot][key]) > 0)
+        with self.state_lock:
+            return (len(self.receive_state_slots[slot][key]) > 0)
     
+    def report_queue(self, slot_id, report_id):
+        #   Queue of unclaimed reports for (slot, report ID); call with state_lock held
+        if slot_id == DAPlatformBackend.GLOBAL_TARGET_INDEX:
+            state = self.receive_state_global
+        else:
+            state = self.receive_state_slots[slot_id]
+        if report_id not in state:
+            state[report_id] = collections.deque(maxlen=self.report_queue_length)
+        return state[report_id]
+
+    def subscribe(self, slot, report_id, handler):
+        """ Call handler(slot, report_id, msg) for each report with the given slot
+            and report ID (GLOBAL_TARGET_INDEX for global reports) as soon as it is
+            parsed, in whichever thread parses it.  Handlers should return quickly.
+            For AUD_FIFO_REPORT, the audio is in the slot's ring buffer by then.
+        """
+        with self.state_lock:
+            self.report_handlers[(slot, report_id)].append(handler)
+        return handler
+
+    def unsubscribe(self, slot, report_id, handler):
+        with self.state_lock:
+            self.report_handlers[(slot, report_id)].remove(handler)
+
+    def expect_report(self, slot, report_id, future=None):
+        """ Returns a future (a ReportFuture unless one is supplied) that gets the
+            oldest unclaimed report with the given slot and report ID, or the next
+            one to arrive.  Futures are served in the order they were requested.
+        """
+        if future is None:
+            future = ReportFuture()
+        with self.state_lock:
+            queue = self.report_queue(slot, report_id)
+            if len(queue) > 0:
+                future.set_result(queue.popleft())
+            else:
+                self.report_waiters[(slot, report_id)].append(future)
+                batch = self.current_batch()
+                if batch is not None:
+                    batch.futures.append((slot, report_id, future))
+        return future
+
+    def current_batch(self):
+        return getattr(self.batch_local, 'batch', None)
+
+    def begin_batch(self):
+        """ Until end_batch(), commands written by this thread are collected instead
+            of being sent.  transaction_lock is held meanwhile, so that other threads'
+            requests don't get between the batched ones and their reports.
+            Batches may be nested; only the outermost one sends anything.
+        """
+        batch = self.current_batch()
+        if batch is not None:
+            batch.depth += 1
+            return batch
+        self.transaction_lock.acquire()
+        batch = CommandBatch(self.dtype)
+        self.batch_local.batch = batch
+        return batch
+
+    def end_batch(self, read_back=False, timeout=1.0):
+        """ Send the batched commands in one transfer.  With read_back, also wait
+            for the reports requested during the batch and return them (in order).
+        """
+        batch = self.current_batch()
+        batch.depth -= 1
+        if batch.depth > 0:
+            return None
+        try:
+            self.batch_local.batch = None
+            if batch.num_words > 0:
+                self.send_batch(batch)
+        finally:
+            self.transaction_lock.release()
+        if read_back:
+            return [self.wait_report(future, timeout) for (slot, report_id, future) in batch.futures]
+
+    def send_batch(self, batch):
+        self.write(batch.data())
+
+    def abort_batch(self):
+        #   Discard the batched commands, and stop waiting for the reports they would have produced
+        batch = self.current_batch()
+        batch.depth -= 1
+        if batch.depth > 0:
+            return
+        self.batch_local.batch = None
+        #   Register writes in the batch already went into the shadow
+        self.invalidate_registers()
+        for (slot, report_id, future) in batch.futures:
+            self.cancel_report(future, slot, report_id)
+        self.transaction_lock.release()
+
+    def cancel_report(self, future, slot=None, report_id=None):
+        #   Stop waiting for a report, so the next one goes to someone else
+        with self.state_lock:
+            if slot is None:
+                keys = self.report_waiters.keys()
+            else:
+                keys = [(slot, report_id)]
+            for key in keys:
+                waiters = self.report_waiters.get(key)
+                if waiters and future in waiters:
+                    waiters.remove(future)
+
+    def write(self, data, display=IO_DISPLAY):
+        batch = self.current_batch()
+        if batch is not None:
+            batch.append(data)
+            if display: print 'Batched %d words: %s' % (data.shape[0], data)
+        else:
+            super(DAPlatformBackend, self).write(data, display)
+
+    def write_owned(self, data):
+        if self.current_batch() is not None:
+            self.write(data)
+            self.release_buffer(data)
+        else:
+            super(DAPlatformBackend, self).write_owned(data)
+
+    def wait_report(self, future, timeout=1.0):
+        #   Receive (or let other threads receive) until the future is done.  Timeout is in seconds.
+        assert future.done() or self.current_batch() is None, 'Reports requested in a batch only arrive after the batch is sent'
+        deadline = time.time() + timeout
+        while not future.done():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                #   Otherwise the next report would go to this future, and be lost
+                self.cancel_report(future)
+                if future.done():
+                    break
+                raise usb1.USBErrorTimeout()
+            self.update_receive_state(timeout=max(1, int(min(remaining, 0.1) * 1000)))
+        return future.result()
+
+    def read_report(self, slot, report_id, timeout=1.0):
+        return self.wait_report(self.expect_report(slot, report_id), timeout)
+
+    def split_cmd_report(self, msg):
+        #   A CMD_FIFO_REPORT carries whatever was in the slot's command FIFO, which may
+        #   be several SPI responses (e.g. after a batch of reads); split them up.
+        records = []
+        pos = 0
+        while pos < msg.shape[0]:
+            if msg[pos] == DAPlatformBackend.SPI_REPORT and pos + DAPlatformBackend.SPI_REPORT_LENGTH <= msg.shape[0]:
+                records.append(msg[pos:pos + DAPlatformBackend.SPI_REPORT_LENGTH])
+                pos += DAPlatformBackend.SPI_REPORT_LENGTH
+            else:
+                records.append(msg[pos:])
+                break
+        return records
+
     def parse_msg(self, slot_id, report_id, msg):
         #   print 'parse_msg(%d, 0x%02x): %d words: %s ...' % (slot_id, report_id, msg.shape[0], msg)
-        if slot_id == DAPlatformBackend.GLOBAL_TARGET_INDEX:
-            if report_id not in self.receive_state_global:
-                self.receive_state_global[report_id] = []
-            self.receive_state_global[report_id].append(msg)
-        elif slot_id >= 0:
-            if report_id not in self.receive_state_slots[slot_id]:
-                self.receive_state_slots[slot_id][report_id] = []
-            self.receive_state_slots[slot_id][report_id].append(msg)
+        if report_id == DAPlatformBackend.CMD_FIFO_REPORT and msg.shape[0] > DAPlatformBackend.SPI_REPORT_LENGTH:
+            for record in self.split_cmd_report(msg):
+                self.dispatch_report(slot_id, report_id, record)
+        else:
+            self.dispatch_report(slot_id, report_id, msg)
+
+    def dispatch_report(self, slot_id, report_id, msg):
+        with self.state_lock:
+            key = (slot_id, report_id)
+            if report_id == DAPlatformBackend.AUD_FIFO_REPORT and 0 <= slot_id < len(self.audio_buffers):
+                self.audio_buffers[slot_id].write(msg)
+            else:
+                waiters = self.report_waiters.get(key)
+                claimed = False
+                while waiters and not claimed:
+                    future = waiters.popleft()
+                    if not future.done():
+                        future.set_result(msg)
+                        claimed = True
+                if not claimed:
+                    queue = self.report_queue(slot_id, report_id)
+                    if len(queue) == queue.maxlen:
+                        self.reports_dropped[key] += 1
+                    queue.append(msg)
+            handlers = self.report_handlers.get(key)
+            if handlers:
+                #   (A copy, so handlers can unsubscribe themselves)
+                for handler in list(handlers):
+                    handler(slot_id, report_id, msg)
 
     def parse_report(self, new_packet):
-        all_packets = numpy.concatenate([self.report_unparsed, new_packet])
-        #   print 'parse_report: %s' % all_packets
-        cur_index = 0
-        N = all_packets.shape[0]
-        parsing_valid = True
-        while parsing_valid:
-            parsing_valid = False
-            if N > cur_index + 2:
-                #   Pull out metadata
-                slot_id = all_packets[cur_index]
-                report_id = all_packets[cur_index + 1]
-                msg_length = (all_packets[cur_index + 2] << 16) + all_packets[cur_index + 3]
-                if N < cur_index + 6 + msg_length:
-                    break
-                msg = all_packets[cur_index + 4:cur_index + 4 + msg_length]
-                checksum = (all_packets[cur_index + 4 + msg_length] << 16) + all_packets[cur_index + 5 + msg_length]
-                
-                #   TODO: check checksum
-                
-                #   Call parse function
-                self.parse_msg(slot_id, report_id, msg)
-
-                cur_index += 6 + msg_length
-                parsing_valid = True
-        self.report_unparsed = all_packets[cur_index:]
+        with self.state_lock:
+            self.parse_report_locked(new_packet)
+
+    def parse_report_locked(self, new_packet):
+        #   new_packet may be a pool buffer that is reused after this returns, so the
+        #   parser copies it; messages are views into the parser's buffer.
+        self.parser.feed(new_packet)
+        for (slot_id, report_id, msg, checksum) in self.parser.frames():
+            self.parse_msg(slot_id, report_id, msg)
     
     def update_receive_state(self, timeout=100, request_size=2048):
         #   For up to 10 ms of CD audio, we need: 441 samples * 4 words/sample = ~1600
         #   That would be 8 512-byte packets.
-        data = self.read(request_size, timeout=timeout)  #   , display=True
-        self.parse_report(data)
+        #   Data is parsed straight out of pool buffers, which go back to the pool afterwards
+        with self.receive_lock:
+            if self.ring_active:
+                #   IN transfers are already in flight; just collect what they returned.
+                chunks = self.read_ring_chunks(timeout=timeout)
+            else:
+                buf = self.acquire_buffer(request_size)
+                num_words = self.read_into(buf, timeout=timeout)
+                chunks = [buf[:num_words]]
+
+            num_words = 0
+            for chunk in chunks:
+                self.parse_report(chunk)
+                num_words += chunk.shape[0]
+                self.release_buffer(chunk)
         #   print 'Receive state slots: %s' % self.receive_state_slots
         
         #   Provide the number of bytes received - some loops want to see if any new data showed up
-        return data.shape[0]
+        return num_words
 
     def flush(self, display=False):
         """ Read from the device until there's nothing more to read.    """
+        if self.write_queue_depth > 0:
+            self.write_flush()
         num_words = 1
         while num_words > 0:
             num_words = self.update_receive_state()
@@ -140,4 +436,31 @@ class DAPlatformBackend(EZUSBBackend):
             print 'After flushing, remainder is %d words: %s' % (self.report_unparsed.shape[0], self.report_unparsed)
 
     def pop_report_global(self, report_id):
-        return self.receive_state_global[report_id].pop(0)
+        with self.state_lock:
+            return self.receive_state_global[report_id].popleft()
+
+    def audio_words_available(self, slot):
+        with self.state_lock:
+            return self.audio_buffers[slot].available()
+
+    def audio_overrun_words(self, slot):
+        #   Received audio dropped because the slot's ring buffer was full
+        with self.state_lock:
+            return self.audio_buffers[slot].overrun_words
+
+    def pop_audio(self, slot, num_samples):
+        #   Remove up to num_samples received samples for the slot and return them as int32.
+        with self.state_lock:
+            return self.audio_buffers[slot].read(num_samples * 2).view(numpy.int32)
+
+    def peek_audio(self, slot, num_samples):
+        """ Like pop_audio(), but the samples stay in the ring buffer until
+            consume_audio() is called.  The result is normally a view into the
+            ring buffer, so it should be used before more audio is received.
+        """
+        with self.state_lock:
+            return self.audio_buffers[slot].peek(num_samples * 2).view(numpy.int32)
+
+    def consume_audio(self, slot, num_samples):
+        with self.state_lock:
+            self.audio_buffers[slot].consume(num_samples * 2)
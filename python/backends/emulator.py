@@ -0,0 +1,730 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    emulator.py: Software model of the FPGA side of the host interface
+    (see verilog/commands.vh and da_platform.sv), for running and profiling
+    the Python code without a ZTEX board.  The model sits behind stand-ins
+    for the libusb context, device handle and transfer objects, so all of the
+    EZUSBBackend transfer code (write queue, read ring, etc.) runs unchanged.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import time
+import threading
+import collections
+import numpy
+import usb1
+
+from backends.da_platform import DAPlatformBackend
+
+#   Master clock frequencies chosen by SELECT_CLOCK
+MCLK_FREQS = [22579200., 24576000.]
+
+#   Module in each slot: (is DAC, number of channels)
+DEFAULT_MODULES = [(True, 2), (False, 2), (True, 8), (False, 8)]
+
+#   How often to re-check the FPGA when it is waiting on the sample clocks (s)
+POLL_INTERVAL = 1e-3
+
+
+class SampleFIFO(object):
+    """ One port of the DRAM FIFO, holding int32 samples.   """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.chunks = collections.deque()
+        self.count = 0
+        #   32-bit sample counters reported by FIFO_READ_STATUS
+        self.write_counter = 0
+        self.read_counter = 0
+
+    def space(self):
+        return max(self.capacity - self.count, 0)
+
+    def push(self, samples):
+        if samples.shape[0] == 0:
+            return
+        self.chunks.append(samples)
+        self.count += samples.shape[0]
+        self.write_counter = (self.write_counter + samples.shape[0]) & 0xFFFFFFFF
+
+    def pop(self, num_samples):
+        #   Remove up to num_samples samples from the front
+        parts = []
+        remaining = min(num_samples, self.count)
+        while remaining > 0:
+            chunk = self.chunks[0]
+            if chunk.shape[0] <= remaining:
+                parts.append(self.chunks.popleft())
+                remaining -= chunk.shape[0]
+            else:
+                parts.append(chunk[:remaining])
+                self.chunks[0] = chunk[remaining:]
+                remaining = 0
+        if len(parts) == 0:
+            return numpy.zeros((0,), dtype=numpy.int32)
+        result = numpy.concatenate(parts)
+        self.count -= result.shape[0]
+        self.read_counter = (self.read_counter + result.shape[0]) & 0xFFFFFFFF
+        return result
+
+
+class SlotEmulator(object):
+    """ Slot controller (slot_controller.sv) plus the SPI registers of the module.  """
+
+    #   Number of bytes in each command; all others are 2 bytes (command, argument)
+    CMD_LENGTHS = {
+        DAPlatformBackend.SPI_WRITE_REG: 6,
+        DAPlatformBackend.SPI_READ_REG: 4,
+        DAPlatformBackend.SLOT_SET_CLK_RATIO: 3,
+    }
+
+    def __init__(self, is_dac, num_channels):
+        self.is_dac = is_dac
+        self.num_channels = num_channels
+        self.regs = {}
+        #   Bytes waiting to go out in a CMD_FIFO_REPORT
+        self.ctl_out = []
+        self.reset()
+
+    def reset(self):
+        self.playback_enabled = True
+        self.recording_enabled = False
+        self.clocks_enabled = True
+        self.clk_ratio = 256
+        self.hwcon = 0
+        self.fmt = DAPlatformBackend.I2S
+        self.ctl_in = []
+
+    def spi_read(self, addr_size, data_size, addr):
+        #   Reads may set a flag in the address that writes don't (0x80 for the
+        #   1-byte addresses of AKM parts, 0x100 in the chip address of AD193x parts).
+        if addr in self.regs:
+            value = self.regs[addr]
+        elif addr_size == 0:
+            value = self.regs.get(addr & 0x7F, 0)
+        else:
+            value = self.regs.get(addr & ~0x100, 0)
+        if data_size == 0:
+            value &= 0xFF
+        return value
+
+    def receive_ctl(self, data):
+        for byte in data:
+            self.ctl_in.append(int(byte) & 0xFF)
+            if len(self.ctl_in) >= self.CMD_LENGTHS.get(self.ctl_in[0], 2):
+                self.handle_ctl(self.ctl_in)
+                self.ctl_in = []
+
+    def handle_ctl(self, msg):
+        cmd = msg[0]
+        if cmd == DAPlatformBackend.SPI_WRITE_REG:
+            self.regs[(msg[2] << 8) + msg[3]] = (msg[4] << 8) + msg[5]
+        elif cmd == DAPlatformBackend.SPI_READ_REG:
+            addr = (msg[2] << 8) + msg[3]
+            data = self.spi_read((msg[1] >> 1) & 1, msg[1] & 1, addr)
+            self.ctl_out += [DAPlatformBackend.SPI_REPORT, addr >> 8, addr & 0xFF, data >> 8, data & 0xFF]
+        elif cmd == DAPlatformBackend.SLOT_START_PLAYBACK:
+            self.playback_enabled = True
+        elif cmd == DAPlatformBackend.SLOT_STOP_PLAYBACK:
+            self.playback_enabled = False
+        elif cmd == DAPlatformBackend.SLOT_START_RECORDING:
+            self.recording_enabled = True
+        elif cmd == DAPlatformBackend.SLOT_STOP_RECORDING:
+            self.recording_enabled = False
+        elif cmd == DAPlatformBackend.SLOT_START_CLOCKS:
+            self.clocks_enabled = True
+        elif cmd == DAPlatformBackend.SLOT_STOP_CLOCKS:
+            self.clocks_enabled = False
+        elif cmd == DAPlatformBackend.SLOT_FMT_I2S:
+            self.fmt = DAPlatformBackend.I2S
+        elif cmd == DAPlatformBackend.SLOT_FMT_LJ:
+            self.fmt = DAPlatformBackend.MSB_JUSTIFIED
+        elif cmd == DAPlatformBackend.SLOT_FMT_RJ:
+            self.fmt = DAPlatformBackend.LSB_JUSTIFIED
+        elif cmd == DAPlatformBackend.SLOT_SET_CLK_RATIO:
+            self.clk_ratio = ((msg[1] & 0x03) << 8) + msg[2]
+        elif cmd == DAPlatformBackend.SLOT_SET_ACON:
+            self.hwcon = msg[1]
+
+
+class FPGAEmulator(object):
+    """ Command processing, DRAM FIFOs and sample clocks of da_platform.sv.
+        modules lists (is DAC, number of channels) for each slot; loopback maps
+        ADC slots to the DAC slot whose output they should record (otherwise
+        ADCs record silence).  fifo_capacity is the size of each FIFO port in samples.
+    """
+
+    def __init__(self, num_slots=4, modules=None, loopback=None, fifo_capacity=(1 << 22)):
+        if modules is None:
+            modules = DEFAULT_MODULES[:num_slots]
+        self.num_slots = num_slots
+        self.slots = [SlotEmulator(is_dac, num_channels) for (is_dac, num_channels) in modules]
+        if loopback is None:
+            loopback = {}
+        self.loopback = loopback
+        self.fifo_capacity = fifo_capacity
+        self.reset(time.time())
+
+    def reset(self, now):
+        #   FIFO ports 0 to num_slots - 1 are written by the host (playback);
+        #   the remaining ports are read by the host (recording).
+        self.fifos = [SampleFIFO(self.fifo_capacity) for i in range(self.num_slots * 2)]
+        self.loopback_lines = dict((adc_slot, SampleFIFO(self.fifo_capacity)) for adc_slot in self.loopback)
+        self.clksel = 0
+        self.sclk_en = True
+        self.reset_hold = False
+        self.fifo_en = (1 << self.num_slots) - 1
+        self.hwflags = 0
+        self.last_time = [now] * self.num_slots
+        self.phase = [0.] * self.num_slots
+        for slot in self.slots:
+            slot.reset()
+            slot.ctl_out = []
+
+        self.input_chunks = collections.deque()
+        self.input_words = 0
+        self.output = collections.deque()
+        self.output_words = 0
+        self.stalled = False
+
+        #   Statistics
+        self.underruns = [0] * self.num_slots
+        self.checksum_errors = 0
+
+    def dirchan(self):
+        value = 0
+        for (i, slot) in enumerate(self.slots):
+            if slot.is_dac:
+                value |= (1 << i)
+            if slot.num_channels == 8:
+                value |= (1 << (i + 4))
+        return value
+
+    def sample_rate(self, slot):
+        return MCLK_FREQS[self.clksel] / slot.clk_ratio
+
+    def advance(self, now):
+        #   Run the sample clocks up to now: DACs drain their FIFO ports, ADCs fill theirs.
+        #   DACs go first so that loopback ADCs see what was just played.
+        order = [i for i in range(self.num_slots) if self.slots[i].is_dac] + [i for i in range(self.num_slots) if not self.slots[i].is_dac]
+        for i in order:
+            slot = self.slots[i]
+            dt = now - self.last_time[i]
+            self.last_time[i] = now
+            if not (self.sclk_en and not self.reset_hold and slot.clocks_enabled and (self.fifo_en & (1 << i))):
+                continue
+            frames = self.phase[i] + dt * self.sample_rate(slot)
+            num_frames = int(frames)
+            self.phase[i] = frames - num_frames
+            num_samples = num_frames * slot.num_channels
+            if num_samples == 0:
+                continue
+
+            if slot.is_dac:
+                if slot.playback_enabled:
+                    data = self.fifos[i].pop(num_samples)
+                    self.underruns[i] += num_samples - data.shape[0]
+                    for (adc_slot, dac_slot) in self.loopback.items():
+                        if dac_slot == i:
+                            line = self.loopback_lines[adc_slot]
+                            line.push(data[:line.space()])
+            else:
+                fifo = self.fifos[self.num_slots + i]
+                if i in self.loopback:
+                    data = self.loopback_lines[i].pop(num_samples)
+                else:
+                    data = None
+                if slot.recording_enabled:
+                    if num_samples > fifo.space():
+                        #   Overflow: set both of the slot's flags, as read by AOVF_READ
+                        self.hwflags |= (3 << (i * 2))
+                        num_samples = fifo.space()
+                    recorded = numpy.zeros((num_samples,), dtype=numpy.int32)
+                    if data is not None:
+                        num_copy = min(num_samples, data.shape[0])
+                        recorded[:num_copy] = data[:num_copy]
+                    fifo.push(recorded)
+
+    def receive(self, words, now):
+        #   Words arriving from the host; processed as far as possible right away
+        if words.shape[0] > 0:
+            self.input_chunks.append(words.copy())
+            self.input_words += words.shape[0]
+        self.process(now)
+
+    def peek(self, num_words):
+        if self.input_words < num_words:
+            return None
+        while self.input_chunks[0].shape[0] < num_words:
+            first = self.input_chunks.popleft()
+            second = self.input_chunks.popleft()
+            self.input_chunks.appendleft(numpy.concatenate((first, second)))
+        return self.input_chunks[0][:num_words]
+
+    def consume(self, num_words):
+        first = self.input_chunks[0]
+        if first.shape[0] == num_words:
+            self.input_chunks.popleft()
+        else:
+            self.input_chunks[0] = first[num_words:]
+        self.input_words -= num_words
+
+    def command_length(self):
+        #   Total length of the command at the front of the input, or None if not known yet
+        header = self.peek(2)
+        if header is None:
+            return None
+        cmd = header[1]
+        if cmd == DAPlatformBackend.AUD_FIFO_WRITE or cmd == DAPlatformBackend.CMD_FIFO_WRITE:
+            header = self.peek(4)
+            if header is None:
+                return None
+            return 6 + (int(header[2]) << 16) + int(header[3])
+        elif cmd == DAPlatformBackend.AUD_FIFO_READ:
+            return 4
+        elif cmd == DAPlatformBackend.SELECT_CLOCK or cmd == DAPlatformBackend.UPDATE_BLOCKING:
+            return 3
+        elif cmd == DAPlatformBackend.ECHO_SEND:
+            header = self.peek(3)
+            if header is None:
+                return None
+            return 3 + int(header[2])
+        else:
+            return 2
+
+    def process(self, now):
+        #   Handle complete commands until the input runs out or one of them has to
+        #   wait for the sample clocks (FIFO full, or not enough samples recorded).
+        self.advance(now)
+        self.stalled = False
+        while True:
+            length = self.command_length()
+            if length is None or self.input_words < length:
+                break
+            if not self.handle_command(self.peek(length)):
+                self.stalled = True
+                break
+            self.consume(length)
+
+        #   Slot responses (SPI reports) go out together, one CMD_FIFO_REPORT per slot
+        for (i, slot) in enumerate(self.slots):
+            if len(slot.ctl_out) > 0:
+                self.report(i, DAPlatformBackend.CMD_FIFO_REPORT, slot.ctl_out)
+                slot.ctl_out = []
+
+    def check_payload(self, slot_id, msg, payload):
+        N = payload.shape[0]
+        received = (int(msg[4 + N]) << 16) + int(msg[5 + N])
+        calculated = int(numpy.sum(payload, dtype=numpy.uint64)) & 0xFFFFFFFF
+        if received != calculated:
+            #   Matches the (truncated) fields the RTL reports
+            self.checksum_errors += 1
+            self.report(slot_id, DAPlatformBackend.CHECKSUM_ERROR, [(received >> 8) & 0xFF, received & 0xFF, (calculated >> 8) & 0xFF, calculated & 0xFF])
+
+    def handle_command(self, msg):
+        #   Returns False if the command can't be completed yet.
+        slot_id = int(msg[0])
+        cmd = int(msg[1])
+        if cmd == DAPlatformBackend.AUD_FIFO_WRITE:
+            payload = msg[4:-2]
+            if slot_id < self.num_slots:
+                fifo = self.fifos[slot_id]
+                if fifo.space() == 0:
+                    return False
+                words = payload[:(payload.shape[0] / 2) * 2].reshape((-1, 2)).astype(numpy.uint32)
+                fifo.push(((words[:, 0] << 16) | words[:, 1]).view(numpy.int32))
+            #   As in the RTL, data has already been written when the checksum is checked
+            self.check_payload(slot_id, msg, payload)
+        elif cmd == DAPlatformBackend.CMD_FIFO_WRITE:
+            payload = msg[4:-2]
+            if slot_id < self.num_slots:
+                self.slots[slot_id].receive_ctl(payload)
+            self.check_payload(slot_id, msg, payload)
+        elif cmd == DAPlatformBackend.AUD_FIFO_READ:
+            num_samples = (int(msg[2]) << 16) + int(msg[3])
+            fifo = self.fifos[self.num_slots + slot_id]
+            if fifo.count < num_samples:
+                return False
+            #   Least significant word of each sample goes first
+            samples = fifo.pop(num_samples).astype('<i4')
+            self.report(slot_id, DAPlatformBackend.AUD_FIFO_REPORT, samples.view('<u2'))
+        elif cmd == DAPlatformBackend.DIRCHAN_READ:
+            self.report(DAPlatformBackend.GLOBAL_TARGET_INDEX, DAPlatformBackend.DIRCHAN_REPORT, [self.dirchan()])
+        elif cmd == DAPlatformBackend.AOVF_READ:
+            self.report(DAPlatformBackend.GLOBAL_TARGET_INDEX, DAPlatformBackend.AOVF_REPORT, [self.hwflags])
+            self.hwflags = 0
+        elif cmd == DAPlatformBackend.FIFO_READ_STATUS:
+            counters = []
+            for fifo in self.fifos:
+                counters += [fifo.write_counter >> 16, fifo.write_counter & 0xFFFF, fifo.read_counter >> 16, fifo.read_counter & 0xFFFF]
+            self.report(DAPlatformBackend.GLOBAL_TARGET_INDEX, DAPlatformBackend.FIFO_REPORT_STATUS, counters)
+        elif cmd == DAPlatformBackend.RESET_SLOTS:
+            for slot in self.slots:
+                slot.reset()
+        elif cmd == DAPlatformBackend.ENTER_RESET:
+            for slot in self.slots:
+                slot.reset()
+            self.reset_hold = True
+        elif cmd == DAPlatformBackend.LEAVE_RESET:
+            self.reset_hold = False
+        elif cmd == DAPlatformBackend.STOP_SCLK:
+            self.sclk_en = False
+        elif cmd == DAPlatformBackend.START_SCLK:
+            self.sclk_en = True
+        elif cmd == DAPlatformBackend.SELECT_CLOCK:
+            #   Slots are reset when their clock is switched over
+            clksel = int(msg[2]) & 1
+            if clksel != self.clksel:
+                for slot in self.slots:
+                    slot.reset()
+            self.clksel = clksel
+        elif cmd == DAPlatformBackend.UPDATE_BLOCKING:
+            self.fifo_en = int(msg[2])
+        elif cmd == DAPlatformBackend.ECHO_SEND:
+            self.report(slot_id, DAPlatformBackend.ECHO_REPORT, msg[3:])
+        else:
+            print 'FPGAEmulator: ignoring unknown command 0x%02x for slot %d' % (cmd, slot_id)
+        return True
+
+    def report(self, slot_id, report_id, msg):
+        msg = numpy.asarray(msg, dtype=numpy.uint16)
+        N = msg.shape[0]
+        frame = numpy.empty((N + 6,), dtype=numpy.uint16)
+        frame[0] = slot_id
+        frame[1] = report_id
+        frame[2] = (N >> 16) & 0xFF
+        frame[3] = N & 0xFFFF
+        frame[4:4 + N] = msg
+        #   The RTL's accumulator is held while the checksum goes out, one word too
+        #   early, so the last word before the footer isn't included.
+        checksum = int(numpy.sum(frame[:3 + N], dtype=numpy.uint64)) & 0xFFFFFFFF
+        frame[4 + N] = checksum >> 16
+        frame[5 + N] = checksum & 0xFFFF
+        self.output.append(frame)
+        self.output_words += frame.shape[0]
+
+    def read_output(self, max_words):
+        #   Remove up to max_words words of report data
+        parts = []
+        remaining = min(max_words, self.output_words)
+        while remaining > 0:
+            frame = self.output[0]
+            if frame.shape[0] <= remaining:
+                parts.append(self.output.popleft())
+                remaining -= frame.shape[0]
+            else:
+                parts.append(frame[:remaining])
+                self.output[0] = frame[remaining:]
+                remaining = 0
+        if len(parts) == 0:
+            return numpy.zeros((0,), dtype=numpy.uint16)
+        result = numpy.concatenate(parts)
+        self.output_words -= result.shape[0]
+        return result
+
+    def next_event_time(self, now):
+        if self.stalled:
+            return now + POLL_INTERVAL
+        return None
+
+
+class EmulatedTransfer(object):
+    """ Stand-in for usb1.USBTransfer (bulk transfers only).   """
+
+    def __init__(self, context):
+        self.context = context
+        self.endpoint = None
+        self.buffer = None
+        self.callback = None
+        self.user_data = None
+        self.timeout = 0
+        self.status = usb1.TRANSFER_COMPLETED
+        self.actual_length = 0
+        self.submitted = False
+
+    def setBulk(self, endpoint, buffer_or_len, callback=None, user_data=None, timeout=0):
+        self.endpoint = endpoint
+        self.setBuffer(buffer_or_len)
+        self.callback = callback
+        self.user_data = user_data
+        self.timeout = timeout
+
+    def setBuffer(self, buffer_or_len):
+        if isinstance(buffer_or_len, (int, long)):
+            self.buffer = bytearray(buffer_or_len)
+        else:
+            self.buffer = buffer_or_len
+
+    def getBuffer(self):
+        return self.buffer
+
+    def setUserData(self, user_data):
+        self.user_data = user_data
+
+    def getUserData(self):
+        return self.user_data
+
+    def getStatus(self):
+        return self.status
+
+    def getActualLength(self):
+        return self.actual_length
+
+    def isSubmitted(self):
+        return self.submitted
+
+    def submit(self):
+        self.context.submit(self)
+
+    def cancel(self):
+        self.context.cancel(self)
+
+    def close(self):
+        pass
+
+
+class EmulatedUSBContext(object):
+    """ Stand-in for usb1.USBContext connecting transfers to an FPGAEmulator.
+        Each direction of the link moves bandwidth bytes/s, and every transfer
+        completes latency seconds after its data has crossed the link.
+        OUT transfers complete once the FPGA has taken in all but
+        input_buffer_words of the data sent so far.
+    """
+
+    def __init__(self, fpga, bandwidth=40e6, latency=250e-6, input_buffer_words=(1 << 14)):
+        self.fpga = fpga
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.input_buffer_words = input_buffer_words
+
+        self.cond = threading.Condition(threading.RLock())
+        self.out_queue = collections.deque()
+        self.in_queue = collections.deque()
+        self.out_bus_free = 0.
+        self.in_bus_free = 0.
+        #   Cancelled transfers, whose callbacks run on the next event handling
+        self.cancelled = []
+
+    def reset(self):
+        with self.cond:
+            self.fpga.reset(time.time())
+
+    def submit(self, transfer):
+        with self.cond:
+            assert not transfer.submitted
+            now = time.time()
+            transfer.submitted = True
+            transfer.status = None
+            transfer.actual_length = 0
+            transfer.end_time = None
+            transfer.delivered = False
+            if transfer.timeout:
+                transfer.deadline = now + transfer.timeout * 1e-3
+            else:
+                transfer.deadline = None
+            if transfer.endpoint & 0x80:
+                self.in_queue.append(transfer)
+            else:
+                num_bytes = numpy.frombuffer(transfer.buffer, dtype=numpy.uint8).shape[0]
+                start_time = max(now, self.out_bus_free)
+                self.out_bus_free = start_time + num_bytes / self.bandwidth
+                transfer.end_time = self.out_bus_free + self.latency
+                self.out_queue.append(transfer)
+            self.cond.notify_all()
+
+    def cancel(self, transfer):
+        with self.cond:
+            if not transfer.submitted:
+                raise usb1.USBErrorNotFound()
+            #   Transfers that have already started moving data just run to completion
+            if transfer in self.out_queue and not transfer.delivered:
+                self.out_queue.remove(transfer)
+            elif transfer in self.in_queue and transfer.end_time is None:
+                self.in_queue.remove(transfer)
+            else:
+                return
+            transfer.status = usb1.TRANSFER_CANCELLED
+            transfer.submitted = False
+            self.cancelled.append(transfer)
+            self.cond.notify_all()
+
+    def finish(self, transfer, status):
+        transfer.status = status
+        transfer.submitted = False
+
+    def step(self, now):
+        #   Advance the model to now; returns the transfers that completed.
+        done = self.cancelled
+        self.cancelled = []
+        self.fpga.process(now)
+
+        #   OUT: data reaches the FPGA when it has crossed the link
+        while len(self.out_queue) > 0:
+            transfer = self.out_queue[0]
+            if transfer.end_time > now:
+                break
+            if not transfer.delivered:
+                self.fpga.receive(numpy.frombuffer(transfer.buffer, dtype=numpy.uint16), now)
+                transfer.delivered = True
+            if self.fpga.input_words > self.input_buffer_words:
+                break
+            self.out_queue.popleft()
+            transfer.actual_length = numpy.frombuffer(transfer.buffer, dtype=numpy.uint8).shape[0]
+            self.finish(transfer, usb1.TRANSFER_COMPLETED)
+            done.append(transfer)
+
+        #   IN: transfers take whatever report data is waiting, in the order they were
+        #   submitted.  Any of them may time out while waiting.
+        can_start = True
+        for transfer in self.in_queue:
+            if transfer.end_time is not None:
+                continue
+            if can_start and self.fpga.output_words > 0:
+                if isinstance(transfer.buffer, numpy.ndarray):
+                    buf = transfer.buffer
+                else:
+                    buf = numpy.frombuffer(transfer.buffer, dtype=numpy.uint8)
+                words = self.fpga.read_output(buf.shape[0] / 2)
+                buf[:words.nbytes] = words.view(numpy.uint8)
+                transfer.actual_length = words.nbytes
+                start_time = max(now, self.in_bus_free)
+                self.in_bus_free = start_time + words.nbytes / self.bandwidth
+                transfer.end_time = self.in_bus_free + self.latency
+                transfer.result = usb1.TRANSFER_COMPLETED
+            elif transfer.deadline is not None and now >= transfer.deadline:
+                transfer.end_time = now
+                transfer.result = usb1.TRANSFER_TIMED_OUT
+            else:
+                can_start = False
+        for transfer in list(self.in_queue):
+            if transfer.end_time is not None and transfer.end_time <= now:
+                self.in_queue.remove(transfer)
+                self.finish(transfer, transfer.result)
+                done.append(transfer)
+
+        return done
+
+    def next_event_time(self, now):
+        times = []
+        if len(self.cancelled) > 0:
+            times.append(now)
+        if len(self.out_queue) > 0:
+            if self.out_queue[0].delivered:
+                times.append(now + POLL_INTERVAL)
+            else:
+                times.append(self.out_queue[0].end_time)
+        for transfer in self.in_queue:
+            if transfer.end_time is not None:
+                times.append(transfer.end_time)
+            elif transfer.deadline is not None:
+                times.append(transfer.deadline)
+        fpga_time = self.fpga.next_event_time(now)
+        if fpga_time is not None:
+            times.append(fpga_time)
+        if len(times) == 0:
+            return None
+        return min(times)
+
+    def handleEventsTimeout(self, tv=0):
+        #   Wait up to tv seconds for something to happen, then run the callbacks
+        deadline = time.time() + tv
+        while True:
+            with self.cond:
+                now = time.time()
+                done = self.step(now)
+                if len(done) == 0 and now < deadline:
+                    wake_time = deadline
+                    next_time = self.next_event_time(now)
+                    if next_time is not None:
+                        wake_time = min(wake_time, next_time)
+                    if wake_time > now:
+                        self.cond.wait(wake_time - now)
+                    continue
+            for transfer in done:
+                if transfer.callback is not None:
+                    transfer.callback(transfer)
+            return
+
+    def getNextTimeout(self):
+        with self.cond:
+            now = time.time()
+            next_time = self.next_event_time(now)
+        if next_time is None:
+            return None
+        return max(next_time - now, 0)
+
+    def getPollFDList(self):
+        #   Nothing to poll; see getNextTimeout()
+        return []
+
+    def setPollFDNotifiers(self, added_cb=None, removed_cb=None, user_data=None):
+        pass
+
+
+class EmulatedDeviceHandle(object):
+    """ Stand-in for usb1.USBDeviceHandle.  """
+
+    def __init__(self, context):
+        self.context = context
+
+    def getTransfer(self, iso_packets=0):
+        return EmulatedTransfer(self.context)
+
+    def setConfiguration(self, configuration):
+        pass
+
+    def claimInterface(self, interface):
+        pass
+
+    def releaseInterface(self, interface):
+        pass
+
+    def close(self):
+        pass
+
+    def controlWrite(self, request_type, request, value, index, data, timeout=0):
+        #   The only vendor request used is 0x60, which resets the FPGA
+        if request == 0x60:
+            self.context.reset()
+        return len(data)
+
+    def bulk_transfer(self, endpoint, data, timeout):
+        transfer = self.getTransfer()
+        transfer.setBulk(endpoint, data, timeout=timeout)
+        transfer.submit()
+        while transfer.isSubmitted():
+            self.context.handleEventsTimeout(0.01)
+        if transfer.getStatus() == usb1.TRANSFER_TIMED_OUT:
+            raise usb1.USBErrorTimeout()
+        return transfer
+
+    def bulkWrite(self, endpoint, data, timeout=0):
+        return self.bulk_transfer(endpoint, data, timeout).getActualLength()
+
+    def bulkRead(self, endpoint, length, timeout=0):
+        transfer = self.bulk_transfer(endpoint, length, timeout)
+        return bytes(transfer.getBuffer()[:transfer.getActualLength()])
+
+
+class EmulatorBackend(DAPlatformBackend):
+    """ DAPlatformBackend connected to an FPGAEmulator instead of a ZTEX board.
+        bandwidth (bytes/s) and latency (s) describe the simulated USB link;
+        see FPGAEmulator for modules, loopback and fifo_capacity.
+    """
+
+    def __init__(self, num_slots=4, reset=False, threaded=False, modules=None, loopback=None, fifo_capacity=(1 << 22), bandwidth=40e6, latency=250e-6):
+        self.fpga = FPGAEmulator(num_slots, modules, loopback, fifo_capacity)
+        self.usb_bandwidth = bandwidth
+        self.usb_latency = latency
+        super(EmulatorBackend, self).__init__(num_slots=num_slots, reset=reset, threaded=threaded)
+
+    def open(self):
+        self.context = EmulatedUSBContext(self.fpga, self.usb_bandwidth, self.usb_latency)
+        self.handle = EmulatedDeviceHandle(self.context)
@@ -15,6 +15,10 @@ import numpy
 import libusb1
 import usb1
 import time
+import collections
+import threading
+
+from backends.buffers import BufferPool
 
 #   Set to True for debugging
 IO_DISPLAY = False
@@ -25,6 +29,49 @@ class EZUSBBackend(object):
     EP_OUT = 0x06
 
     def __init__(self, dtype=numpy.uint16):
+        self.open()
+        
+        self.dtype=dtype
+        self.bytes_per_word = numpy.dtype(dtype).itemsize
+
+        #   Preallocated buffers for transfers, and transfer objects for synchronous reads/writes
+        self.buffer_pool = BufferPool(dtype=dtype)
+        self.read_transfer = self.handle.getTransfer()
+        self.read_lock = threading.Lock()
+        self.read_done = False
+        self.write_transfer = self.handle.getTransfer()
+        self.write_lock = threading.Lock()
+        self.write_done = False
+
+        #   Transfer callbacks update state and notify event_cond while holding it.
+        #   libusb events are handled either inline by whichever call is waiting,
+        #   or by a background thread (see start_event_thread).
+        self.event_cond = threading.Condition(threading.RLock())
+        self.event_thread = None
+        self.event_thread_running = False
+
+        #   State for the standing read ring (see start_read_ring)
+        self.ring_active = False
+        self.ring_transfers = []
+        self.ring_in_flight = 0
+        self.ring_data = collections.deque()
+        self.ring_error = None
+
+        #   State for the pipelined OUT queue (see enable_write_queue)
+        self.write_queue_depth = 0
+        self.write_transfers_idle = collections.deque()
+        self.write_in_flight = 0
+        self.write_submitted_count = 0
+        self.write_completed_count = 0
+        self.write_bytes_completed = 0
+        self.write_error = None
+
+        #   If set, every transfer is passed to its record_out()/record_in() (see backends/recorder.py)
+        self.recorder = None
+        
+    def open(self):
+        #   Sets up self.context and self.handle; subclasses may provide something else
+        #   with the same interface (see backends/emulator.py).
         self.context = usb1.USBContext()
         
         self.device = self.context.getByVendorIDAndProductID(0x221a, 0x0100)
@@ -33,10 +80,7 @@ class EZUSBBackend(object):
         #   self.handle.resetDevice()
         self.handle.setConfiguration(1)
         self.handle.claimInterface(0)
-        
-        self.dtype=dtype
-        self.bytes_per_word = numpy.dtype(dtype).itemsize
-        
+
     def flush(self):
         flushed = False
         flush_count = 0
@@ -49,69 +93,327 @@ class EZUSBBackend(object):
         print 'Flushed FIFOs in %d iterations' % flush_count
 
     def close(self):
+        if self.ring_active:
+            self.stop_read_ring()
+        if self.write_queue_depth > 0:
+            self.write_flush()
+        if self.event_thread is not None:
+            self.stop_event_thread()
+        if self.recorder is not None:
+            self.recorder.close()
         self.handle.releaseInterface(0)
         self.handle.close()
 
-    def read(self, num_words, fail_on_timeout=False, display=IO_DISPLAY, timeout=100):
+    def start_event_thread(self):
+        """ Run the libusb event loop in a background thread, so that transfers
+            complete (and waiting calls in other threads wake up) without any
+            caller having to drive the event loop.
+        """
+        assert self.event_thread is None
+        self.event_thread_running = True
+        self.event_thread = threading.Thread(target=self.run_event_thread, name='libusb events')
+        self.event_thread.daemon = True
+        self.event_thread.start()
+
+    def run_event_thread(self):
+        while self.event_thread_running:
+            try:
+                self.context.handleEventsTimeout(tv=0.1)
+            except usb1.USBErrorInterrupted:
+                pass
+
+    def stop_event_thread(self):
+        self.event_thread_running = False
+        self.event_thread.join()
+        self.event_thread = None
+
+    def handle_events(self, timeout=0.1):
+        #   Run the libusb event loop once; timeout is in seconds.
         try:
-            num_bytes = num_words * self.bytes_per_word
-            result = self.handle.bulkRead(EZUSBBackend.EP_IN, num_bytes, timeout)
-        except usb1.USBErrorTimeout:
-            result = ''
+            self.context.handleEventsTimeout(tv=timeout)
+        except usb1.USBErrorInterrupted:
+            print 'Got USBErrorInterrupted'
+
+    def wait_events(self, predicate, timeout=None):
+        #   Block until predicate() is true or timeout (in seconds) expires; returns predicate().
+        #   predicate is always evaluated with event_cond held, so it sees consistent state.
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.event_cond:
+            while not predicate():
+                if timeout is None:
+                    remaining = 0.1
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                if self.event_thread_running:
+                    self.event_cond.wait(remaining)
+                else:
+                    self.handle_events(remaining)
+            return predicate()
+
+    def acquire_buffer(self, num_words):
+        return self.buffer_pool.acquire(num_words)
+
+    def release_buffer(self, buf):
+        self.buffer_pool.release(buf)
+
+    def byte_view(self, data):
+        #   libusb can transfer directly from/to the memory behind a (contiguous) uint8 view
+        return numpy.ascontiguousarray(data, dtype=self.dtype).view(numpy.uint8)
+
+    def read_callback(self, transfer):
+        with self.event_cond:
+            self.read_done = True
+            self.event_cond.notify_all()
+
+    def read_into(self, buf, fail_on_timeout=False, timeout=100):
+        #   Read straight into buf without intermediate copies.  Returns the number of words read.
+        with self.read_lock:
+            self.read_done = False
+            self.read_transfer.setBulk(EZUSBBackend.EP_IN, buf.view(numpy.uint8), callback=self.read_callback, timeout=timeout)
+            self.read_transfer.submit()
+            self.wait_events(lambda: self.read_done)
+            status = self.read_transfer.getStatus()
+            num_bytes = self.read_transfer.getActualLength()
+        if self.recorder is not None and num_bytes > 0:
+            self.recorder.record_in(buf[:num_bytes / self.bytes_per_word])
+        if status == usb1.TRANSFER_TIMED_OUT:
             if fail_on_timeout:
-                raise
+                raise usb1.USBErrorTimeout()
+        elif status != usb1.TRANSFER_COMPLETED:
+            raise usb1.USBError(status)
+        return num_bytes / self.bytes_per_word
 
-        result = numpy.frombuffer(result, dtype=self.dtype)
+    def read(self, num_words, fail_on_timeout=False, display=IO_DISPLAY, timeout=100):
+        buf = self.acquire_buffer(num_words)
+        num_read = self.read_into(buf, fail_on_timeout=fail_on_timeout, timeout=timeout)
+        result = buf[:num_read].copy()
+        self.release_buffer(buf)
         if display: print 'Got %d/%d words: %s' % (len(result), num_words, result)
         return result
     
+    def write_sync_callback(self, transfer):
+        with self.event_cond:
+            self.write_done = True
+            self.event_cond.notify_all()
+
     def write(self, data, display=IO_DISPLAY):
-        num_bytes = self.handle.bulkWrite(EZUSBBackend.EP_OUT, data.tostring())
+        #   Not handle.bulkWrite(): that runs the libusb event loop outside of wait_events,
+        #   and could run (and block in) the callbacks of a transfer another thread is waiting for.
+        if self.recorder is not None:
+            self.recorder.record_out(data)
+        with self.write_lock:
+            self.write_done = False
+            self.write_transfer.setBulk(EZUSBBackend.EP_OUT, self.byte_view(data), callback=self.write_sync_callback)
+            self.write_transfer.submit()
+            self.wait_events(lambda: self.write_done)
+            status = self.write_transfer.getStatus()
+            num_bytes = self.write_transfer.getActualLength()
+        if status != usb1.TRANSFER_COMPLETED:
+            raise usb1.USBError(status)
         assert num_bytes == data.shape[0] * self.bytes_per_word
         num_words = num_bytes / self.bytes_per_word
         if display: print 'Wrote %d/%d words: %s' % (num_words, data.shape[0], data)
 
+    def enable_write_queue(self, depth=4):
+        """ Allow up to depth bulk OUT transfers to be in flight at once via write_async().  """
+        with self.event_cond:
+            assert self.write_in_flight == 0
+            for transfer in self.write_transfers_idle:
+                transfer.close()
+            self.write_transfers_idle.clear()
+            for i in range(depth):
+                self.write_transfers_idle.append(self.handle.getTransfer())
+            self.write_queue_depth = depth
+
+    def write_async(self, data, display=IO_DISPLAY):
+        #   Queue data for EP_OUT without waiting for the transfer to finish.
+        #   If the queue is full, block (running the event loop) until a slot frees up.
+        #   data is sent in place, so it must not be modified until the transfer completes;
+        #   buffers from acquire_buffer() are handed over and released on completion.
+        with self.event_cond:
+            self.wait_events(lambda: self.write_in_flight < self.write_queue_depth or self.write_error is not None)
+            if self.write_error is not None:
+                raise usb1.USBError(self.write_error)
+
+            if self.recorder is not None:
+                self.recorder.record_out(data)
+            transfer = self.write_transfers_idle.popleft()
+            transfer.setBulk(EZUSBBackend.EP_OUT, self.byte_view(data), callback=self.write_callback, user_data=data)
+            transfer.submit()
+            self.write_in_flight += 1
+            self.write_submitted_count += 1
+        if display: print 'Queued %d words (%d in flight): %s' % (data.shape[0], self.write_in_flight, data)
+
+    def write_owned(self, data):
+        #   Send a buffer from acquire_buffer(), handing it over to the backend
+        #   which releases it once the data has been sent.
+        if self.write_queue_depth > 0:
+            self.write_async(data)
+        else:
+            self.write(data)
+            self.release_buffer(data)
+
+    def write_callback(self, transfer):
+        with self.event_cond:
+            status = transfer.getStatus()
+            if status == usb1.TRANSFER_COMPLETED:
+                self.write_completed_count += 1
+                self.write_bytes_completed += transfer.getActualLength()
+            else:
+                print 'write_callback: transfer fail, status = %s' % status
+                self.write_error = status
+            self.release_buffer(transfer.getUserData())
+            transfer.setUserData(None)
+            self.write_in_flight -= 1
+            self.write_transfers_idle.append(transfer)
+            self.event_cond.notify_all()
+
+    def write_flush(self):
+        #   Wait for all queued OUT transfers to complete.
+        self.wait_events(lambda: self.write_in_flight == 0)
+        if self.write_error is not None:
+            raise usb1.USBError(self.write_error)
+
+    def write_queue_status(self):
+        with self.event_cond:
+            return {
+                'submitted': self.write_submitted_count,
+                'completed': self.write_completed_count,
+                'in_flight': self.write_in_flight,
+                'bytes_completed': self.write_bytes_completed,
+            }
+
     def rw_callback(self, transfer):
-        self.callback_active = True
-        if transfer.getStatus() != usb1.TRANSFER_COMPLETED:
-            print 'rw_callback: transfer fail, status = %s' % transfer.getStatus()
-            print 'Actual length = %d buffer size = %d' % (transfer.getActualLength(), len(transfer.getBuffer()))
-            raise usb1.USBError(transfer.getStatus())
-        data = transfer.getBuffer()[:transfer.getActualLength()]
-        #   Don't resubmit... though that would be smart
-        #   NOTE: should this handle the case of an odd number of bytes?
-        self.read_data_pending = numpy.frombuffer(data, dtype=self.dtype)
-        self.callback_active = False
+        with self.event_cond:
+            if transfer.getStatus() != usb1.TRANSFER_COMPLETED:
+                print 'rw_callback: transfer fail, status = %s' % transfer.getStatus()
+                print 'Actual length = %d buffer size = %d' % (transfer.getActualLength(), len(transfer.getBuffer()))
+                self.rw_error = transfer.getStatus()
+            elif transfer is self.rw_read_transfer:
+                data = transfer.getBuffer()[:transfer.getActualLength()]
+                #   Don't resubmit... though that would be smart
+                #   NOTE: should this handle the case of an odd number of bytes?
+                self.read_data_pending = numpy.frombuffer(data, dtype=self.dtype)
+                if self.recorder is not None:
+                    self.recorder.record_in(self.read_data_pending)
+            self.rw_pending -= 1
+            self.event_cond.notify_all()
 
     def read_and_write(self, data, read_size, timeout=100):
         #   Simultaneously request and read back data using libusb async functions.
         #   Then (and this can be optional later?) wait for both to complete.
-        transfer_list = []
-        self.callback_active = False
-        self.read_data_pending = None
-        #   a) Write
-        transfer1 = self.handle.getTransfer()
-        transfer1.setBulk(EZUSBBackend.EP_OUT, data.tostring(), callback=self.rw_callback)
-        transfer1.submit()
-        transfer_list.append(transfer1)
-        #   b) Read
-        transfer2 = self.handle.getTransfer()
-        transfer2.setBulk(EZUSBBackend.EP_IN, read_size * self.bytes_per_word, callback=self.rw_callback)
-        transfer2.submit()
-        transfer_list.append(transfer2)
-        
-        while any(x.isSubmitted() for x in transfer_list):
-            try:
-                self.context.handleEvents()
-            except usb1.USBErrorInterrupted:
-                print 'Got USBErrorInterrupted'
-                pass
-        
-        while self.callback_active:
-            time.sleep(0)
-        
-        #   Should be done now.
-        return self.read_data_pending
+        with self.read_lock:
+            self.read_data_pending = None
+            self.rw_error = None
+            self.rw_pending = 2
+            #   a) Write
+            transfer1 = self.handle.getTransfer()
+            transfer1.setBulk(EZUSBBackend.EP_OUT, self.byte_view(data), callback=self.rw_callback)
+            #   b) Read
+            transfer2 = self.handle.getTransfer()
+            transfer2.setBulk(EZUSBBackend.EP_IN, read_size * self.bytes_per_word, callback=self.rw_callback)
+            self.rw_read_transfer = transfer2
+            if self.recorder is not None:
+                self.recorder.record_out(data)
+            transfer1.submit()
+            transfer2.submit()
+
+            self.wait_events(lambda: self.rw_pending == 0)
+            if self.rw_error is not None:
+                raise usb1.USBError(self.rw_error)
+
+            #   Should be done now.
+            return self.read_data_pending
+
+    def start_read_ring(self, num_transfers=8, transfer_words=4096):
+        """ Keep num_transfers bulk IN transfers in flight on EP_IN at all times.
+            Each transfer reads into a buffer from the pool and is resubmitted
+            from its callback; received data is queued until read_ring() is called.
+        """
+        with self.event_cond:
+            assert not self.ring_active
+            self.ring_active = True
+            self.ring_data.clear()
+            self.ring_error = None
+            for i in range(num_transfers):
+                transfer = self.handle.getTransfer()
+                buf = self.acquire_buffer(transfer_words)
+                transfer.setBulk(EZUSBBackend.EP_IN, buf.view(numpy.uint8), callback=self.ring_callback, user_data=buf)
+                transfer.submit()
+                self.ring_transfers.append(transfer)
+                self.ring_in_flight += 1
+
+    def ring_callback(self, transfer):
+        with self.event_cond:
+            status = transfer.getStatus()
+            resubmit = False
+            if status == usb1.TRANSFER_COMPLETED or status == usb1.TRANSFER_TIMED_OUT:
+                num_words = transfer.getActualLength() / self.bytes_per_word
+                if num_words > 0:
+                    #   Hand the filled buffer to the consumer and give libusb a fresh one
+                    buf = transfer.getUserData()
+                    if self.recorder is not None:
+                        self.recorder.record_in(buf[:num_words])
+                    self.ring_data.append(buf[:num_words])
+                    buf = self.acquire_buffer(buf.shape[0])
+                    transfer.setBuffer(buf.view(numpy.uint8))
+                    transfer.setUserData(buf)
+                resubmit = self.ring_active
+            elif status != usb1.TRANSFER_CANCELLED:
+                print 'ring_callback: transfer fail, status = %s' % status
+                self.ring_error = status
+
+            if resubmit:
+                transfer.submit()
+            else:
+                self.ring_in_flight -= 1
+            self.event_cond.notify_all()
+
+    def read_ring_chunks(self, timeout=100):
+        #   Return the list of buffers the read ring has filled so far, waiting up to
+        #   timeout (in ms) for the first data to show up.  The caller must
+        #   release_buffer() each of them once it is done with the data.
+        with self.event_cond:
+            self.wait_events(lambda: len(self.ring_data) > 0 or self.ring_error is not None, timeout * 1e-3)
+            if self.ring_error is not None:
+                raise usb1.USBError(self.ring_error)
+
+            chunks = []
+            while len(self.ring_data) > 0:
+                chunks.append(self.ring_data.popleft())
+            return chunks
+
+    def read_ring(self, timeout=100, display=IO_DISPLAY):
+        #   Same as read_ring_chunks, but returns a single array.
+        chunks = self.read_ring_chunks(timeout)
+        if len(chunks) == 0:
+            result = numpy.array([], dtype=self.dtype)
+        else:
+            result = numpy.concatenate(chunks)
+        for chunk in chunks:
+            self.release_buffer(chunk)
+        if display: print 'Read ring returned %d words: %s' % (len(result), result)
+        return result
+
+    def stop_read_ring(self):
+        #   Cancel the outstanding IN transfers.  Data that already arrived
+        #   stays queued and can still be collected with read_ring().
+        with self.event_cond:
+            self.ring_active = False
+            for transfer in self.ring_transfers:
+                try:
+                    transfer.cancel()
+                except usb1.USBErrorNotFound:
+                    #   Already completed
+                    pass
+        self.wait_events(lambda: self.ring_in_flight == 0)
+        for transfer in self.ring_transfers:
+            self.release_buffer(transfer.getUserData())
+            transfer.close()
+        self.ring_transfers = []
 
     def reset(self):
         self.handle.controlWrite(libusb1.LIBUSB_TYPE_VENDOR, 0x60, 0, 0, '')
@@ -0,0 +1,180 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    fifo_status.py: Keeps track of the DRAM FIFO status (samples written to
+    and read from each FIFO port) using FIFO_REPORT_STATUS reports.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import threading
+import time
+
+import numpy
+import usb1
+
+from utils import monotonic_time
+
+
+class FIFOStatus(object):
+    """ One FIFO_REPORT_STATUS report.  counts[port] = (samples written, samples
+        read), as 32-bit counters which wrap around.  Ports 0 to num_slots - 1
+        hold playback data for each slot, and the rest hold recorded data.
+        timestamp is the monotonic_time() when the report was received.
+    """
+
+    def __init__(self, msg, timestamp):
+        words = numpy.asarray(msg, dtype=numpy.uint32).reshape((-1, 2))
+        self.counts = ((words[:, 0] << 16) | words[:, 1]).reshape((-1, 2))
+        self.timestamp = timestamp
+
+    def age(self):
+        return monotonic_time() - self.timestamp
+
+    def pending(self, port):
+        #   Samples written to the port but not read yet
+        return int(self.counts[port, 0] - self.counts[port, 1]) & 0xFFFFFFFF
+
+    def display(self):
+        print 'DRAM FIFO status:'
+        for i in range(self.counts.shape[0]):
+            if self.counts[i, 0] != 0 or self.counts[i, 1] != 0:
+                print '  Port %d: Wrote %d samples, read %d samples' % (i, self.counts[i, 0], self.counts[i, 1])
+
+
+class FIFOStatusService(object):
+    """ Requests FIFO status reports and caches the latest one.  Status reports
+        are received along with everything else (see DAPlatformBackend.subscribe),
+        so other traffic such as audio can be interleaved with them.
+
+        Concurrent requests share one FIFO_READ_STATUS command, and status(max_age)
+        only asks the FPGA again if the cached status is older than max_age.
+        The rate at which each port is read (e.g. played back) is estimated from
+        successive reports, so wait_drained() can sleep until a port is expected
+        to be empty instead of polling it.
+    """
+
+    def __init__(self, backend, max_age=0.01, poll_interval=0.05):
+        self.backend = backend
+        #   Default maximum age (s) of a cached status, and the polling interval (s)
+        #   used by wait_drained() until the drain rate is known
+        self.max_age = max_age
+        self.poll_interval = poll_interval
+
+        self.lock = threading.Lock()
+        self.latest = None
+        #   Future for the report requested but not received yet, if any
+        self.request_future = None
+        #   Estimated read rate (samples/s) of each port, from the last two reports
+        self.read_rates = {}
+        self.backend.subscribe(backend.GLOBAL_TARGET_INDEX, backend.FIFO_REPORT_STATUS, self.status_received)
+
+    def close(self):
+        self.backend.unsubscribe(self.backend.GLOBAL_TARGET_INDEX, self.backend.FIFO_REPORT_STATUS, self.status_received)
+
+    def status_received(self, slot_id, report_id, msg):
+        status = FIFOStatus(msg, monotonic_time())
+        with self.lock:
+            previous = self.latest
+            self.latest = status
+            if previous is not None:
+                dt = status.timestamp - previous.timestamp
+                if dt > 0:
+                    for port in range(status.counts.shape[0]):
+                        num_read = int(status.counts[port, 1] - previous.counts[port, 1]) & 0xFFFFFFFF
+                        if num_read > 0 or status.pending(port) > 0:
+                            self.read_rates[port] = num_read / dt
+
+    def request(self):
+        """ Returns a future for the next status report, sending FIFO_READ_STATUS
+            unless a request is already outstanding.  The future's sent_time is
+            when the request was sent; the report includes everything sent before.
+        """
+        with self.lock:
+            future = self.request_future
+            if future is not None and not future.done():
+                return future
+        with self.backend.transaction_lock:
+            with self.lock:
+                if self.request_future is not None and not self.request_future.done():
+                    return self.request_future
+                with self.backend.state_lock:
+                    #   Drop reports nobody waited for (e.g. after a timeout), which are out of date
+                    self.backend.report_queue(self.backend.GLOBAL_TARGET_INDEX, self.backend.FIFO_REPORT_STATUS).clear()
+                future = self.backend.expect_report(self.backend.GLOBAL_TARGET_INDEX, self.backend.FIFO_REPORT_STATUS)
+                future.sent_time = monotonic_time()
+                self.request_future = future
+            self.backend.write(numpy.array([self.backend.GLOBAL_TARGET_INDEX, self.backend.FIFO_READ_STATUS], dtype=self.backend.dtype))
+        return future
+
+    def status(self, max_age=None, timeout=1.0):
+        """ Returns a FIFOStatus no older than max_age seconds (by default
+            self.max_age), asking the FPGA for a new one if necessary.
+        """
+        if max_age is None:
+            max_age = self.max_age
+        with self.lock:
+            latest = self.latest
+        if latest is not None and latest.age() <= max_age:
+            return latest
+        future = self.request()
+        try:
+            msg = self.backend.wait_report(future, timeout)
+        except usb1.USBErrorTimeout:
+            #   The report was lost; the next caller sends a new request
+            with self.lock:
+                if self.request_future is future:
+                    self.request_future = None
+            raise
+        #   (Other subscribers, including status_received, may not have seen it yet)
+        return FIFOStatus(msg, future.sent_time)
+
+    def read_rate(self, port):
+        #   Estimated samples/s read from the port, or None if not known yet
+        with self.lock:
+            return self.read_rates.get(port)
+
+    def predicted_drain_time(self, port, status=None):
+        """ Estimated seconds (from now) until the port is empty, or None if its
+            read rate isn't known.
+        """
+        if status is None:
+            status = self.status()
+        pending = status.pending(port)
+        if pending == 0:
+            return 0.0
+        rate = self.read_rate(port)
+        if not rate:
+            return None
+        return max(0.0, pending / rate - status.age())
+
+    def wait_drained(self, port, timeout=None, threshold=0):
+        """ Block until no more than threshold samples are pending in the port.
+            Sleeps until the port is expected to have drained (or for the polling
+            interval if that can't be predicted yet), then checks again.
+            Returns False if timeout (s) expires first.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = monotonic_time() + timeout
+        while True:
+            status = self.status(max_age=0)
+            pending = status.pending(port)
+            if pending <= threshold:
+                return True
+            rate = self.read_rate(port)
+            if rate:
+                delay = max((pending - threshold) / rate - status.age(), 0.001)
+            else:
+                delay = self.poll_interval
+            if deadline is not None:
+                remaining = deadline - monotonic_time()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
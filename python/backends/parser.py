@@ -0,0 +1,222 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    parser.py: Incremental parser for the stream of reports sent by the FPGA.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import numpy
+
+#   Reports the FPGA sends (see verilog/commands.vh), with their maximum lengths in words.
+def report_max_lengths(num_slots, max_length):
+    return {
+        0x11: max_length,       #   AUD_FIFO_REPORT
+        0x21: 0xFFFF,           #   CMD_FIFO_REPORT
+        0x42: 1,                #   DIRCHAN_REPORT
+        0x44: 1,                #   AOVF_REPORT
+        0x46: 0xFF,             #   ECHO_REPORT
+        0x49: num_slots * 8,    #   FIFO_REPORT_STATUS
+        0x50: 4,                #   CHECKSUM_ERROR
+    }
+
+#   Indices into the per-(slot, report ID) counters
+COUNT_GOOD = 0
+COUNT_BAD = 1
+COUNT_RESYNC = 2
+
+#   Words examined at a time when looking for the next plausible header
+RESYNC_SCAN_WORDS = 4096
+
+
+class ReportParser(object):
+    """ Incoming data is appended to a buffer, and complete reports are returned
+        as views into that buffer rather than copies.  Space in the buffer is
+        never reused once reports have been handed out from it: when it fills up,
+        the unparsed remainder moves to a new buffer instead, so earlier views
+        stay valid for as long as they are kept.
+
+        Report format: [slot, report ID, length (2 words), message, checksum (2 words)]
+
+        Checksums are verified unless check_checksums is False; reports that fail
+        are dropped.  If a header doesn't make sense (or a report fails its checksum
+        and isn't followed by a sensible header), the header was probably corrupted,
+        so the parser skips ahead to the next plausible header.  A report that fails
+        is kept until the next header has arrived, so the outcome doesn't depend on
+        how the data was split into packets.  The counters record
+        good, bad and resynchronized (first good report after skipping) reports
+        for each (slot, report ID).
+    """
+
+    def __init__(self, capacity=(1 << 16), dtype=numpy.uint16, num_slots=4, check_checksums=True, max_length=(1 << 22)):
+        self.dtype = dtype
+        self.min_capacity = capacity
+        self.buffer = numpy.empty((capacity,), dtype=dtype)
+        #   Unparsed data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+        #   Whether any views of the current buffer have been handed out
+        self.shared = False
+
+        self.num_slots = num_slots
+        self.check_checksums = check_checksums
+        #   Maximum length of each report (-1 for unknown report IDs), as a dict and as a table
+        self.max_lengths = report_max_lengths(num_slots, max_length)
+        self.max_length_table = -numpy.ones((1 << 16,), dtype=numpy.int64)
+        for (report_id, length) in self.max_lengths.items():
+            self.max_length_table[report_id] = length
+
+        self.counters = {}
+        self.resyncing = False
+        self.words_discarded = 0
+
+    def unparsed(self):
+        return self.buffer[self.start:self.end]
+
+    def reserve(self, num_words):
+        #   Make room for num_words more words after the unparsed data
+        if self.end + num_words <= self.buffer.shape[0]:
+            return
+        remaining = self.end - self.start
+        capacity = max(self.min_capacity, self.buffer.shape[0])
+        if remaining + num_words > capacity / 2:
+            capacity = 2 * (remaining + num_words)
+
+        if self.shared or capacity != self.buffer.shape[0]:
+            new_buffer = numpy.empty((capacity,), dtype=self.dtype)
+            new_buffer[:remaining] = self.buffer[self.start:self.end]
+            self.buffer = new_buffer
+            self.shared = False
+        else:
+            #   Nobody else is looking at this buffer, so it can be reused
+            self.buffer[:remaining] = self.buffer[self.start:self.end].copy()
+        self.start = 0
+        self.end = remaining
+
+    def feed(self, packet):
+        #   Copies the packet, so the caller may reuse it afterwards.
+        num_words = packet.shape[0]
+        self.reserve(num_words)
+        self.buffer[self.end:self.end + num_words] = packet
+        self.end += num_words
+
+    def walk(self):
+        #   Follow headers from start while they are plausible and their reports complete.
+        #   Returns ([(start, message end, checksum), ...], position after them, whether
+        #   the walk stopped at an implausible header).
+        item = self.buffer.item
+        pos = self.start
+        end = self.end
+        spans = []
+        while end - pos >= 4:
+            slot_id = item(pos)
+            length = (item(pos + 2) << 16) | item(pos + 3)
+            if (slot_id >= self.num_slots and slot_id != 0xFF) or length > self.max_lengths.get(item(pos + 1), -1):
+                return (spans, pos, True)
+            msg_end = pos + 4 + length
+            if msg_end + 2 > end:
+                break
+            spans.append((pos, msg_end, (item(msg_end) << 16) | item(msg_end + 1)))
+            pos = msg_end + 2
+        return (spans, pos, False)
+
+    def verify(self, spans):
+        #   Checksums for all of the reports at once.  As generated by the FPGA, the checksum
+        #   is the sum of the header and message words, except for the last message word.
+        if not self.check_checksums or len(spans) == 0:
+            return [True] * len(spans)
+        base = spans[0][0]
+        indices = []
+        for (start, msg_end, checksum) in spans:
+            indices.append(start - base)
+            indices.append(msg_end - 1 - base)
+        #   The 32-bit sums wrap around just like the FPGA's accumulator
+        sums = numpy.add.reduceat(self.buffer[base:spans[-1][1] + 2], indices, dtype=numpy.uint32)[0::2].tolist()
+        return [sums[i] == spans[i][2] for i in range(len(spans))]
+
+    def header_mask(self, region):
+        #   Which positions in region could be the start of a report header
+        slot_ids = region[:-3]
+        lengths = (region[2:-1].astype(numpy.uint32) << 16) | region[3:]
+        return ((slot_ids < self.num_slots) | (slot_ids == 0xFF)) & (lengths <= self.max_length_table[region[1:-2]])
+
+    def resync(self, pos):
+        #   Discard everything before the next plausible header at or after pos
+        if not self.resyncing:
+            print 'ReportParser: lost sync at offset %d, resynchronizing' % self.start
+        self.resyncing = True
+        new_start = None
+        while new_start is None and self.end - pos >= 4:
+            region = self.buffer[pos:min(pos + RESYNC_SCAN_WORDS + 3, self.end)]
+            candidates = numpy.flatnonzero(self.header_mask(region))
+            if len(candidates) > 0:
+                new_start = pos + candidates[0]
+            else:
+                pos += region.shape[0] - 3
+        if new_start is None:
+            #   Keep the last few words, which could be the start of a header
+            new_start = pos
+        self.words_discarded += new_start - self.start
+        self.start = new_start
+
+    def count(self, slot_id, report_id, index):
+        key = (slot_id, report_id)
+        if key not in self.counters:
+            self.counters[key] = [0, 0, 0]
+        self.counters[key][index] += 1
+
+    def frames(self):
+        """ Returns a list of (slot, report ID, message, checksum) for each complete,
+            valid report received so far.  Messages are views into the buffer.
+        """
+        buf = self.buffer
+        result = []
+        while True:
+            (spans, pos, garbage) = self.walk()
+            valid = self.verify(spans)
+            restart = False
+            waiting = False
+            for (i, (start, msg_end, checksum)) in enumerate(spans):
+                slot_id = buf.item(start)
+                report_id = buf.item(start + 1)
+                if valid[i]:
+                    if self.resyncing:
+                        self.count(slot_id, report_id, COUNT_RESYNC)
+                        self.resyncing = False
+                    else:
+                        self.count(slot_id, report_id, COUNT_GOOD)
+                    result.append((slot_id, report_id, buf[start + 4:msg_end], checksum))
+                elif not self.resyncing and i + 1 == len(spans) and self.end - (msg_end + 2) < 4:
+                    #   Whether the contents or the header were corrupted depends on the next
+                    #   header, which hasn't all arrived yet; look at this report again later
+                    self.start = start
+                    waiting = True
+                    break
+                elif not self.resyncing and (i + 1 < len(spans) or not garbage):
+                    #   What follows looks like a report, so just the contents were corrupted
+                    print 'ReportParser: bad checksum for report 0x%02x from slot %d' % (report_id, slot_id)
+                    self.count(slot_id, report_id, COUNT_BAD)
+                else:
+                    #   Probably a corrupted header (or a false match while resynchronizing)
+                    self.start = start
+                    self.resync(start + 1)
+                    restart = True
+                    break
+            if restart:
+                continue
+            if waiting:
+                break
+            self.start = pos
+            if garbage:
+                self.resync(pos + 1)
+                continue
+            break
+
+        if len(result) > 0:
+            self.shared = True
+        return result
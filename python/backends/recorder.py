@@ -0,0 +1,186 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    recorder.py: Recording of USB traffic to/from the FPGA, and replay of
+    recorded IN traffic, for benchmarking and profiling the report parsing
+    and receive state code offline on real data.
+
+    File format: the magic string below, followed by one record per transfer:
+    a 16-byte header (monotonic timestamp in seconds as a double, direction,
+    3 padding bytes, payload length in bytes) and then the payload (16-bit
+    words as sent over USB).  All values are little-endian.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import struct
+import threading
+import collections
+import time
+import numpy
+
+from backends.da_platform import DAPlatformBackend
+from backends.emulator import FPGAEmulator, EmulatedUSBContext, EmulatedDeviceHandle
+from utils import monotonic_time
+
+FILE_MAGIC = 'DAPTRAF1'
+RECORD_HEADER = struct.Struct('<dBxxxI')
+
+#   Directions
+DIR_OUT = 0
+DIR_IN = 1
+
+
+class TrafficRecorder(object):
+    """ Records transfers into a preallocated buffer, which is only written out
+        to the file when it fills up (or on flush/close), so recording adds
+        little more than a copy to each transfer.
+        To record a backend's traffic: backend.recorder = TrafficRecorder(filename)
+    """
+
+    def __init__(self, filename, buffer_size=(1 << 24)):
+        self.file = open(filename, 'wb')
+        self.file.write(FILE_MAGIC)
+        self.buffer = bytearray(buffer_size)
+        self.buffer_view = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+        self.offset = 0
+        self.lock = threading.Lock()
+        self.num_records = 0
+        self.num_bytes = 0
+
+    def record(self, direction, data):
+        payload = numpy.ascontiguousarray(data).view(numpy.uint8)
+        num_bytes = payload.shape[0]
+        timestamp = monotonic_time()
+        with self.lock:
+            if self.offset + RECORD_HEADER.size + num_bytes > len(self.buffer):
+                self.flush_locked()
+            header = RECORD_HEADER.pack(timestamp, direction, num_bytes)
+            if RECORD_HEADER.size + num_bytes > len(self.buffer):
+                #   Too big for the buffer; goes straight to the file
+                self.file.write(header)
+                self.file.write(payload.tostring())
+            else:
+                RECORD_HEADER.pack_into(self.buffer, self.offset, timestamp, direction, num_bytes)
+                self.offset += RECORD_HEADER.size
+                self.buffer_view[self.offset:self.offset + num_bytes] = payload
+                self.offset += num_bytes
+            self.num_records += 1
+            self.num_bytes += num_bytes
+
+    def record_out(self, data):
+        self.record(DIR_OUT, data)
+
+    def record_in(self, data):
+        self.record(DIR_IN, data)
+
+    def flush_locked(self):
+        self.file.write(memoryview(self.buffer)[:self.offset])
+        self.offset = 0
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_traffic(filename):
+    """ Returns a list of (timestamp, direction, data) for the transfers in a
+        recording, where data is an array of words viewing the file contents.
+    """
+    contents = open(filename, 'rb').read()
+    assert contents[:len(FILE_MAGIC)] == FILE_MAGIC, 'Not a traffic recording: %s' % filename
+    records = []
+    offset = len(FILE_MAGIC)
+    while offset + RECORD_HEADER.size <= len(contents):
+        (timestamp, direction, num_bytes) = RECORD_HEADER.unpack_from(contents, offset)
+        offset += RECORD_HEADER.size
+        data = numpy.frombuffer(contents, dtype=numpy.uint16, count=num_bytes / 2, offset=offset)
+        records.append((timestamp, direction, data))
+        offset += num_bytes
+    return records
+
+
+def replay_reports(records, backend, realtime=False):
+    """ Feed the recorded IN data straight to backend.parse_report(), either with
+        the original timing or as fast as possible.  Returns (number of records,
+        number of words, elapsed time).
+    """
+    in_records = [(timestamp, data) for (timestamp, direction, data) in records if direction == DIR_IN]
+    num_words = 0
+    start_time = monotonic_time()
+    for (timestamp, data) in in_records:
+        if realtime:
+            delay = (timestamp - in_records[0][0]) - (monotonic_time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+        backend.parse_report(data)
+        num_words += data.shape[0]
+    return (len(in_records), num_words, monotonic_time() - start_time)
+
+
+class RecordedTraffic(FPGAEmulator):
+    """ Takes the place of the FPGAEmulator behind an EmulatedUSBContext, producing
+        the recorded IN data (with the original timing if realtime is set) and
+        discarding whatever is sent to it.
+    """
+
+    def __init__(self, records, realtime=False):
+        self.records = [(timestamp, data) for (timestamp, direction, data) in records if direction == DIR_IN]
+        self.realtime = realtime
+        self.reset(time.time())
+
+    def reset(self, now):
+        self.start_time = now
+        self.index = 0
+        self.input_words = 0
+        self.output = collections.deque()
+        self.output_words = 0
+
+    def record_time(self, index):
+        #   When the record at index is due, relative to the start of the replay
+        return self.start_time + (self.records[index][0] - self.records[0][0])
+
+    def receive(self, words, now):
+        self.process(now)
+
+    def process(self, now):
+        while self.index < len(self.records):
+            if self.realtime and self.record_time(self.index) > now:
+                break
+            data = self.records[self.index][1]
+            self.output.append(data)
+            self.output_words += data.shape[0]
+            self.index += 1
+
+    def next_event_time(self, now):
+        if self.realtime and self.index < len(self.records):
+            return self.record_time(self.index)
+        return None
+
+
+class ReplayBackend(DAPlatformBackend):
+    """ DAPlatformBackend whose EP_IN returns the IN traffic from a recording,
+        so the whole receive path (update_receive_state, read ring, etc.) can be
+        run on it.  Writes complete immediately and are discarded.
+    """
+
+    def __init__(self, filename, realtime=False, num_slots=4):
+        self.traffic = RecordedTraffic(read_traffic(filename), realtime)
+        super(ReplayBackend, self).__init__(num_slots=num_slots)
+
+    def open(self):
+        self.context = EmulatedUSBContext(self.traffic, bandwidth=float('inf'), latency=0)
+        self.handle = EmulatedDeviceHandle(self.context)
+
+    def replay_done(self):
+        return self.traffic.index == len(self.traffic.records) and self.traffic.output_words == 0
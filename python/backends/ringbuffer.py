@@ -0,0 +1,98 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    ringbuffer.py: Fixed-capacity ring buffer for received audio.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import numpy
+
+
+class AudioRingBuffer(object):
+    """ Ring buffer of words received from one slot.  The first max_view words
+        of the ring are mirrored just past its end, so any read of up to
+        max_view words can be returned as a view without copying, wherever it
+        starts.  Views are only valid until the space they occupy is written
+        again (after it has been consumed, or on an overrun).
+
+        If more is written than there is space for, the oldest data is dropped
+        and counted in overrun_words.  Data is kept in units of align words
+        (one sample = 2 words), so dropping never splits a sample.
+    """
+
+    def __init__(self, capacity=(1 << 22), max_view=(1 << 18), dtype=numpy.uint16, align=2):
+        assert capacity % align == 0 and max_view <= capacity
+        self.capacity = capacity
+        self.max_view = max_view
+        self.align = align
+        self.buffer = numpy.zeros((capacity + max_view,), dtype=dtype)
+        #   Total words written and read; positions in the ring are these modulo capacity
+        self.write_count = 0
+        self.read_count = 0
+        self.overrun_words = 0
+
+    def available(self):
+        return self.write_count - self.read_count
+
+    def space(self):
+        return self.capacity - self.available()
+
+    def clear(self):
+        self.read_count = self.write_count
+
+    def copy_in(self, pos, data):
+        #   Copy data into the ring at pos (no wraparound), keeping the mirror up to date
+        N = data.shape[0]
+        self.buffer[pos:pos + N] = data
+        if pos < self.max_view:
+            mirror_end = min(pos + N, self.max_view)
+            self.buffer[self.capacity + pos:self.capacity + mirror_end] = data[:mirror_end - pos]
+
+    def write(self, data):
+        N = data.shape[0]
+        if N > self.capacity:
+            #   Only the most recent data will fit
+            skip = N - self.capacity
+            self.overrun_words += self.available() + skip
+            self.write_count += skip
+            self.read_count = self.write_count
+            data = data[skip:]
+            N = self.capacity
+        if N > self.space():
+            drop = N - self.space()
+            drop += (-drop) % self.align
+            self.overrun_words += drop
+            self.read_count += drop
+
+        pos = self.write_count % self.capacity
+        first = min(N, self.capacity - pos)
+        self.copy_in(pos, data[:first])
+        if first < N:
+            self.copy_in(0, data[first:])
+        self.write_count += N
+
+    def peek(self, num_words):
+        """ Returns up to num_words of the oldest data, without consuming it.
+            This is a view if num_words <= max_view, otherwise a copy.
+        """
+        N = min(num_words, self.available())
+        pos = self.read_count % self.capacity
+        if pos + N <= self.capacity + self.max_view:
+            return self.buffer[pos:pos + N]
+        first = self.capacity - pos
+        return numpy.concatenate((self.buffer[pos:self.capacity], self.buffer[:N - first]))
+
+    def consume(self, num_words):
+        self.read_count += min(num_words, self.available())
+
+    def read(self, num_words):
+        #   Returns a copy of (and consumes) up to num_words of the oldest data
+        data = self.peek(num_words).copy()
+        self.consume(data.shape[0])
+        return data
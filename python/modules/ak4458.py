@@ -12,24 +12,56 @@
 """
 
 from modules.base import ModuleBase
+from modules.regmap import RegisterMap
 
 class AK4458Module(ModuleBase):
 
-    #   TODO:
+    #   Main fields only; see the AK4458 datasheet for the rest
     REG_CONFIG = {
-
+        #   RSTN: write 0 to reset, normal is 1
+        'RSTN': (0, 0, 1),
+        #   DIF: Data interface mode.  Write 3 for 24-bit I2S.
+        'DIF': (0, 1, 3),
+        #   ACKS: Master clock frequency auto setting mode.  0 for manual, 1 for auto
+        'ACKS': (0, 7, 1),
+        #   SMUTE: Soft mute.  0 for normal, 1 for mute.
+        'SMUTE': (1, 0, 1),
+        #   DEM1: De-emphasis for DAC1.  01 for off.
+        'DEM1': (1, 1, 2),
+        #   DFS: Sampling speed control.  00 for 44/48k, 01 for 88/96k, 10 for 176/192k.
+        'DFS': (1, 3, 2),
+        #   SD: Short delay filter enable
+        'SD': (1, 5, 1),
+        #   DCKB: DCLK polarity for DSD (0 for falling edge, 1 for rising)
+        'DCKB': (2, 4, 1),
+        #   DCKS: Master clock select for DSD (0 for 512fs, 1 for 768fs)
+        'DCKS': (2, 5, 1),
+        #   DP: DSD/PCM mode select (0 for PCM, 1 for DSD)
+        'DP': (2, 7, 1),
+        #   ATT: Attenuation for each output (FF for max vol, 00 for mute, 0.5 dB steps)
+        'ATT1L': (0x03, 0, 8),
+        'ATT1R': (0x04, 0, 8),
+        'ATT2L': (0x0F, 0, 8),
+        'ATT2R': (0x10, 0, 8),
+        'ATT3L': (0x11, 0, 8),
+        'ATT3R': (0x12, 0, 8),
+        'ATT4L': (0x13, 0, 8),
+        'ATT4R': (0x14, 0, 8),
     }
+    REG_MAP = RegisterMap(REG_CONFIG, registers=range(0, 0x15))
+
+    def is_soft_reset(self, addr, data):
+        #   RSTN (register 0, bit 0) = 0
+        return (addr & 0x1F) == 0 and (data & 0x01) == 0
+
+    def reg_index(self, addr):
+        #   The chip address bits (0x20) are ignored
+        return addr & 0x1F
+
+    def registers_selected(self, slot):
+        #   HWCON = 0xFF selects the attenuator instead of the DAC
+        return self.backend.slot_hwcon[slot] == 0
 
-    def set_reg(self, reg_name, new_val, slot=0):
-        (reg_index, start_bit, num_bits) = AK4458Module.REG_CONFIG[reg_name]
-        bit_mask = 0
-        for i in range(num_bits):
-            bit_mask |= (1 << (start_bit + i))
-        current_val = self.spi_read(slot, 0, 0, reg_index)
-        new_val = (current_val & (~bit_mask)) | (new_val << start_bit)
-        print 'Updating register 0x%02x from 0x%02x to 0x%02x' % (reg_index, current_val, new_val)
-        self.spi_write(slot, 0, 0, reg_index, new_val)
-    
     def num_channels(self):
         return 8
 
@@ -52,14 +84,15 @@ class AK4458Module(ModuleBase):
         #   HWCON = 0 for DAC
         #   HWCON = 0xFF for atten.
         
-        #   Configure DAC
-        self.set_hwcon(slot, 0)
+        with self.batch():
+            #   Configure DAC
+            self.set_hwcon(slot, 0)
         
-        #   Set DIF for 24-bit I2S
-        self.spi_write(slot, 0, 0, 0x20, 0x87)
-        print 'Set up for AK4458: Wrote 0x87 to register 0'
+            #   Set DIF for 24-bit I2S
+            self.spi_write(slot, 0, 0, 0x20, 0x87)
         
-        #   Configure attenuator - all off
-        self.set_attenuation(slot, 0)
+            #   Configure attenuator - all off
+            self.set_attenuation(slot, 0)
+        print 'Set up for AK4458: Wrote 0x87 to register 0'
 
 
@@ -12,6 +12,7 @@
 """
 
 from modules.base import ModuleBase
+from modules.regmap import RegisterMap
 
 class AK4490Module(ModuleBase):
 
@@ -29,16 +30,16 @@ class AK4490Module(ModuleBase):
         #   SMUTE: Soft mute.  0 for normal, 1 for mute.
         'SMUTE': (1, 0, 1),
         #   DEM: De-emphasis.  01 for off.
-        'DEM': (0, 1, 2),
+        'DEM': (1, 1, 2),
         #   DFS: Sampling speed control (Table 9, page 55).  000 for 44/48k, 001 for 88/96.
-        'DFS': (0, 3, 2),
+        'DFS': (1, 3, 2),
         'DFS2': (5, 1, 1),
         #   SD: Short delay filter enable (Table 14, page 55).  Default is short delay
-        'SD': (0, 5, 1),
+        'SD': (1, 5, 1),
         #   DZFM: Data zero detect mode.  0 for channel separated, 1 for joint L/R zero-detect.
-        'DZFM': (0, 6, 1),
+        'DZFM': (1, 6, 1),
         #   DZDE: Data zero detect enable (write 1 to enable)
-        'DZFE': (0, 7, 1),
+        'DZFE': (1, 7, 1),
         #   SLOW: Slow rolloff filter enable (Table 14, page 56).  Default is slow rolloff.
         'SLOW': (2, 0, 1),
         #   SELLR: L/R select for mono mode (0 for right, 1 for left)
@@ -82,34 +83,19 @@ class AK4490Module(ModuleBase):
         #   DSDF: DSD filter control (table 18, page 59).
         'DSDF': (9, 1, 1),
     }
+    REG_MAP = RegisterMap(REG_CONFIG, registers=range(0, 10))
 
     def spi_summary(self, slot=0):
         print 'SPI summary for AK4490'
-        reg_base = 0
-        vals = [self.spi_read(slot, 0, 0, x) for x in range(0, 10)]
-        result_dict = {}
-        keys = AK4490Module.REG_CONFIG.keys()
-        keys.sort()
-        for key in keys:
-            (reg_index, start_bit, num_bits) = AK4490Module.REG_CONFIG[key]
-            bit_mask = 0
-            for i in range(num_bits):
-                bit_mask |= (1 << (start_bit + i))
-            val = (vals[reg_index - reg_base] & bit_mask) >> start_bit
-            result_dict[key] = val
-            print '%6s = %3d' % (key, val)
-
-        return result_dict
+        return self.print_registers(slot)
     
-    def set_reg(self, reg_name, new_val, slot=0):
-        (reg_index, start_bit, num_bits) = AK4490Module.REG_CONFIG[reg_name]
-        bit_mask = 0
-        for i in range(num_bits):
-            bit_mask |= (1 << (start_bit + i))
-        current_val = self.spi_read(slot, 0, 0, reg_index)
-        new_val = (current_val & (~bit_mask)) | (new_val << start_bit)
-        print 'Updating register 0x%02x from 0x%02x to 0x%02x' % (reg_index, current_val, new_val)
-        self.spi_write(slot, 0, 0, reg_index, new_val)
+    def is_soft_reset(self, addr, data):
+        #   RSTN (register 0, bit 0) = 0
+        return (addr & 0x1F) == 0 and (data & 0x01) == 0
+
+    def reg_index(self, addr):
+        #   The chip address bits (0x20) are ignored
+        return addr & 0x1F
 
     def set_attenuation(self, slot, atten_db):
         if atten_db == 0:
@@ -130,12 +116,13 @@ class AK4490Module(ModuleBase):
         #self.set_reg('DIF', 3, slot=slot)
         
         #self.reset_slots()
-        #   Disable attenuator
-        self.set_attenuation(slot, 0)
-        
-        #   Set DIF for 24-bit I2S (first reset to handle any sample rate update)
-        self.spi_write(slot, 0, 0, 0x20, 0x86)
-        self.spi_write(slot, 0, 0, 0x20, 0x87)
+        with self.batch():
+            #   Disable attenuator
+            self.set_attenuation(slot, 0)
+            
+            #   Set DIF for 24-bit I2S (first reset to handle any sample rate update)
+            self.spi_write(slot, 0, 0, 0x20, 0x86)
+            self.spi_write(slot, 0, 0, 0x20, 0x87)
         print 'Set up for AK4490: Reset and wrote 0x87 to register 0; attenuation at 0 dB'
         
         #   Set traditional sharp rolloff filter (SD = 0)
@@ -14,6 +14,7 @@
 import time
 
 from modules.base import ModuleBase
+from modules.regmap import RegisterMap
 
 class AK5572Module(ModuleBase):
 
@@ -47,35 +48,20 @@ class AK5572Module(ModuleBase):
         #   DCKS: DSD clock frequency select (0 = 512fs, 1 = 768fs)
         'DCKS': (5, 5, 1),
     }
+    REG_MAP = RegisterMap(REG_CONFIG, registers=range(0, 8))
 
     def spi_summary(self, slot=0):
         print 'SPI summary for AK5572'
-        reg_base = 0
-        vals = [self.spi_read(slot, 0, 0, x) for x in range(0, 8)]
-        result_dict = {}
-        keys = AK5572Module.REG_CONFIG.keys()
-        keys.sort()
-        for key in keys:
-            (reg_index, start_bit, num_bits) = AK5572Module.REG_CONFIG[key]
-            bit_mask = 0
-            for i in range(num_bits):
-                bit_mask |= (1 << (start_bit + i))
-            val = (vals[reg_index - reg_base] & bit_mask) >> start_bit
-            result_dict[key] = val
-            print '%6s = %3d' % (key, val)
-
-        return result_dict
-    
-    def set_reg(self, reg_name, new_val, slot=0):
-        (reg_index, start_bit, num_bits) = AK5572Module.REG_CONFIG[reg_name]
-        bit_mask = 0
-        for i in range(num_bits):
-            bit_mask |= (1 << (start_bit + i))
-        current_val = self.spi_read(slot, 0, 0, reg_index)
-        new_val = (current_val & (~bit_mask)) | (new_val << start_bit)
-        print 'Updating register 0x%02x from 0x%02x to 0x%02x' % (reg_index, current_val, new_val)
-        self.spi_write(slot, 0, 0, reg_index, new_val)
+        return self.print_registers(slot)
     
+    def is_soft_reset(self, addr, data):
+        #   RSTN (register 1, bit 0) = 0
+        return (addr & 0x1F) == 1 and (data & 0x01) == 0
+
+    def reg_index(self, addr):
+        #   The chip address bits (0x20) are ignored
+        return addr & 0x1F
+
     def num_channels(self):
         return 2
 
@@ -89,15 +75,16 @@ class AK5572Module(ModuleBase):
         #self.reset_slots()
         #time.sleep(0.1)
         
-        #   Register 2 - Control 1
-        #   [0] HPFE = 1
-        #   [2:1] DIF = 01 (I2S)
-        #   [6:3] CKS = 0010 - 256Fs (11.2M MCLK, 44.1k Fs)
-        #   try 0011 for 128Fs (88.2k), 0110 for 512Fs (22.05k)
-        self.spi_write(slot, 0, 0, 0x22, 0x13)
+        with self.batch():
+            #   Register 2 - Control 1
+            #   [0] HPFE = 1
+            #   [2:1] DIF = 01 (I2S)
+            #   [6:3] CKS = 0010 - 256Fs (11.2M MCLK, 44.1k Fs)
+            #   try 0011 for 128Fs (88.2k), 0110 for 512Fs (22.05k)
+            self.spi_write(slot, 0, 0, 0x22, 0x13)
         
-        #   Have to do a soft reset for changes to clock and format to take effect.
-        self.spi_write(slot, 0, 0, 0x21, 0x00)
+            #   Have to do a soft reset for changes to clock and format to take effect.
+            self.spi_write(slot, 0, 0, 0x21, 0x00)
         time.sleep(0.1)
         self.spi_write(slot, 0, 0, 0x21, 0x01)
 
@@ -14,33 +14,61 @@
 import time
 
 from modules.base import ModuleBase
+from modules.regmap import RegisterMap
 
 class AK5578Module(ModuleBase):
 
-    #   TODO
+    #   Same layout as the AK5572, with power down control for 8 channels
     REG_CONFIG = {
-        
+        #   PW: Power down control (1 = on, 0 = off), one bit per channel
+        'PW': (0, 0, 8),
+        #   RSTN: Write 0 to reset
+        'RSTN': (1, 0, 1),
+        #   MONO: Summing
+        'MONO': (1, 1, 2),
+        #   HPFE: Highpass filter enable
+        'HPFE': (2, 0, 1),
+        #   DIF: Digital interface mode
+        'DIF': (2, 1, 2),
+        #   CKS: Sampling speed and MCLK frequency select
+        'CKS': (2, 3, 4),
+        #   TDM: Time division modes
+        'TDM': (3, 5, 2),
+        #   SLOW: Slow rolloff filter (off by default)
+        'SLOW': (4, 0, 1),
+        #   SD: Short delay filter (off by default)
+        'SD': (4, 1, 1),
+        #   DP: DSD mode = 1, PCM = 0
+        'DP': (4, 7, 1),
+        #   DSDSEL: DCLK frequency select for DSD
+        'DSDSEL': (5, 0, 2),
+        #   DCKB: DCLK polarity for DSD (0 = falling, 1 = rising)
+        'DCKB': (5, 2, 1),
+        #   PMOD: DSD phase modulation mode
+        'PMOD': (5, 3, 1),
+        #   DCKS: DSD clock frequency select (0 = 512fs, 1 = 768fs)
+        'DCKS': (5, 5, 1),
     }
+    REG_MAP = RegisterMap(REG_CONFIG, registers=range(0, 6))
     
-    def set_reg(self, reg_name, new_val, slot=0):
-        (reg_index, start_bit, num_bits) = AK5578Module.REG_CONFIG[reg_name]
-        bit_mask = 0
-        for i in range(num_bits):
-            bit_mask |= (1 << (start_bit + i))
-        current_val = self.spi_read(slot, 0, 0, reg_index)
-        new_val = (current_val & (~bit_mask)) | (new_val << start_bit)
-        print 'Updating register 0x%02x from 0x%02x to 0x%02x' % (reg_index, current_val, new_val)
-        self.spi_write(slot, 0, 0, reg_index, new_val)
-    
+    def is_soft_reset(self, addr, data):
+        #   RSTN (register 1, bit 0) = 0
+        return (addr & 0x1F) == 1 and (data & 0x01) == 0
+
+    def reg_index(self, addr):
+        #   The chip address bits (0x20) are ignored
+        return addr & 0x1F
+
     def num_channels(self):
         return 8
 
     def setup(self, slot):
 
-        self.spi_write(slot, 0, 0, 0x22, 0x13)
+        with self.batch():
+            self.spi_write(slot, 0, 0, 0x22, 0x13)
         
-        #   Have to do a soft reset for changes to clock and format to take effect.
-        self.spi_write(slot, 0, 0, 0x21, 0x00)
+            #   Have to do a soft reset for changes to clock and format to take effect.
+            self.spi_write(slot, 0, 0, 0x21, 0x00)
         time.sleep(0.1)
         self.spi_write(slot, 0, 0, 0x21, 0x01)
 
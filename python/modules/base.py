@@ -18,26 +18,75 @@
 import numpy
 from datetime import datetime
 import time
+import contextlib
+import usb1
 
 from backends.da_platform import DAPlatformBackend
+from modules.regmap import RegisterMap
+from modules.packing import AudioPacker, frame_words
 from utils import get_elapsed_time
 
 class ModuleBase(object):
 
+    #   Register fields: {name: (register index, start bit, number of bits)}, and the
+    #   RegisterMap built from them (subclasses define both)
+    REG_CONFIG = {}
+    REG_MAP = RegisterMap(REG_CONFIG)
+    #   SPI address/data size used for the registers in REG_CONFIG
+    REG_ADDR_SIZE = 0
+    REG_DATA_SIZE = 0
+
     def __init__(self, backend):
         self.backend = backend
+        self.packer = AudioPacker(backend.dtype)
         self.backend.flush()
         
     def transaction(self, cmd, num_words):
         self.backend.write(cmd)
         self.backend.update_receive_state()
         #   return self.backend.read(num_words)
+
+    def request_async(self, cmd, slot, report_id):
+        #   Send a command and return a future for the report it produces.  The lock
+        #   only covers sending, since responses are handed to waiting futures in order.
+        with self.backend.transaction_lock:
+            future = self.backend.expect_report(slot, report_id)
+            self.backend.write(cmd)
+        return future
+
+    def request(self, cmd, slot, report_id, timeout=1.0):
+        #   Send a command and return the report it produces.
+        return self.backend.wait_report(self.request_async(cmd, slot, report_id), timeout)
+
+    @contextlib.contextmanager
+    def batch(self, read_back=False, timeout=1.0):
+        """ Collect the commands sent in a with-block and send them in one transfer
+            at the end of the block (or not at all, if it raises an exception).
+            Reports can't arrive until then, so use e.g. spi_read_request() rather
+            than spi_read() inside the block.  With read_back, batch.results is then
+            the list of reports requested in the block:
+
+                with module.batch(read_back=True) as batch:
+                    module.spi_write(slot, 0, 0, 0x00, 0x87)
+                    module.spi_read_request(slot, 0, 0, 0x00)
+                print batch.results
+        """
+        batch = self.backend.begin_batch()
+        try:
+            yield batch
+        except:
+            self.backend.abort_batch()
+            raise
+        batch.results = self.backend.end_batch(read_back, timeout)
     
-    def prepare_cmd(self, destination, cmd, data):
-        data = data.flatten()
+    def prepare_cmd(self, destination, cmd, data, out=None):
+        data = data.ravel()
         N = data.shape[0]
         checksum = numpy.sum(data)
-        msg = numpy.zeros((N + 6,), dtype=self.backend.dtype)
+        if out is None:
+            msg = numpy.zeros((N + 6,), dtype=self.backend.dtype)
+        else:
+            msg = out[:N + 6]
         msg[0] = destination
         msg[1] = cmd
         msg[2] = N / 65536
@@ -48,8 +97,8 @@ class ModuleBase(object):
         return msg
         
     def get_dirchan(self):
-        self.transaction(numpy.array([0xFF, 0x41], dtype=self.backend.dtype), 3)
-        dval = self.backend.pop_report_global(DAPlatformBackend.DIRCHAN_REPORT)[0]
+        cmd = numpy.array([0xFF, DAPlatformBackend.DIRCHAN_READ], dtype=self.backend.dtype)
+        dval = self.request(cmd, DAPlatformBackend.GLOBAL_TARGET_INDEX, DAPlatformBackend.DIRCHAN_REPORT)[0]
         dir_vals = numpy.zeros((4,), dtype=bool)
         chan_vals = numpy.zeros((4,), dtype=bool)
         for slot in range(4):
@@ -66,8 +115,8 @@ class ModuleBase(object):
         raise NotImplementedError
 
     def get_aovf(self):
-        result = self.transaction(numpy.array([0xFF, 0x43], dtype=self.backend.dtype), 3)
-        dval = self.backend.pop_report_global(DAPlatformBackend.AOVF_REPORT)[0]
+        cmd = numpy.array([0xFF, DAPlatformBackend.AOVF_READ], dtype=self.backend.dtype)
+        dval = self.request(cmd, DAPlatformBackend.GLOBAL_TARGET_INDEX, DAPlatformBackend.AOVF_REPORT)[0]
         for slot in range(4):
             ovfl = 1 * ((dval & (1 << (slot * 2))) > 0)
             ovfr = 1 * ((dval & (1 << (slot * 2 + 1))) > 0)
@@ -87,9 +136,11 @@ class ModuleBase(object):
 
     def reset_slots(self):
         self.backend.write(numpy.array([0xFF, DAPlatformBackend.RESET_SLOTS], dtype=self.backend.dtype))
+        self.backend.invalidate_registers()
 
     def enter_reset(self):
         self.backend.write(numpy.array([0xFF, DAPlatformBackend.ENTER_RESET], dtype=self.backend.dtype))
+        self.backend.invalidate_registers()
         
     def leave_reset(self):
         self.backend.write(numpy.array([0xFF, DAPlatformBackend.LEAVE_RESET], dtype=self.backend.dtype))
@@ -100,8 +151,38 @@ class ModuleBase(object):
         cmd = self.prepare_cmd(slot, DAPlatformBackend.CMD_FIFO_WRITE, msg)
         self.backend.write(cmd)
         #print 'Wrote command for SPI write: %s' % cmd
+        with self.backend.register_lock:
+            shadow = self.register_shadow(slot)
+            if shadow is None:
+                pass
+            elif self.is_soft_reset(addr, data):
+                self.backend.invalidate_registers(slot)
+            else:
+                shadow[self.reg_index(addr)] = int(data)
 
-    def spi_read(self, slot, addr_size, data_size, addr, add_offset=True):
+    def is_soft_reset(self, addr, data):
+        #   Whether an SPI write resets the module's registers; overridden by subclasses
+        return False
+
+    def reg_index(self, addr):
+        #   Register index for an SPI address (which may include R/W or chip address bits);
+        #   overridden by subclasses
+        return addr
+
+    def registers_selected(self, slot):
+        #   Whether SPI transfers currently go to the chip whose registers are in
+        #   REG_MAP (see set_hwcon); overridden by subclasses
+        return True
+
+    def register_shadow(self, slot):
+        #   {register index: value} known for the slot, or None if SPI transfers
+        #   currently go to another chip.  Call with register_lock held.
+        if not self.registers_selected(slot):
+            return None
+        return self.backend.register_shadow[slot]
+
+    def spi_read_request(self, slot, addr_size, data_size, addr, add_offset=True):
+        #   Send an SPI read and return a future for its report (see spi_read).
         #   Previous version added 0x80 to address to force a read.  But not all peripherals need this.
         if add_offset:
             addr += 0x80
@@ -109,18 +190,128 @@ class ModuleBase(object):
         msg = numpy.array([DAPlatformBackend.SPI_READ_REG, config_word, addr / 256, addr % 256], dtype=self.backend.dtype)
         cmd = self.prepare_cmd(slot, DAPlatformBackend.CMD_FIFO_WRITE, msg)
         #print 'Wrote command for SPI read: %s' % cmd
-        self.transaction(cmd, 100)
-        
-        data = self.backend.receive_state_slots[slot][DAPlatformBackend.CMD_FIFO_REPORT][0]
+        return self.request_async(cmd, slot, DAPlatformBackend.CMD_FIFO_REPORT)
+
+    def spi_report_value(self, data, data_size):
+        #   Register value from an SPI_REPORT: [SPI_REPORT, addr_hi, addr_lo, data_hi, data_lo]
+        if data_size:
+            return (data[3] << 8) | data[4]
+        return data[4]
+
+    def spi_read(self, slot, addr_size, data_size, addr, add_offset=True):
+        data = self.backend.wait_report(self.spi_read_request(slot, addr_size, data_size, addr, add_offset))
         #print data
         assert data[0] == DAPlatformBackend.SPI_REPORT
         #assert data[2] == addr + 0x80
-        result = data[4]
-        self.backend.receive_state_slots[slot][DAPlatformBackend.CMD_FIFO_REPORT].pop(0)
+        result = self.spi_report_value(data, data_size)
+        with self.backend.register_lock:
+            shadow = self.register_shadow(slot)
+            if shadow is not None:
+                shadow[self.reg_index(addr)] = int(result)
         
         #print 'Got response for SPI read: %s' % data
         return result
 
+    def spi_read_bulk(self, slot, addr_size, data_size, addrs, add_offset=True, timeout=1.0):
+        """ Read several registers with one transfer of SPI reads, returning their
+            values in the same order as addrs.  Responses are matched to the reads
+            by address; any that are missing are read again individually.
+        """
+        offset = 0x80 if add_offset else 0
+        with self.batch():
+            futures = [self.spi_read_request(slot, addr_size, data_size, addr, add_offset) for addr in addrs]
+        values = {}
+        deadline = time.time() + timeout
+        for future in futures:
+            try:
+                data = self.backend.wait_report(future, max(deadline - time.time(), 0.001))
+            except usb1.USBErrorTimeout:
+                #   Stop waiting for this and the remaining responses
+                for other in futures:
+                    if not other.done():
+                        self.backend.cancel_report(other, slot, DAPlatformBackend.CMD_FIFO_REPORT)
+                break
+            if data[0] == DAPlatformBackend.SPI_REPORT:
+                values[((data[1] << 8) | data[2]) - offset] = self.spi_report_value(data, data_size)
+        result = []
+        for addr in addrs:
+            if addr in values:
+                with self.backend.register_lock:
+                    shadow = self.register_shadow(slot)
+                    if shadow is not None:
+                        shadow[self.reg_index(addr)] = int(values[addr])
+                result.append(values[addr])
+            else:
+                result.append(self.spi_read(slot, addr_size, data_size, addr, add_offset))
+        return result
+
+    def read_reg(self, slot, reg_index):
+        #   Register value from the shadow if known, otherwise read from the module
+        with self.backend.register_lock:
+            value = None
+            shadow = self.register_shadow(slot)
+            if shadow is not None:
+                value = shadow.get(self.reg_index(reg_index))
+            if value is None:
+                value = self.spi_read(slot, self.REG_ADDR_SIZE, self.REG_DATA_SIZE, reg_index)
+        return value
+
+    def known_regs(self, slot, reg_indices):
+        #   {register index: value} for those of reg_indices in the shadow.  Call with register_lock held.
+        shadow = self.register_shadow(slot) or {}
+        return dict([(reg_index, shadow[self.reg_index(reg_index)]) for reg_index in reg_indices if self.reg_index(reg_index) in shadow])
+
+    def read_regs(self, slot, reg_indices):
+        #   {register index: value} from the shadow, reading the unknown ones in bulk
+        with self.backend.register_lock:
+            result = self.known_regs(slot, reg_indices)
+        missing = [reg_index for reg_index in reg_indices if reg_index not in result]
+        if len(missing) > 0:
+            #   (Not holding register_lock during the USB round trip)
+            result.update(zip(missing, self.spi_read_bulk(slot, self.REG_ADDR_SIZE, self.REG_DATA_SIZE, missing)))
+        return result
+
+    def print_registers(self, slot=0):
+        #   Read all of the registers in REG_MAP, print their fields and return them as a dict
+        vals = self.spi_read_bulk(slot, self.REG_ADDR_SIZE, self.REG_DATA_SIZE, self.REG_MAP.registers)
+        regs = dict(zip(self.REG_MAP.registers, vals))
+        for line in self.REG_MAP.format(regs):
+            print line
+        return self.REG_MAP.decode(regs)
+
+    def apply_config(self, values, slot=0):
+        """ Bring the register fields in values ({name: value}) to the given values,
+            writing only the registers that change, in one batch.  Returns the
+            list of (register index, value) written.
+        """
+        reg_indices = self.REG_MAP.registers_for(values.keys())
+        regs = self.read_regs(slot, reg_indices)
+        with self.backend.register_lock:
+            #   Registers written by another thread since they were read
+            regs.update(self.known_regs(slot, reg_indices))
+            writes = self.REG_MAP.diff(regs, values)
+            with self.batch():
+                for (reg_index, new_val) in writes:
+                    self.spi_write(slot, self.REG_ADDR_SIZE, self.REG_DATA_SIZE, reg_index, new_val)
+        return writes
+
+    def set_regs(self, values, slot=0):
+        """ Set register fields (see REG_CONFIG) from a dict {name: value}.  Fields in
+            the same register are merged into one SPI write, and registers whose
+            values are already known aren't read back first.
+        """
+        updates = self.REG_MAP.updates(values)
+        with self.backend.register_lock:
+            for reg_index in sorted(updates.keys()):
+                (clear_mask, set_bits) = updates[reg_index]
+                current_val = self.read_reg(slot, reg_index)
+                new_val = (current_val & ~clear_mask) | set_bits
+                print 'Updating register 0x%02x from 0x%02x to 0x%02x' % (reg_index, current_val, new_val)
+                self.spi_write(slot, self.REG_ADDR_SIZE, self.REG_DATA_SIZE, reg_index, new_val)
+
+    def set_reg(self, reg_name, new_val, slot=0):
+        self.set_regs({reg_name: new_val}, slot)
+
     def single_byte_msg(self, slot, cmd):
         msg = numpy.array([cmd, 0], dtype=self.backend.dtype)
         self.backend.write(self.prepare_cmd(slot, DAPlatformBackend.CMD_FIFO_WRITE, msg))
@@ -147,13 +338,7 @@ class ModuleBase(object):
 
         #   Wait for all samples to be played at the current sample rate.
         #   Doesn't do anything about recording--this is a possible future issue.
-        fifo_flushed = False
-        while not fifo_flushed:
-            status = self.fifo_status()[slot]
-            if status[0] != status[1]:
-                time.sleep(0.05)
-            else:
-                fifo_flushed = True
+        self.backend.fifo_status.wait_drained(slot)
 
         #   Select between 22.5792 MHz vs. 24.576 MHz master clock,
         #   then set the clock divide ratio.
@@ -187,63 +372,80 @@ class ModuleBase(object):
         elif fmt == DAPlatformBackend.MSB_JUSTIFIED: self.single_byte_msg(slot, DAPlatformBackend.SLOT_FMT_LJ)
         elif fmt == DAPlatformBackend.LSB_JUSTIFIED: self.single_byte_msg(slot, DAPlatformBackend.SLOT_FMT_RJ)
         
+    def set_blocking(self, enable_mask):
+        #   Bit i of enable_mask lets slot i's DRAM FIFO run; slots whose bits are clear are blocked
+        self.backend.write(numpy.array([0xFF, DAPlatformBackend.UPDATE_BLOCKING, enable_mask], dtype=self.backend.dtype))
+        self.backend.enable_mask = enable_mask
+
     def block_slots(self):
-        self.backend.write(numpy.array([0xFF, 0x4A, 0x00], dtype=self.backend.dtype))
+        self.set_blocking(0x00)
+
+    def set_slots_blocked(self, slot_mask, blocked):
+        #   Block or unblock the slots in slot_mask, leaving the others as they are
+        if blocked:
+            self.set_blocking(self.backend.enable_mask & ~slot_mask)
+        else:
+            self.set_blocking(self.backend.enable_mask | slot_mask)
     
     def unblock_slots(self):
-        self.backend.write(numpy.array([0xFF, 0x4A, 0x0F], dtype=self.backend.dtype))
+        self.set_blocking(0x0F)
     
     def set_hwcon(self, slot, val):
         msg = numpy.array([DAPlatformBackend.SLOT_SET_ACON, val], dtype=self.backend.dtype)
         self.backend.write(self.prepare_cmd(slot, DAPlatformBackend.CMD_FIFO_WRITE, msg))
+        with self.backend.register_lock:
+            self.backend.slot_hwcon[slot] = int(val)
+
+    #   (Called ACON on some modules)
+    set_acon = set_hwcon
     
-    def fifo_status(self, display=False):
-        self.backend.write(numpy.array([0xFF, 0x48, 0x00], dtype=self.backend.dtype))
-        data = self.backend.read(38)
-        status = data[4:36].byteswap().view(numpy.uint32).byteswap().reshape((8, 2))
+    def fifo_status(self, display=False, max_age=None):
+        #   Status of the DRAM FIFO ports: status[port] = (samples written, samples read).
+        #   Uses the backend's cached status if it is no older than max_age seconds.
+        status = self.backend.fifo_status.status(max_age)
         if display:
-            print 'DRAM FIFO status:'
-            for i in range(8):
-                if status[i, 0] != 0 or status[i, 1] != 0:
-                    print '  Port %d: Wrote %d samples, read %d samples' % (i, status[i, 0], status[i, 1])
-        
-        return status
+            status.display()
+        return status.counts
     
     def audio_write_float(self, slot, data):
-        data_int = (data * (1 << 24)).astype(numpy.int32)
-        self.audio_write(slot, data_int)
-        return data_int
+        #   Float samples are scaled by 2^24 (see AudioPacker.pack_float)
+        cmd = self.packer.pack_float(slot, data, self.backend.acquire_buffer(frame_words(data.size)))
+        self.backend.write_owned(cmd)
     
+    def pack_audio(self, slot, data, out=None):
+        #   Build an AUD_FIFO_WRITE command for int32 samples, in out if supplied.
+        return self.packer.pack(slot, data, out)
+
     def audio_write(self, slot, data):
-        #   2 byteswaps accomplishes a word-swap while preserving byte order within words
         #   print [hex(x) for x in data[:8]]
         start_time = datetime.now()
-        msg = numpy.fromstring(data.byteswap().tostring(), dtype=self.backend.dtype).byteswap()
-        self.backend.write(self.prepare_cmd(slot, DAPlatformBackend.AUD_FIFO_WRITE, msg))
+        cmd = self.pack_audio(slot, data, self.backend.acquire_buffer(frame_words(data.size)))
+        #   If the write queue is enabled, this returns as soon as the transfer is
+        #   queued (blocking only if the queue is full).
+        self.backend.write_owned(cmd)
         #   print 'Wrote %d samples in %.2f ms' % (data.shape[0], get_elapsed_time(start_time) * 1e3)
     
+    def audio_write_multi(self, items):
+        """ Write audio for several slots in one transfer.  items is a list of
+            (slot, samples), with int32 or float samples (as for audio_write or
+            audio_write_float).
+        """
+        num_words = sum([frame_words(data.size) for (slot, data) in items])
+        cmd = self.packer.pack_slots(items, self.backend.acquire_buffer(num_words))
+        self.backend.write_owned(cmd)
+
     def get_available_audio(self, slot, num_samples):
-        if self.backend.receive_state_available(slot, DAPlatformBackend.AUD_FIFO_REPORT):
-            all_data = numpy.concatenate(self.backend.receive_state_slots[slot][DAPlatformBackend.AUD_FIFO_REPORT])
-            data = all_data[:num_samples * 2]
-            other_data = all_data[num_samples * 2:]
-            #   Save leftover samples back into receive state
-            self.backend.receive_state_slots[slot][DAPlatformBackend.AUD_FIFO_REPORT] = [other_data,]
-            
-            #   Convert to integer
-            #data = numpy.fromstring(data.byteswap().tostring(), dtype=numpy.int32).byteswap()
-            data = numpy.fromstring(data.tostring(), dtype=numpy.int32)
-        else:
-            data = numpy.array([], dtype=numpy.int32)
-            
-        return data
+        return self.backend.pop_audio(slot, num_samples)
+
+    def audio_words_received(self, slot):
+        return self.backend.audio_words_available(slot)
         
     def audio_read(self, slot, num_samples, perform_update=True, timeout=100):
         #   Timeout is in ms
         #   TODO: Make much smarter
         
         start_time = datetime.now()
-        words_received = numpy.sum([x.shape[0] for x in self.backend.receive_state_slots[slot][DAPlatformBackend.AUD_FIFO_REPORT]])
+        words_received = self.audio_words_received(slot)
         samples_received = int(words_received / 2)
         #   print 'Samples previously received = %d' % samples_received
         
@@ -259,7 +461,7 @@ class ModuleBase(object):
                 num_words = samples_needed * 2 + 6
                 self.backend.update_receive_state(request_size=num_words, timeout=timeout)
                 time_float = get_elapsed_time(start_time)
-                words_received = numpy.sum([x.shape[0] for x in self.backend.receive_state_slots[slot][DAPlatformBackend.AUD_FIFO_REPORT]])
+                words_received = self.audio_words_received(slot)
                 samples_received = int(words_received / 2)
                 #   print 'Got to %d samples from %d words in %.2f ms' % (samples_received, num_words, (time_float * 1e3))
         
@@ -267,20 +469,22 @@ class ModuleBase(object):
 
     def audio_read_write(self, slot_dac, slot_adc, samples, num_read_samples, timeout=100):
         #   11/17/2017: Try using async libusb.  Bypass receive state... (dangerous, one slot only)
-        data_out = numpy.fromstring(samples.byteswap().tostring(), dtype=self.backend.dtype).byteswap()
-        msg_out_1 = self.prepare_cmd(slot_dac, DAPlatformBackend.AUD_FIFO_WRITE, data_out)
+        #   Room for the read command after the audio, so both go out in one buffer
+        num_write_words = frame_words(samples.size)
+        msg_out = numpy.empty((num_write_words + 4,), dtype=self.backend.dtype)
+        msg_out_1 = self.pack_audio(slot_dac, samples, msg_out)
         
         if num_read_samples > 0:
             #   No checksum on audio read cmd?
-            msg_out_2 = numpy.array([slot_adc, DAPlatformBackend.AUD_FIFO_READ, num_read_samples / 65536, num_read_samples % 65536], dtype=numpy.uint16)
+            msg_out[num_write_words:] = [slot_adc, DAPlatformBackend.AUD_FIFO_READ, num_read_samples / 65536, num_read_samples % 65536]
             #cmd_args_out = numpy.array([samples.size / 65536, samples.size % 65536], dtype=numpy.uint16)
             #msg_out_2 = self.prepare_cmd(slot_adc, DAPlatformBackend.AUD_FIFO_READ, cmd_args_out)
-            msg_out = numpy.concatenate((msg_out_1, msg_out_2))
             
             use_async = True    #   Can also put in sync blocking mode with same data
             if use_async:
-                data_received = self.backend.read_and_write(msg_out, num_read_samples * 2 + 6)
-                self.backend.parse_report(data_received)
+                with self.backend.receive_lock:
+                    data_received = self.backend.read_and_write(msg_out, num_read_samples * 2 + 6)
+                    self.backend.parse_report(data_received)
             else:
                 self.backend.write(msg_out)
                 self.backend.update_receive_state(request_size=num_read_samples * 2 + 6, timeout=timeout)
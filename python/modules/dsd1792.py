@@ -12,6 +12,7 @@
 """
 
 from modules.base import ModuleBase
+from modules.regmap import RegisterMap
 
 class DSD1792Module(ModuleBase):
 
@@ -42,35 +43,20 @@ class DSD1792Module(ModuleBase):
         'ZFGR': (22, 1, 1),
         'ID': (23, 0, 5),
     }
+    REG_MAP = RegisterMap(REG_CONFIG, registers=range(16, 24))
 
     def spi_summary(self, slot=0):
         print 'SPI summary for DSD1792'
-        reg_base = 16
-        vals = [self.spi_read(slot, 0, 0, x) for x in range(16, 24)]
-        result_dict = {}
-        keys = DSD1792Module.REG_CONFIG.keys()
-        keys.sort()
-        for key in keys:
-            (reg_index, start_bit, num_bits) = DSD1792Module.REG_CONFIG[key]
-            bit_mask = 0
-            for i in range(num_bits):
-                bit_mask |= (1 << (start_bit + i))
-            val = (vals[reg_index - reg_base] & bit_mask) >> start_bit
-            result_dict[key] = val
-            print '%6s = %3d' % (key, val)
-
-        return result_dict
-    
-    def set_reg(self, reg_name, new_val, slot=0):
-        (reg_index, start_bit, num_bits) = DSD1792Module.REG_CONFIG[reg_name]
-        bit_mask = 0
-        for i in range(num_bits):
-            bit_mask |= (1 << (start_bit + i))
-        current_val = self.spi_read(slot, 0, 0, reg_index)
-        new_val = (current_val & (~bit_mask)) | (new_val << start_bit)
-        print 'Updating register 0x%02x from 0x%02x to 0x%02x' % (reg_index, current_val, new_val)
-        self.spi_write(slot, 0, 0, reg_index, new_val)
+        return self.print_registers(slot)
     
+    def is_soft_reset(self, addr, data):
+        #   SRST (register 20, bit 6) = 1
+        return (addr & 0x7F) == 20 and (data & 0x40) != 0
+
+    def reg_index(self, addr):
+        #   The read bit (0x80) is ignored
+        return addr & 0x7F
+
     def num_channels(self):
         return 2
 
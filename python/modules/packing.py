@@ -0,0 +1,118 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    packing.py: Packs audio samples into AUD_FIFO_WRITE commands.  Samples are
+    24-bit values in 32-bit words; each goes out as two 16-bit words, most
+    significant first.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import sys
+import threading
+
+import numpy
+
+from backends.da_platform import DAPlatformBackend
+
+#   Position of the most/least significant 16-bit word of an int32 sample in host memory
+if sys.byteorder == 'little':
+    (SAMPLE_MSW, SAMPLE_LSW) = (1, 0)
+else:
+    (SAMPLE_MSW, SAMPLE_LSW) = (0, 1)
+
+#   Full scale for float samples, as used by ModuleBase.audio_write_float
+FLOAT_SCALE = (1 << 24)
+
+#   Words in an AUD_FIFO_WRITE command besides the samples (header and checksum)
+FRAME_OVERHEAD = 6
+
+
+def frame_words(num_samples):
+    #   Length of the AUD_FIFO_WRITE command for num_samples samples
+    return num_samples * 2 + FRAME_OVERHEAD
+
+
+class AudioPacker(object):
+    """ Builds AUD_FIFO_WRITE commands directly in an output buffer (e.g. one
+        from DAPlatformBackend.acquire_buffer()): the header, the word-swapped
+        samples and the checksum are written in place, with no intermediate
+        arrays.  Float samples are scaled and converted on the way into a scratch
+        buffer which is reused from one call to the next.
+    """
+
+    def __init__(self, dtype=numpy.uint16):
+        self.dtype = dtype
+        self.scratch = numpy.empty((0,), dtype=numpy.int32)
+        self.scratch_lock = threading.Lock()
+
+    def pack_into(self, out, slot, samples):
+        #   samples: contiguous 1-D int32 array.  Fills in out[:frame_words(N)].
+        N = samples.shape[0] * 2
+        words = samples.view(self.dtype).reshape((-1, 2))
+        payload = out[4:4 + N].reshape((-1, 2))
+        payload[:, 0] = words[:, SAMPLE_MSW]
+        payload[:, 1] = words[:, SAMPLE_LSW]
+        #   The checksum is the 32-bit sum of the sample words (accumulating in 32 bits
+        #   wraps around just like the FPGA does)
+        checksum = int(numpy.add.reduce(words.ravel(), dtype=numpy.uint32))
+        out[0] = slot
+        out[1] = DAPlatformBackend.AUD_FIFO_WRITE
+        out[2] = N / 65536
+        out[3] = N % 65536
+        out[4 + N] = checksum / 65536
+        out[5 + N] = checksum % 65536
+        return out[:N + FRAME_OVERHEAD]
+
+    def output(self, num_samples, out):
+        if out is None:
+            out = numpy.empty((frame_words(num_samples),), dtype=self.dtype)
+        assert out.shape[0] >= frame_words(num_samples)
+        return out
+
+    def pack(self, slot, data, out=None):
+        """ Returns the AUD_FIFO_WRITE command for int32 samples, built in out if
+            supplied (it may be longer than needed).
+        """
+        samples = numpy.ascontiguousarray(data, dtype=numpy.int32).ravel()
+        return self.pack_into(self.output(samples.shape[0], out), slot, samples)
+
+    def pack_float(self, slot, data, out=None, scale=FLOAT_SCALE):
+        """ Same as pack(), for float samples which are multiplied by scale and
+            truncated to integers, as in ModuleBase.audio_write_float.
+        """
+        data = numpy.asarray(data)
+        N = data.size
+        out = self.output(N, out)
+        with self.scratch_lock:
+            if self.scratch.shape[0] < N:
+                self.scratch = numpy.empty((N,), dtype=numpy.int32)
+            samples = self.scratch[:N]
+            #   Scale and convert in one pass
+            numpy.multiply(data.reshape((N,)), scale, out=samples, casting='unsafe')
+            return self.pack_into(out, slot, samples)
+
+    def pack_slots(self, items, out=None):
+        """ Packs audio for several slots into consecutive commands in one buffer,
+            so they can be sent in a single transfer.  items is a list of
+            (slot, samples); float samples are converted as in pack_float().
+        """
+        total = sum([frame_words(numpy.asarray(data).size) for (slot, data) in items])
+        if out is None:
+            out = numpy.empty((total,), dtype=self.dtype)
+        assert out.shape[0] >= total
+        pos = 0
+        for (slot, data) in items:
+            data = numpy.asarray(data)
+            length = frame_words(data.size)
+            if data.dtype.kind == 'f':
+                self.pack_float(slot, data, out[pos:pos + length])
+            else:
+                self.pack(slot, data, out[pos:pos + length])
+            pos += length
+        return out[:total]
@@ -0,0 +1,101 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    regmap.py: Register maps for module drivers.  Translates between register
+    values and the fields defined in a module's REG_CONFIG, and works out
+    which register writes are needed to reach a given configuration.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+
+class RegisterMap(object):
+    """ Fields are given as {name: (register index, start bit, number of bits)},
+        as in REG_CONFIG.  Register values are passed around as dicts
+        {register index: value}.  registers is the list of registers making up
+        the register file (by default, the ones that have fields).
+    """
+
+    def __init__(self, fields, registers=None):
+        #   Precomputed (register, shift, mask in place, mask after shifting) for each field
+        self.fields = {}
+        for (name, (reg_index, start_bit, num_bits)) in fields.items():
+            width_mask = (1 << num_bits) - 1
+            self.fields[name] = (reg_index, start_bit, width_mask << start_bit, width_mask)
+        self.names = sorted(self.fields.keys())
+
+        #   Fields of each register, and the bits that belong to some field
+        self.register_fields = {}
+        self.register_masks = {}
+        for name in self.names:
+            (reg_index, shift, mask, width_mask) = self.fields[name]
+            assert (self.register_masks.get(reg_index, 0) & mask) == 0, 'Field %s overlaps another field in register 0x%02x' % (name, reg_index)
+            self.register_masks[reg_index] = self.register_masks.get(reg_index, 0) | mask
+            self.register_fields.setdefault(reg_index, []).append(name)
+
+        if registers is None:
+            registers = sorted(self.register_fields.keys())
+        self.registers = list(registers)
+
+    def field_register(self, name):
+        return self.fields[name][0]
+
+    def registers_for(self, names):
+        #   Sorted list of the registers holding the given fields
+        return sorted(set([self.fields[name][0] for name in names]))
+
+    def get(self, regs, name):
+        (reg_index, shift, mask, width_mask) = self.fields[name]
+        return (regs[reg_index] & mask) >> shift
+
+    def decode(self, regs):
+        """ Returns {field name: value} for the fields whose registers are in regs."""
+        result = {}
+        for (name, (reg_index, shift, mask, width_mask)) in self.fields.items():
+            if reg_index in regs:
+                result[name] = (regs[reg_index] & mask) >> shift
+        return result
+
+    def updates(self, values):
+        """ Returns {register index: (bits to clear, bits to set)} for setting the
+            fields in values ({field name: value}).
+        """
+        result = {}
+        for (name, value) in values.items():
+            (reg_index, shift, mask, width_mask) = self.fields[name]
+            if value & ~width_mask:
+                raise Exception('Value %s does not fit in field %s' % (value, name))
+            (clear_bits, set_bits) = result.get(reg_index, (0, 0))
+            result[reg_index] = (clear_bits | mask, (set_bits & ~mask) | (value << shift))
+        return result
+
+    def encode(self, values, regs=None):
+        """ Returns register values with the fields in values ({field name: value})
+            set, starting from regs (other fields unchanged) or from zero.
+        """
+        if regs is None:
+            result = {}
+        else:
+            result = dict(regs)
+        for (reg_index, (clear_bits, set_bits)) in self.updates(values).items():
+            result[reg_index] = (result.get(reg_index, 0) & ~clear_bits) | set_bits
+        return result
+
+    def diff(self, regs, values):
+        """ Returns the [(register index, new value), ...] writes needed to get from
+            register values regs to a configuration with the fields in values set.
+            Only registers whose value changes are written; regs must include all
+            of the registers holding fields in values.
+        """
+        target = self.encode(values, regs)
+        return [(reg_index, target[reg_index]) for reg_index in sorted(target.keys()) if target[reg_index] != regs[reg_index]]
+
+    def format(self, regs):
+        #   One line per field, as printed by spi_summary()
+        decoded = self.decode(regs)
+        return ['%6s = %3d' % (name, decoded[name]) for name in self.names if name in decoded]
@@ -18,15 +18,27 @@ import os
 import scipy.io.wavfile
 
 from backends.da_platform import DAPlatformBackend
+from backends.emulator import EmulatorBackend
 from modules.base import ModuleBase
 from modules.dsd1792 import DSD1792Module
 from modules.ad1934 import AD1934Module
+from streaming.formats import SampleConverter
+from streaming.playback import PlaybackEngine
+from streaming.routing import ChannelRouter
 from utils import get_elapsed_time
 
 SLOT_DAC = 0
+SAMPLE_RATE = 44100
 multichan_mode = False
 
-backend = DAPlatformBackend()
+#   Run with --emulate to use the FPGA emulator instead of hardware
+if '--emulate' in sys.argv[1:]:
+    backend = EmulatorBackend()
+else:
+    backend = DAPlatformBackend()
+#   Keep a few audio transfers in flight so reading/converting the next chunk
+#   overlaps with USB transfer of the previous ones
+backend.enable_write_queue(4)
 
 #   Autodetect DAC type and configure the module
 chunk_size = 4096
@@ -43,37 +55,43 @@ else:
     print 'Detected DSD1792, 2-channel'
     dac = DSD1792Module(backend)
 
+if multichan_mode:
+    #   Hack for distributing same stereo stream to each channel pair of AD1934
+    #   For now, only using channels 1,2 and 7,8 (long story)
+    router = ChannelRouter(2, {SLOT_DAC: 8}, [(0, SLOT_DAC, 0), (1, SLOT_DAC, 1), (0, SLOT_DAC, 6), (1, SLOT_DAC, 7)])
+
 dac.setup(SLOT_DAC)
 dac.select_clock(1)
 
 #  For now, assumes 44.1 kHz, 2 channels, 16 bit format
 #  BUT should eventually get that from the command line (ALSA)
 
+#   Writes are paced so that about 50 ms of audio are queued for the DAC
+if multichan_mode:
+    engine = PlaybackEngine(dac, {SLOT_DAC: 8}, SAMPLE_RATE)
+else:
+    engine = PlaybackEngine(dac, {SLOT_DAC: 2}, SAMPLE_RATE)
+
 def play_stream(stream, chunk_size=4096):
     bytes_read = 1
+    converter = SampleConverter('S16_LE')
     while bytes_read > 0: 
         data = stream.read(chunk_size)
         bytes_read = len(data)
-        data = numpy.fromstring(data, dtype=numpy.int16)
         #   Convert to 24-bit format
-        data = data.astype(numpy.int32) << 8
+        data = converter.convert(data)
 
         if multichan_mode:
-            #   Hack for distributing same stereo stream to each channel pair of AD1934
-            #   For now, only using channels 1,2 and 7,8 (long story)
-            orig_size = data.shape[0]
-            data_exp = numpy.zeros((orig_size * 4,), dtype=numpy.int32)
-            data_exp[::8] = data[::2]
-            data_exp[1::8] = data[1::2]
-            data_exp[6::8] = data[::2]
-            data_exp[7::8] = data[1::2]
-            data = data_exp
+            [(slot, data)] = router.route(data)
 
         #print 'Got %d samples: %s' % (data.shape[0], data[:32])
-        dac.audio_write(SLOT_DAC, data)
+        engine.write(SLOT_DAC, data)
 
 play_stream(sys.stdin, chunk_size)
+engine.drain()
+print 'Underruns: %s' % engine.underruns
 
 backend.flush(display=True)
+print 'Write queue status: %s' % backend.write_queue_status()
 sys.exit(0)
 
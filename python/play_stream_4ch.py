@@ -14,16 +14,24 @@
 """
 
 import sys
+import collections
 import numpy
 import os
 import scipy.io.wavfile
 import argparse
 
 from backends.da_platform import DAPlatformBackend
+from backends.emulator import EmulatorBackend
+from backends.recorder import TrafficRecorder
 from modules.base import ModuleBase
 from modules.dsd1792 import DSD1792Module
 from modules.ak4490 import AK4490Module
 from modules.ad1934 import AD1934Module
+from streaming.convolution import PartitionedConvolver, load_filters
+from streaming.formats import SampleConverter, FORMATS, SAMPLE_BITS
+from streaming.playback import PlaybackEngine
+from streaming.routing import ChannelRouter, split_routes
+from streaming.workers import DSPWorkerPool
 from utils import get_elapsed_time
 
 from webctrl import controls
@@ -34,15 +42,31 @@ parser.add_argument('-r', '--rate', type=int, default=44100)
 parser.add_argument('-c', '--channels', type=int, default=4)
 parser.add_argument('-b', '--bits', type=int, default=16)
 parser.add_argument('-f', '--format', default='S16_LE')
+parser.add_argument('--emulate', action='store_true', help='Use the FPGA emulator instead of hardware')
+parser.add_argument('--record', help='Record USB traffic to this file')
+parser.add_argument('--latency', type=float, default=0.05, help='Target output latency (s); volume changes take about this long to be heard')
+parser.add_argument('--filters', help='FIR filters (.npy or .wav, one channel per output channel) to apply, e.g. for a crossover')
+parser.add_argument('--filter-block', type=int, default=256, help='Block size (frames) for FIR filtering; adds this much latency')
+parser.add_argument('--workers', type=int, default=0, help='Worker processes to share the FIR filtering between (0 to filter in this process)')
 args = parser.parse_args()
 print args
 
 assert args.channels == 4
+if args.format not in FORMATS or args.bits != SAMPLE_BITS[args.format]:
+    raise Exception('Bad input format %s with %d bits' % (args.format, args.bits))
 
 #   Assumes 4 channels in.  Directs these to 2 DAC2s in the following slots.
 SLOTS_DAC = [0, 1]
 
-backend = DAPlatformBackend()
+if args.emulate:
+    backend = EmulatorBackend(modules=[(True, 2), (True, 2), (True, 8), (False, 8)])
+else:
+    backend = DAPlatformBackend()
+if args.record:
+    backend.recorder = TrafficRecorder(args.record)
+#   Keep a few audio transfers in flight so reading/converting the next chunk
+#   overlaps with USB transfer of the previous ones
+backend.enable_write_queue(4)
 
 #   Autodetect DAC type and configure the module
 chunk_size = 2048
@@ -77,8 +101,42 @@ for slot in SLOTS_DAC:
 #   1/27/2018: Set slot 1 DAC to 10 dB attenuation
 #   for use with Modulus-86 amp (20 dB gain vs. 32 dB on XPA-5)
 #   2/4/2018: Changed to full gain on tweeter amp.
-dacs[0].set_attenuation(0, 10)
-dacs[1].set_attenuation(1, 0)
+with base_module.batch():
+    dacs[0].set_attenuation(0, 10)
+    dacs[1].set_attenuation(1, 0)
+
+#   Writes are paced so that about args.latency seconds of audio are queued for the DACs.
+#   Both DACs are held until they have been prefilled, so they start at the same sample.
+engine = PlaybackEngine(base_module, dict((slot, 2) for slot in SLOTS_DAC), args.rate, target_latency=args.latency, synchronized_start=True)
+
+#   Optional FIR filtering (after the volume control) instead of an external crossover
+convolver = None
+pool = None
+if args.filters:
+    filters = load_filters(args.filters, args.rate)
+    convolver = PartitionedConvolver(filters, args.filter_block, args.channels)
+    print 'Loaded %d-tap filters (%d partitions of %d frames)' % (convolver.num_taps, convolver.num_partitions, convolver.block_frames)
+elif args.workers > 0:
+    raise Exception('Worker processes are only used for filtering; use --filters')
+
+def filter_maker(channels):
+    #   Each worker filters a range of channels with its own convolver
+    def make_process():
+        if filters.shape[1] == 1:
+            group_filters = filters
+        else:
+            group_filters = filters[:, channels]
+        return PartitionedConvolver(group_filters, args.filter_block, channels.stop - channels.start).process
+    return make_process
+
+if args.workers > 0:
+    bounds = numpy.linspace(0, args.channels, args.workers + 1).astype(int)
+    worker_channels = [slice(bounds[i], bounds[i + 1]) for i in range(args.workers) if bounds[i + 1] > bounds[i]]
+    pool = DSPWorkerPool([(range(args.channels)[ch], ch.stop - ch.start, filter_maker(ch)) for ch in worker_channels], args.filter_block, args.channels)
+    print 'Filtering in %d worker processes' % len(worker_channels)
+
+#   First 2 channels to first slot, second 2 channels to second slot
+router = ChannelRouter(args.channels, dict((slot, 2) for slot in SLOTS_DAC), split_routes(args.channels, [(slot, 2) for slot in SLOTS_DAC]))
 
 #  For now, assumes 44.1 kHz, 2 channels, 16 bit format
 #  BUT should eventually get that from the command line (ALSA)
@@ -86,53 +144,74 @@ dacs[1].set_attenuation(1, 0)
 def play_stream(stream, chunk_size=4096):
     bytes_read = 1
     gain_db = None
+    controls_version = None
+    converter = SampleConverter(args.format)
+    #   Read whole frames (e.g. 3-byte samples don't fit evenly into 4096 bytes)
+    frame_bytes = converter.sample_bytes * args.channels
+    chunk_size -= chunk_size % frame_bytes
+    if convolver is not None:
+        #   Read whole filter blocks
+        chunk_size = convolver.block_frames * frame_bytes
+    data_buf = numpy.empty((chunk_size / converter.sample_bytes,), dtype=numpy.int32)
+    if pool is not None:
+        pool.start()
+        filtered_buf = numpy.zeros((convolver.block_frames, args.channels), dtype=numpy.int32)
+        #   Number of frames of audio (vs. padding) in each block being filtered
+        block_frames = collections.deque()
+
+    def write_filtered():
+        #   Write out the oldest block from the workers
+        for (ch, output) in zip(worker_channels, pool.collect()):
+            filtered_buf[:, ch] = output
+        engine.write_slots(router.route(filtered_buf[:block_frames.popleft()]))
+
     while bytes_read > 0: 
-        #   Data is converted to double precision when read in.
         data = stream.read(chunk_size)
         bytes_read = len(data)
-        if args.format == 'S16_LE' and args.bits == 16:
-            data = numpy.fromstring(data, dtype=numpy.int16)
-            data = data.astype(float) / (1 << 16)
-        elif args.format == 'S24_LE' and args.bits == 24:
-            data = numpy.fromstring(data, dtype=numpy.int32)
-            data = data.astype(float) / (1 << 24)
-        elif args.format == 'S32_LE' and args.bits == 32:
-            data = numpy.fromstring(data, dtype=numpy.int32)
-            data = data.astype(float) / (1 << 32)
-        elif args.format == 'FLOAT_LE' and args.bits == 32:
-            data = numpy.fromstring(data, dtype=numpy.float32)
-            data = data.astype(float)
-        else:
-            raise Exception('Bad input format %s with %d bits' % (args.format, args.bits))
 
         #  Apply global volume (gain) setting and convert to 24 bit integers.
-        next_gain_db = controls.get_volume()
-        if next_gain_db != gain_db:
-            print 'Volume changed to %f dB' % next_gain_db
-        gain_db = next_gain_db
-        data_scaled = data * (10 ** (gain_db / 20.))
-        data = (data_scaled * (1 << 24)).astype(numpy.int32)
-
-        #  Distribute channels to slots:
-        #  First 2 channels to first slot, second 2 channels to second slot
-        orig_size = data.shape[0]
-
-        data_slot0 = numpy.zeros((orig_size / 2), dtype=numpy.int32)
-        data_slot1 = numpy.zeros((orig_size / 2), dtype=numpy.int32)
-
-        data_slot0[::2] = data[::4]
-        data_slot0[1::2] = data[1::4]
-        data_slot1[::2] = data[2::4]
-        data_slot1[1::2] = data[3::4]
-
-        #print 'Got %d samples: %s' % (data.shape[0], data[:32])
-
-        #   TODO: Time alignment by releasing a block at the same time for both...
-        dacs[0].audio_write(SLOTS_DAC[0], data_slot0)
-        dacs[1].audio_write(SLOTS_DAC[1], data_slot1)
+        #  The setting is only read again when something has changed.
+        next_version = controls.version()
+        if next_version != controls_version:
+            controls_version = next_version
+            next_gain_db = controls.get_volume()
+            if next_gain_db != gain_db:
+                print 'Volume changed to %f dB' % next_gain_db
+            gain_db = next_gain_db
+        data = converter.convert(data, 10 ** (gain_db / 20.), data_buf)
+        #  (Drop any incomplete frame at the end of the stream)
+        data = data[:data.shape[0] - data.shape[0] % args.channels]
+
+        if pool is not None:
+            #   Keep the workers busy with up to pool.depth blocks
+            if pool.pending() == pool.depth:
+                write_filtered()
+            num_frames = data.shape[0] / args.channels
+            if num_frames < convolver.block_frames:
+                #   (The last block is padded with silence, which isn't played)
+                data_buf[data.shape[0]:] = 0
+                data = data_buf
+            pool.submit(data)
+            block_frames.append(num_frames)
+            continue
+        elif convolver is not None:
+            convolver.process(data, data)
+
+        #  Distribute channels to slots; both slots' audio goes out in one transfer
+        engine.write_slots(router.route(data))
+
+    if pool is not None:
+        while pool.pending() > 0:
+            write_filtered()
+        pool.stop()
 
 play_stream(sys.stdin, chunk_size)
+engine.drain()
+print 'Underruns: %s' % engine.underruns
 
 backend.flush(display=True)
+print 'Write queue status: %s' % backend.write_queue_status()
+if backend.recorder is not None:
+    backend.recorder.close()
 sys.exit(0)
 
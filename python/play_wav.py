@@ -20,6 +20,8 @@ import scipy.io.wavfile
 from backends.da_platform import DAPlatformBackend
 from modules.dsd1792 import DSD1792Module
 from modules.ad1934 import AD1934Module
+from streaming.formats import SampleConverter, format_for_dtype
+from streaming.playback import PlaybackEngine
 from utils import get_elapsed_time
 
 SLOT_DAC = 1
@@ -32,28 +34,31 @@ test_fn = sys.argv[1]
 def play_file(filename):
     
     (Fs_test, x_st_int) = scipy.io.wavfile.read(filename)
-    #   Convert to 24-bit
-    if x_st_int.dtype == numpy.int16:
-        #   << 8 for 0 dBFS, << 4 for -24 dbFS
-        x_st_int = x_st_int.astype(numpy.int32) << 8
-    elif x_st_int.dtype == numpy.int32:
-        #   fine, accept int32 as if it's 24 bit
-        #   hopefully it isn't actually 32 bit
-        pass
-    else:
-        raise Exception('Unexpected source data type: %s' % x_st_int.dtype)
+    #   Convert to 24-bit.  int32 is accepted as if it's 24 bit;
+    #   hopefully it isn't actually 32 bit
+    converter = SampleConverter(format_for_dtype(x_st_int.dtype))
+    x_st_int = converter.convert(x_st_int).reshape(x_st_int.shape)
     
     N = x_st_int.shape[0]
     print 'Num. samples = %d' % N
     samples_written = 0
     chunk_size = (1 << 12)
     
+    #   Writes are paced so that about 50 ms of audio are queued for the DAC
+    num_channels = 1
+    if x_st_int.ndim > 1:
+        num_channels = x_st_int.shape[1]
+    engine = PlaybackEngine(dac, {SLOT_DAC: num_channels}, Fs_test)
+    
     while samples_written < N:
         chunk = x_st_int[samples_written:samples_written+chunk_size]
         this_chunk_size = chunk.shape[0]
-        dac.audio_write(SLOT_DAC, chunk.flatten())
+        engine.write(SLOT_DAC, chunk.flatten())
         samples_written += this_chunk_size
         print 'ASAA %d' % samples_written
+    
+    engine.drain()
+    print 'Underruns: %s' % engine.underruns
 
 if os.path.isdir(test_fn):
     x_st_arr = []
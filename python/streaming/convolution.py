@@ -0,0 +1,131 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    convolution.py: Low-latency FIR filtering of multichannel audio (e.g. for
+    an active crossover), using uniformly partitioned overlap-save convolution.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import numpy
+
+from streaming.formats import SAMPLE_MIN, SAMPLE_MAX
+
+
+def load_filters(filename, sample_rate=None):
+    """ Returns FIR filter coefficients from a .npy file or a WAV file, as an
+        array of shape (taps, channels).  Integer WAV data is scaled so full
+        scale is 1.0.  If sample_rate is given, a WAV file must match it.
+    """
+    if filename.lower().endswith('.wav'):
+        import scipy.io.wavfile
+        (Fs, data) = scipy.io.wavfile.read(filename)
+        if sample_rate is not None and Fs != sample_rate:
+            raise Exception('Filters in %s are for %d Hz, not %d Hz' % (filename, Fs, sample_rate))
+        if data.dtype.kind == 'i':
+            data = data / float(1 << (data.dtype.itemsize * 8 - 1))
+    else:
+        data = numpy.load(filename)
+    data = numpy.asarray(data, dtype=numpy.float64)
+    if data.ndim == 1:
+        data = data.reshape((-1, 1))
+    return data
+
+
+class PartitionedConvolver(object):
+    """ Filters each channel of the audio with its own FIR filter.  filters is
+        an array of shape (taps, channels); one channel applies the same filter
+        to every channel of the audio.
+
+        The filters are split into partitions of block_frames taps, whose
+        spectra are computed once.  Each block of input is transformed (one
+        FFT batch for all channels) into a frequency-domain delay line, and
+        the output block is the inverse FFT of the sum of the products of the
+        last few input spectra with the partition spectra.  So the latency is
+        one block regardless of the filter length, and the work per block grows
+        linearly with the number of partitions.
+    """
+
+    def __init__(self, filters, block_frames=256, num_channels=None):
+        filters = numpy.asarray(filters, dtype=numpy.float64)
+        if filters.ndim == 1:
+            filters = filters.reshape((-1, 1))
+        if num_channels is None:
+            num_channels = filters.shape[1]
+        if filters.shape[1] == 1 and num_channels > 1:
+            filters = numpy.repeat(filters, num_channels, axis=1)
+        if filters.shape[1] != num_channels:
+            raise Exception('Got %d filters for %d channels' % (filters.shape[1], num_channels))
+
+        self.block_frames = block_frames
+        self.num_channels = num_channels
+        self.num_taps = filters.shape[0]
+        self.fft_size = 2 * block_frames
+        self.num_partitions = (self.num_taps + block_frames - 1) / block_frames
+        num_bins = block_frames + 1
+
+        #   Spectra of the partitions: [partition, channel, bin]
+        padded = numpy.zeros((self.num_partitions * block_frames, num_channels))
+        padded[:self.num_taps] = filters
+        partitions = padded.reshape((self.num_partitions, block_frames, num_channels)).transpose((0, 2, 1))
+        self.spectra = numpy.fft.rfft(partitions, n=self.fft_size, axis=2)
+
+        #   The delay line holds each input spectrum twice, so the last
+        #   num_partitions spectra (newest first) are always a contiguous view
+        self.delay_line = numpy.zeros((2 * self.num_partitions, num_channels, num_bins), dtype=numpy.complex128)
+        self.delay_pos = 0
+        #   The last two blocks of input: [channel, frame]
+        self.window = numpy.zeros((num_channels, self.fft_size))
+        self.sum = numpy.zeros((num_channels, num_bins), dtype=numpy.complex128)
+
+    def reset(self):
+        self.delay_line.fill(0)
+        self.window.fill(0)
+
+    def process_block(self, block, out):
+        #   Filter one block of shape (block_frames, channels) into out (same shape)
+        B = self.block_frames
+        P = self.num_partitions
+        self.window[:, :B] = self.window[:, B:]
+        self.window[:, B:] = block.T
+
+        self.delay_pos = (self.delay_pos - 1) % P
+        spectrum = numpy.fft.rfft(self.window, axis=1)
+        self.delay_line[self.delay_pos] = spectrum
+        self.delay_line[self.delay_pos + P] = spectrum
+
+        numpy.einsum('pcf,pcf->cf', self.spectra, self.delay_line[self.delay_pos:self.delay_pos + P], out=self.sum)
+        result = numpy.fft.irfft(self.sum, n=self.fft_size, axis=1)
+        #   The first half has wrapped around; the second half is the output
+        if out.dtype.kind == 'f':
+            out[:] = result[:, B:].T
+        else:
+            numpy.clip(result[:, B:], SAMPLE_MIN, SAMPLE_MAX, out=result[:, B:])
+            numpy.copyto(out, result[:, B:].T, casting='unsafe')
+
+    def process(self, data, out=None):
+        """ Filters interleaved audio (or frames x channels), returning an array
+            of the same shape.  out may be the same array as data.  Integer
+            output is clipped to 24 bits.  A partial block at the end is padded
+            with silence, so this should only happen at the end of a stream.
+        """
+        shape = data.shape
+        data = data.reshape((-1, self.num_channels))
+        if out is None:
+            out = numpy.empty(shape, dtype=data.dtype)
+        out_frames = out.reshape((-1, self.num_channels))
+        N = data.shape[0]
+        B = self.block_frames
+        for start in range(0, N - N % B, B):
+            self.process_block(data[start:start + B], out_frames[start:start + B])
+        if N % B > 0:
+            block = numpy.zeros((B, self.num_channels), dtype=data.dtype)
+            block[:N % B] = data[N - N % B:]
+            self.process_block(block, block)
+            out_frames[N - N % B:] = block[:N % B]
+        return out
@@ -0,0 +1,160 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    duplex.py: Full-duplex streaming engine.  Audio recorded from any set of
+    ADC slots is passed, a fixed-size block at a time, to a process function
+    which fills in the audio to play on any set of DAC slots.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import numpy
+import usb1
+
+from backends.da_platform import DAPlatformBackend
+from modules.packing import FLOAT_SCALE, frame_words
+from utils import monotonic_time
+
+#   Words in an AUD_FIFO_READ command
+READ_CMD_WORDS = 4
+
+
+class DuplexEngine(object):
+    """ Streams audio in and out at the same time, calling
+
+            process(inputs, outputs)
+
+        once per block of block_frames frames.  inputs and outputs are dicts
+        {slot: array of shape (block_frames, number of channels)} for the ADC and
+        DAC slots respectively; process reads inputs and fills in outputs (which
+        start out as zeros).  With float_format, samples are floats (full scale
+        = 1 << 24, as for ModuleBase.audio_write_float); otherwise int32.  The
+        arrays are reused from one block to the next.  run() stops when process
+        returns False or after num_blocks blocks.
+
+        Each block's output goes out in one transfer, followed by the request
+        for the next input block.  The FPGA doesn't handle anything after an
+        AUD_FIFO_READ until that much audio has been recorded, so the DACs are
+        prefilled with prefill_blocks blocks of silence; this (plus read_ahead,
+        the number of input blocks requested in advance) sets the latency from
+        input to output.  It must be more than read_ahead + 1 blocks to avoid
+        underruns.
+    """
+
+    def __init__(self, module, dac_slots, adc_slots, block_frames=1024, prefill_blocks=3, read_ahead=1, float_format=True, timeout=1.0):
+        assert prefill_blocks > read_ahead + 1
+        self.module = module
+        self.backend = module.backend
+        #   {slot: number of channels}
+        self.dac_slots = dict(dac_slots)
+        self.adc_slots = dict(adc_slots)
+        self.block_frames = block_frames
+        self.prefill_blocks = prefill_blocks
+        self.read_ahead = read_ahead
+        self.float_format = float_format
+        self.timeout = timeout
+
+        if float_format:
+            dtype = numpy.float64
+        else:
+            dtype = numpy.int32
+        self.inputs = dict((slot, numpy.zeros((block_frames, channels), dtype=dtype)) for (slot, channels) in self.adc_slots.items())
+        self.outputs = dict((slot, numpy.zeros((block_frames, channels), dtype=dtype)) for (slot, channels) in self.dac_slots.items())
+        self.blocks_processed = 0
+        #   Input blocks requested but not received yet
+        self.reads_pending = 0
+
+    def send(self, num_reads):
+        #   Write the current outputs to the DACs, then request num_reads more blocks from each ADC
+        items = [(slot, self.outputs[slot]) for slot in sorted(self.outputs.keys())]
+        audio_words = sum([frame_words(data.size) for (slot, data) in items])
+        num_words = audio_words + num_reads * len(self.adc_slots) * READ_CMD_WORDS
+        if num_words == 0:
+            return
+        cmd = self.backend.acquire_buffer(num_words)
+        if len(items) > 0:
+            self.module.packer.pack_slots(items, cmd)
+        pos = audio_words
+        for i in range(num_reads):
+            for (slot, channels) in sorted(self.adc_slots.items()):
+                num_samples = self.block_frames * channels
+                cmd[pos:pos + READ_CMD_WORDS] = [slot, DAPlatformBackend.AUD_FIFO_READ, num_samples / 65536, num_samples % 65536]
+                pos += READ_CMD_WORDS
+        self.backend.write_owned(cmd[:num_words])
+        self.reads_pending += num_reads
+
+    def start(self):
+        for slot in self.adc_slots:
+            self.module.start_recording(slot)
+        for output in self.outputs.values():
+            output.fill(0)
+        for i in range(self.prefill_blocks - 1):
+            self.send(0)
+        self.send(self.read_ahead)
+
+    def stop(self):
+        #   Receive (and discard) the blocks requested in advance before recording stops,
+        #   since the FPGA would otherwise wait for them forever
+        while self.reads_pending > 0:
+            self.receive()
+        for slot in self.adc_slots:
+            self.module.stop_recording(slot)
+
+    def words_missing(self):
+        #   Words still to be received (including report headers) for the next input block
+        num_words = 0
+        for (slot, channels) in self.adc_slots.items():
+            missing = self.block_frames * channels * 2 - self.backend.audio_words_available(slot)
+            if missing > 0:
+                num_words += missing + 6
+        return num_words
+
+    def receive(self):
+        #   Wait for the next input block and convert it into self.inputs
+        deadline = monotonic_time() + self.timeout
+        num_words = self.words_missing()
+        while num_words > 0:
+            remaining = deadline - monotonic_time()
+            if remaining <= 0:
+                raise usb1.USBErrorTimeout()
+            self.backend.update_receive_state(timeout=max(1, int(min(remaining, 0.1) * 1000)), request_size=num_words)
+            num_words = self.words_missing()
+        for (slot, channels) in self.adc_slots.items():
+            num_samples = self.block_frames * channels
+            samples = self.backend.peek_audio(slot, num_samples).reshape((self.block_frames, channels))
+            target = self.inputs[slot]
+            if self.float_format:
+                #   Sign-extend the 24-bit samples on the way
+                numpy.multiply(numpy.right_shift(numpy.left_shift(samples, 8), 8), 1.0 / FLOAT_SCALE, out=target)
+            else:
+                numpy.left_shift(samples, 8, out=target)
+                numpy.right_shift(target, 8, out=target)
+            self.backend.consume_audio(slot, num_samples)
+        self.reads_pending -= 1
+
+    def process_block(self, process):
+        self.receive()
+        for output in self.outputs.values():
+            output.fill(0)
+        result = process(self.inputs, self.outputs)
+        self.send(1)
+        self.blocks_processed += 1
+        return result
+
+    def run(self, process, num_blocks=None):
+        """ Stream until process returns False, or for num_blocks blocks.
+            Returns the number of blocks processed.
+        """
+        self.blocks_processed = 0
+        self.reads_pending = 0
+        self.start()
+        while num_blocks is None or self.blocks_processed < num_blocks:
+            if self.process_block(process) is False:
+                break
+        self.stop()
+        return self.blocks_processed
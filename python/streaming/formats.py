@@ -0,0 +1,161 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    formats.py: Conversion of audio from ALSA-style sample formats (as read
+    from a pipe or a WAV file) to the platform's 24-bit samples in int32.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import sys
+
+import numpy
+
+from modules.packing import FLOAT_SCALE
+
+#   Range of the 24-bit samples sent to the DACs
+SAMPLE_MAX = (1 << 23) - 1
+SAMPLE_MIN = -(1 << 23)
+
+#   Supported formats: name -> (dtype of each sample, left shift to 24 bits).
+#   Float samples are scaled by FLOAT_SCALE, as in ModuleBase.audio_write_float.
+#   S24_LE holds 24-bit samples in 32 bits; S24_3LE packs them into 3 bytes.
+FORMATS = {
+    'S16_LE':   (numpy.dtype('<i2'), 8),
+    'S24_LE':   (numpy.dtype('<i4'), 0),
+    'S24_3LE':  (numpy.dtype('u1'), 0),
+    'S32_LE':   (numpy.dtype('<i4'), -8),
+    'FLOAT_LE': (numpy.dtype('<f4'), None),
+}
+
+#   Bytes per sample in each format
+SAMPLE_BYTES = {
+    'S16_LE': 2,
+    'S24_LE': 4,
+    'S24_3LE': 3,
+    'S32_LE': 4,
+    'FLOAT_LE': 4,
+}
+
+#   Significant bits per sample in each format (as given to play_stream_4ch.py)
+SAMPLE_BITS = {
+    'S16_LE': 16,
+    'S24_LE': 24,
+    'S24_3LE': 24,
+    'S32_LE': 32,
+    'FLOAT_LE': 32,
+}
+
+#   Byte positions within an int32 in host memory: the low 3 bytes, and the top byte
+if sys.byteorder == 'little':
+    (LOW_BYTES, TOP_BYTE) = ([0, 1, 2], 3)
+else:
+    (LOW_BYTES, TOP_BYTE) = ([3, 2, 1], 0)
+
+
+def format_for_dtype(dtype):
+    #   Format of samples loaded as numpy arrays (e.g. by scipy.io.wavfile).  As
+    #   before, int32 data is assumed to hold 24-bit samples.
+    dtype = numpy.dtype(dtype)
+    if dtype == numpy.int16:
+        return 'S16_LE'
+    elif dtype == numpy.int32:
+        return 'S24_LE'
+    elif dtype == numpy.float32:
+        return 'FLOAT_LE'
+    raise Exception('Unexpected source data type: %s' % dtype)
+
+
+class SampleConverter(object):
+    """ Converts audio in one of FORMATS to 24-bit samples in int32, applying
+        a gain if requested.  Results are written to a caller-supplied buffer
+        (or a new one).  Integer samples are shifted or scaled straight into the
+        output.  Float samples, and integer samples with a gain above 1, are
+        scaled in a floating-point scratch buffer (which is reused) and clipped
+        to the 24-bit range first.
+    """
+
+    def __init__(self, fmt):
+        if fmt not in FORMATS:
+            raise Exception('Unsupported sample format %s' % fmt)
+        self.format = fmt
+        (self.dtype, self.shift) = FORMATS[fmt]
+        self.sample_bytes = SAMPLE_BYTES[fmt]
+        #   float32 holds 16-bit and float samples exactly, but not 32-bit ones
+        if self.dtype in (numpy.dtype('<i2'), numpy.dtype('<f4')):
+            self.scratch_dtype = numpy.float32
+        else:
+            self.scratch_dtype = numpy.float64
+        self.scratch = numpy.empty((0,), dtype=self.scratch_dtype)
+
+    def samples(self, data):
+        #   View of data (a string, buffer or numpy array) as an array of source samples
+        if isinstance(data, numpy.ndarray):
+            data = data.ravel()
+            if data.dtype != self.dtype:
+                data = data.view(self.dtype)
+        else:
+            num_bytes = len(data) - (len(data) % self.sample_bytes)
+            data = numpy.frombuffer(data, dtype=self.dtype, count=num_bytes / self.dtype.itemsize)
+        if self.format == 'S24_3LE':
+            data = data[:(data.shape[0] / 3) * 3].reshape((-1, 3))
+        return data
+
+    def num_samples(self, data):
+        return self.samples(data).shape[0]
+
+    def scale(self):
+        #   Factor between source samples and 24-bit samples
+        if self.shift is None:
+            return float(FLOAT_SCALE)
+        return 2.0 ** self.shift
+
+    def unpack_24(self, src, out):
+        #   Copy packed 3-byte samples into the low bytes of out, and sign-extend them
+        out_bytes = out.view(numpy.uint8).reshape((-1, 4))
+        out_bytes[:, LOW_BYTES] = src
+        numpy.right_shift(src[:, 2].view(numpy.int8), 7, out=out_bytes[:, TOP_BYTE].view(numpy.int8))
+
+    def convert(self, data, gain=1.0, out=None):
+        """ Returns the int32 samples for data, multiplied by gain (linear).
+            out, if supplied, must hold at least num_samples(data) samples.
+        """
+        src = self.samples(data)
+        N = src.shape[0]
+        if out is None:
+            out = numpy.empty((N,), dtype=numpy.int32)
+        out = out[:N]
+
+        if gain == 1.0 and self.shift is not None:
+            if self.format == 'S24_3LE':
+                self.unpack_24(src, out)
+            elif self.shift > 0:
+                numpy.left_shift(src, self.shift, out=out, dtype=numpy.int32)
+            elif self.shift < 0:
+                numpy.right_shift(src, -self.shift, out=out)
+            else:
+                out[:] = src
+            return out
+
+        if self.format == 'S24_3LE':
+            self.unpack_24(src, out)
+            src = out
+        #   (The factor has the scratch buffer's type, so numpy computes in that type)
+        factor = self.scratch_dtype(self.scale() * gain)
+        if self.shift is not None and abs(gain) <= 1.0:
+            #   Integer samples can't leave the 24-bit range, so they don't need clipping
+            numpy.multiply(src, factor, out=out, casting='unsafe')
+            return out
+
+        if self.scratch.shape[0] < N:
+            self.scratch = numpy.empty((N,), dtype=self.scratch_dtype)
+        scaled = self.scratch[:N]
+        numpy.multiply(src, factor, out=scaled)
+        numpy.clip(scaled, SAMPLE_MIN, SAMPLE_MAX, out=scaled)
+        numpy.copyto(out, scaled, casting='unsafe')
+        return out
@@ -0,0 +1,171 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    playback.py: Playback engine which paces audio writes so that the
+    amount of audio queued for each DAC slot (in USB transfers and in the DRAM
+    FIFO) stays near a target latency.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import time
+
+from utils import monotonic_time
+
+
+class PlaybackEngine(object):
+    """ Writes audio to one or more DAC slots, blocking whenever more than
+        target_latency seconds of audio are queued for any of them.  Until the
+        target is reached (e.g. at startup) writes go through immediately, so the
+        FIFOs are filled faster than real time.
+
+        The queued amount is the number of samples written by the engine minus
+        the FIFO port's read counter (see FIFOStatusService).  Between status
+        reports, the read counter is extrapolated at the slot's sample rate, and
+        the status is refreshed every status_interval seconds while waiting.
+        Underruns (a FIFO found empty after audio was written) are counted per
+        slot in self.underruns.
+
+        slot_channels is {slot: number of channels}; audio for each slot is
+        interleaved, as for ModuleBase.audio_write (int32) or audio_write_float.
+
+        With synchronized_start, the slots are blocked (see ModuleBase.set_blocking)
+        until target_latency seconds of audio have been written to every one of
+        them, and then released with one command, so they start playing at the
+        same sample.  Other slots are left as they were.
+    """
+
+    def __init__(self, module, slot_channels, sample_rate, target_latency=0.05, status_interval=0.02, synchronized_start=False):
+        self.module = module
+        self.backend = module.backend
+        self.slot_channels = dict(slot_channels)
+        self.slots = sorted(self.slot_channels.keys())
+        self.sample_rate = sample_rate
+        self.target_latency = target_latency
+        self.status_interval = status_interval
+
+        self.underruns = dict((slot, 0) for slot in self.slots)
+        #   Whether the slot's FIFO was seen empty since audio was last written to it
+        self.starved = dict((slot, False) for slot in self.slots)
+        self.last_write_time = dict((slot, None) for slot in self.slots)
+        self.blocked = False
+        self.start(synchronized_start)
+
+    def start(self, synchronized=False):
+        #   Count from the FIFO counters as they are now
+        self.status = self.backend.fifo_status.status(max_age=0)
+        self.samples_written = dict((slot, int(self.status.counts[slot, 0])) for slot in self.slots)
+        if synchronized:
+            self.module.set_slots_blocked(self.slot_mask(), True)
+            self.blocked = True
+
+    def slot_mask(self):
+        mask = 0
+        for slot in self.slots:
+            mask |= (1 << slot)
+        return mask
+
+    def release(self):
+        #   Let the blocked slots start playing
+        self.module.set_slots_blocked(self.slot_mask(), False)
+        self.blocked = False
+        self.refresh(max_age=0)
+
+    def read_rate(self, slot):
+        #   Samples/s read from the slot's FIFO port while it is playing
+        return self.sample_rate * self.slot_channels[slot]
+
+    def refresh(self, max_age=None):
+        if max_age is None:
+            max_age = self.status_interval
+        status = self.backend.fifo_status.status(max_age)
+        if status is not self.status:
+            self.status = status
+            for slot in self.slots:
+                last_write = self.last_write_time[slot]
+                if status.pending(slot) == 0 and last_write is not None and status.timestamp > last_write and not self.starved[slot]:
+                    #   Commands are handled in order, so this status includes everything
+                    #   written so far: the FIFO has run dry
+                    self.starved[slot] = True
+                    self.underruns[slot] += 1
+                    print 'PlaybackEngine: underrun in slot %d' % slot
+
+    def queued_samples(self, slot, now=None):
+        """ Estimated samples written to the slot and not yet played.    """
+        if now is None:
+            now = monotonic_time()
+        status = self.status
+        samples_read = int(status.counts[slot, 1])
+        if status.pending(slot) > 0 and not self.blocked:
+            samples_read += int((now - status.timestamp) * self.read_rate(slot))
+        queued = (self.samples_written[slot] - samples_read) & 0xFFFFFFFF
+        if queued >= 0x80000000:
+            #   Extrapolated past what was written
+            queued = 0
+        return queued
+
+    def latency(self, slot, now=None):
+        #   Seconds of audio queued for the slot
+        return self.queued_samples(slot, now) / float(self.read_rate(slot))
+
+    def wait(self, slots=None):
+        #   Block until no more than target_latency seconds are queued for any of the slots
+        if slots is None:
+            slots = self.slots
+        self.refresh()
+        while True:
+            now = monotonic_time()
+            excess = max([self.latency(slot, now) for slot in slots]) - self.target_latency
+            if excess <= 0:
+                return
+            if self.blocked:
+                if min([self.latency(slot, now) for slot in self.slots]) < self.target_latency:
+                    #   Nothing plays until the other slots are prefilled, so don't wait
+                    return
+                self.release()
+                continue
+            time.sleep(min(excess, self.status_interval))
+            self.refresh()
+
+    def written(self, slot, num_samples):
+        self.samples_written[slot] = (self.samples_written[slot] + num_samples) & 0xFFFFFFFF
+        self.last_write_time[slot] = monotonic_time()
+        self.starved[slot] = False
+
+    def write(self, slot, data):
+        """ Queue audio for one slot, first waiting until there is room for it.  """
+        self.wait([slot])
+        if data.dtype.kind == 'f':
+            self.module.audio_write_float(slot, data)
+        else:
+            self.module.audio_write(slot, data)
+        self.written(slot, data.size)
+
+    def write_slots(self, items):
+        """ Queue audio for several slots, given as [(slot, data), ...], in one transfer.   """
+        self.wait([slot for (slot, data) in items])
+        self.module.audio_write_multi(items)
+        for (slot, data) in items:
+            self.written(slot, data.size)
+
+    def drain(self, timeout=None):
+        """ Block until everything written has been played.  Returns False on timeout.  """
+        if self.blocked:
+            self.release()
+        if self.backend.write_queue_depth > 0:
+            self.backend.write_flush()
+        deadline = None
+        if timeout is not None:
+            deadline = monotonic_time() + timeout
+        for slot in self.slots:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - monotonic_time(), 0)
+            if not self.backend.fifo_status.wait_drained(slot, remaining):
+                return False
+        return True
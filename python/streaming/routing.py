@@ -0,0 +1,149 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    routing.py: Distribution of multichannel audio to the channels of one
+    or more DAC slots, with an optional gain for each route.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import numpy
+
+from streaming.formats import SAMPLE_MIN, SAMPLE_MAX
+
+#   For copying a pair of adjacent samples as one element, by sample size
+PAIR_DTYPES = {2: numpy.int32, 4: numpy.int64, 8: numpy.complex128}
+
+
+class ChannelRouter(object):
+    """ Routes interleaved audio with num_inputs channels to DAC slots.
+        slot_channels is {slot: number of channels}, and routes is a list of
+
+            (input channel, slot, output channel[, gain])
+
+        Outputs with no route are silent; outputs with several routes get the
+        sum.  The routing is worked out once.  If every output has at most one
+        route at unity gain, audio is moved with strided copies between
+        precomputed views of the input and output.  A pair of adjacent input
+        channels going to a pair of adjacent outputs (e.g. a stereo signal) is
+        copied as one element per frame (64 bits for int32 samples), and other
+        outputs one channel at a time; numpy does either faster than a 2-D copy
+        of a few channels.
+        Otherwise each slot's output is a matrix product of the input with a
+        gain matrix (and integer output is clipped to 24 bits).  Either way the
+        output goes into buffers which are reused for each chunk.
+    """
+
+    def __init__(self, num_inputs, slot_channels, routes, dtype=numpy.int32, max_frames=1024):
+        self.num_inputs = num_inputs
+        self.slot_channels = dict(slot_channels)
+        self.slots = sorted(self.slot_channels.keys())
+        self.dtype = numpy.dtype(dtype)
+
+        #   Gain matrix for each slot: gains[slot][input channel, output channel]
+        self.gains = dict((slot, numpy.zeros((num_inputs, channels))) for (slot, channels) in self.slot_channels.items())
+        for route in routes:
+            (in_ch, slot, out_ch) = route[:3]
+            gain = 1.0
+            if len(route) > 3:
+                gain = route[3]
+            if in_ch >= num_inputs or out_ch >= self.slot_channels[slot]:
+                raise Exception('Route %s is out of range' % (route,))
+            self.gains[slot][in_ch, out_ch] += gain
+
+        self.use_copies = all([((g == 0) | (g == 1)).all() and ((g != 0).sum(axis=0) <= 1).all() for g in self.gains.values()])
+        #   For copies: [(input channel, output channel), ...] per slot
+        self.copies = dict((slot, zip(*numpy.nonzero(self.gains[slot]))) for slot in self.slots)
+        self.allocate(max_frames)
+
+    def allocate(self, max_frames):
+        #   Buffers only grow, so they're allocated once for a steady chunk size
+        self.max_frames = max_frames
+        self.outputs = dict((slot, numpy.zeros((max_frames, channels), dtype=self.dtype)) for (slot, channels) in self.slot_channels.items())
+        self.outputs_flat = dict((slot, output.ravel()) for (slot, output) in self.outputs.items())
+        #   [(input channel, view of output channel), ...] in slot order
+        self.copy_views = [(in_ch, self.outputs[slot][:, out_ch]) for slot in self.slots for (in_ch, out_ch) in self.copies[slot]]
+        #   The same copies with adjacent channels paired up where possible:
+        #   [(input pair, view of output pair), ...] and the unpaired copy_views
+        self.pair_dtype = None
+        if self.dtype.itemsize in PAIR_DTYPES:
+            self.pair_dtype = numpy.dtype(PAIR_DTYPES[self.dtype.itemsize])
+        self.pair_views = []
+        self.single_views = []
+        for slot in self.slots:
+            copies = set(self.copies[slot])
+            paired = set()
+            for (in_ch, out_ch) in sorted(copies):
+                if (in_ch, out_ch) in paired:
+                    continue
+                if self.pair_dtype is not None and self.num_inputs % 2 == 0 and self.slot_channels[slot] % 2 == 0 and in_ch % 2 == 0 and out_ch % 2 == 0 and (in_ch + 1, out_ch + 1) in copies:
+                    self.pair_views.append((in_ch / 2, self.outputs[slot].view(self.pair_dtype)[:, out_ch / 2]))
+                    paired.add((in_ch + 1, out_ch + 1))
+                else:
+                    self.single_views.append((in_ch, self.outputs[slot][:, out_ch]))
+        if not self.use_copies:
+            self.input_scratch = numpy.empty((max_frames, self.num_inputs))
+            self.output_scratch = dict((slot, numpy.empty((max_frames, channels))) for (slot, channels) in self.slot_channels.items())
+
+    def route(self, data):
+        """ Routes data (interleaved, or frames x num_inputs) to the slots.
+            Returns [(slot, samples), ...] in slot order, suitable for
+            PlaybackEngine.write_slots or ModuleBase.audio_write_multi.
+            The samples are interleaved, and only valid until the next call.
+        """
+        data = data.ravel()
+        N = data.shape[0] / self.num_inputs
+        if N > self.max_frames:
+            self.allocate(N)
+
+        if self.use_copies:
+            num_samples = N * self.num_inputs
+            copy_views = self.copy_views
+            if len(self.pair_views) > 0 and data.dtype == self.dtype:
+                #   (Pairs are copied bit for bit, so this needs the output's sample type)
+                if data.shape[0] > num_samples:
+                    data = data[:num_samples]
+                pairs = data.view(self.pair_dtype)
+                pair_stride = self.num_inputs / 2
+                for (in_pair, column) in self.pair_views:
+                    column[:N] = pairs[in_pair::pair_stride]
+                copy_views = self.single_views
+            for (in_ch, column) in copy_views:
+                column[:N] = data[in_ch:num_samples:self.num_inputs]
+        else:
+            data = data[:N * self.num_inputs].reshape((N, self.num_inputs))
+            scaled_in = self.input_scratch[:N]
+            numpy.copyto(scaled_in, data)
+            for slot in self.slots:
+                out = self.outputs[slot][:N]
+                if self.dtype == numpy.float64:
+                    numpy.dot(scaled_in, self.gains[slot], out=out)
+                else:
+                    #   (numpy.dot can only write its own result type)
+                    scaled_out = self.output_scratch[slot][:N]
+                    numpy.dot(scaled_in, self.gains[slot], out=scaled_out)
+                    if self.dtype.kind != 'f':
+                        numpy.clip(scaled_out, SAMPLE_MIN, SAMPLE_MAX, out=scaled_out)
+                    numpy.copyto(out, scaled_out, casting='unsafe')
+
+        return [(slot, self.outputs_flat[slot][:N * self.slot_channels[slot]]) for slot in self.slots]
+
+
+def split_routes(num_inputs, slot_channels):
+    """ Routes for sending consecutive input channels to each slot in turn,
+        e.g. channels 0-1 to the first slot and 2-3 to the second.
+        slot_channels is [(slot, number of channels), ...] in that order.
+    """
+    routes = []
+    in_ch = 0
+    for (slot, channels) in slot_channels:
+        for out_ch in range(channels):
+            if in_ch < num_inputs:
+                routes.append((in_ch, slot, out_ch))
+            in_ch += 1
+    return routes
@@ -0,0 +1,145 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    workers.py: Spreads DSP work (e.g. FIR filtering) for groups of channels
+    across worker processes, passing blocks of audio through shared memory.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import multiprocessing
+
+import numpy
+
+
+class SharedRing(object):
+    """ A ring of depth slots in shared memory, each holding one input block
+        (block_frames x num_inputs) and one output block (block_frames x
+        num_outputs).  Three semaphores count the slots which are free, ready
+        for the worker (input written), and done (output written); the
+        producer and the worker both go around the ring in order.
+    """
+
+    def __init__(self, depth, block_frames, num_inputs, num_outputs, dtype):
+        dtype = numpy.dtype(dtype)
+        self.depth = depth
+        self.inputs_raw = multiprocessing.RawArray('b', depth * block_frames * num_inputs * dtype.itemsize)
+        self.outputs_raw = multiprocessing.RawArray('b', depth * block_frames * num_outputs * dtype.itemsize)
+        self.inputs = numpy.frombuffer(self.inputs_raw, dtype=dtype).reshape((depth, block_frames, num_inputs))
+        self.outputs = numpy.frombuffer(self.outputs_raw, dtype=dtype).reshape((depth, block_frames, num_outputs))
+        self.free = multiprocessing.Semaphore(depth)
+        self.ready = multiprocessing.Semaphore(0)
+        self.done = multiprocessing.Semaphore(0)
+
+
+class DSPWorkerPool(object):
+    """ Runs one worker process per channel group.  groups is a list of
+
+            (input channels, number of outputs, make_process)
+
+        make_process() is called in the worker (so it can set up its own state,
+        such as a PartitionedConvolver) and returns a function
+
+            process(inputs, outputs)
+
+        which fills in outputs (block_frames x number of outputs) from inputs
+        (block_frames x number of input channels).  Blocks are submitted in
+        order and collected in the same order, up to depth blocks ahead; only
+        semaphores are passed between processes, never the audio.  Workers
+        are forked, so make_process doesn't need to be picklable.
+    """
+
+    def __init__(self, groups, block_frames, num_inputs, depth=4, dtype=numpy.int32, timeout=1.0):
+        self.groups = [(list(in_chs), num_outputs, make_process) for (in_chs, num_outputs, make_process) in groups]
+        self.block_frames = block_frames
+        self.num_inputs = num_inputs
+        self.depth = depth
+        self.timeout = timeout
+        self.rings = [SharedRing(depth, block_frames, len(in_chs), num_outputs, dtype) for (in_chs, num_outputs, make_process) in self.groups]
+        self.stopping = multiprocessing.RawValue('b', 0)
+        self.workers = []
+
+        #   Positions in the rings, and whether the oldest collected slot is still held
+        self.submit_pos = 0
+        self.collect_pos = 0
+        self.num_pending = 0
+        self.held = False
+
+    def start(self):
+        for (ring, (in_chs, num_outputs, make_process)) in zip(self.rings, self.groups):
+            worker = multiprocessing.Process(target=self.worker_main, args=(ring, make_process))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def worker_main(self, ring, make_process):
+        process = make_process()
+        pos = 0
+        while True:
+            ring.ready.acquire()
+            if self.stopping.value:
+                return
+            process(ring.inputs[pos], ring.outputs[pos])
+            ring.done.release()
+            pos = (pos + 1) % ring.depth
+
+    def stop(self):
+        self.stopping.value = 1
+        for ring in self.rings:
+            ring.ready.release()
+        for worker in self.workers:
+            worker.join(self.timeout)
+        self.workers = []
+
+    def wait(self, semaphore):
+        #   Acquire a semaphore, checking that the workers are still running
+        while not semaphore.acquire(True, self.timeout):
+            for worker in self.workers:
+                if not worker.is_alive():
+                    raise Exception('DSP worker exited with code %s' % worker.exitcode)
+
+    def pending(self):
+        #   Blocks submitted but not collected yet
+        return self.num_pending
+
+    def submit(self, block):
+        """ Queues a block of audio (interleaved, or block_frames x num_inputs)
+            for processing.  No more than depth blocks can be pending.
+        """
+        if self.num_pending >= self.depth:
+            raise Exception('DSP worker queue is full; collect() a block first')
+        self.release()
+        block = block.reshape((self.block_frames, self.num_inputs))
+        for (ring, (in_chs, num_outputs, make_process)) in zip(self.rings, self.groups):
+            self.wait(ring.free)
+            target = ring.inputs[self.submit_pos]
+            for (i, in_ch) in enumerate(in_chs):
+                target[:, i] = block[:, in_ch]
+            ring.ready.release()
+        self.submit_pos = (self.submit_pos + 1) % self.depth
+        self.num_pending += 1
+
+    def release(self):
+        #   Hand the slot of the last collected block back to the producer
+        if self.held:
+            for ring in self.rings:
+                ring.free.release()
+            self.collect_pos = (self.collect_pos + 1) % self.depth
+            self.held = False
+
+    def collect(self):
+        """ Waits for the oldest submitted block to be processed, and returns
+            the output of each group (in shared memory, valid until the next
+            call to collect(), submit() or release()).
+        """
+        self.release()
+        for ring in self.rings:
+            self.wait(ring.done)
+        self.num_pending -= 1
+        self.held = True
+        return [ring.outputs[self.collect_pos] for ring in self.rings]
@@ -0,0 +1,46 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    benchmark_convolution.py: Measures the time taken by PartitionedConvolver
+    (streaming/convolution.py) per block for a range of filter lengths and
+    block sizes, as a fraction of the real-time budget.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import argparse
+import numpy
+
+from streaming.convolution import PartitionedConvolver
+from utils import monotonic_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks partitioned FIR convolution')
+    parser.add_argument('-c', '--channels', type=int, default=4)
+    parser.add_argument('-r', '--rate', type=int, default=44100)
+    parser.add_argument('--taps', type=int, nargs='+', default=[1024, 4096, 16384, 65536])
+    parser.add_argument('--blocks', type=int, nargs='+', default=[128, 256, 1024])
+    parser.add_argument('--seconds', type=float, default=2.0, help='Seconds of audio to filter for each test')
+    args = parser.parse_args()
+
+    print '%d channels at %d Hz' % (args.channels, args.rate)
+    print '  %8s %8s %10s %12s %12s %10s' % ('taps', 'block', 'partitions', 'us/block', 'latency (ms)', 'CPU (%)')
+    for block_frames in args.blocks:
+        for num_taps in args.taps:
+            filters = numpy.random.normal(0, 0.01, size=(num_taps, args.channels))
+            conv = PartitionedConvolver(filters, block_frames)
+            num_blocks = max(int(args.seconds * args.rate / block_frames), 1)
+            data = (numpy.random.normal(0, 0.1, size=(block_frames, args.channels)) * (1 << 23)).astype(numpy.int32)
+            out = numpy.empty_like(data)
+            start_time = monotonic_time()
+            for i in range(num_blocks):
+                conv.process(data, out)
+            elapsed = (monotonic_time() - start_time) / num_blocks
+            budget = block_frames / float(args.rate)
+            print '  %8d %8d %10d %12.1f %12.2f %10.1f' % (num_taps, block_frames, conv.num_partitions, elapsed * 1e6, budget * 1e3, elapsed / budget * 100)
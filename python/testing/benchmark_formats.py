@@ -0,0 +1,93 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    benchmark_formats.py: Measures the throughput of sample format conversion
+    (streaming/formats.py) for each input format, with and without gain,
+    compared with the conversion previously done in play_stream_4ch.py.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import argparse
+import numpy
+
+from streaming.formats import SampleConverter, FORMATS, SAMPLE_BYTES
+from utils import monotonic_time
+
+
+def legacy_convert(data, fmt, gain):
+    #   What play_stream_4ch.py used to do for each chunk
+    if fmt == 'S16_LE':
+        data = numpy.fromstring(data, dtype=numpy.int16)
+        data = data.astype(float) / (1 << 16)
+    elif fmt == 'S24_LE':
+        data = numpy.fromstring(data, dtype=numpy.int32)
+        data = data.astype(float) / (1 << 24)
+    elif fmt == 'S32_LE':
+        data = numpy.fromstring(data, dtype=numpy.int32)
+        data = data.astype(float) / (1 << 32)
+    elif fmt == 'FLOAT_LE':
+        data = numpy.fromstring(data, dtype=numpy.float32)
+        data = data.astype(float)
+    else:
+        return None
+    data_scaled = data * gain
+    return (data_scaled * (1 << 24)).astype(numpy.int32)
+
+def make_chunks(fmt, num_chunks, chunk_samples):
+    #   Random audio at about -20 dBFS, as strings like those read from a pipe
+    chunks = []
+    for i in range(num_chunks):
+        samples = (numpy.random.normal(0, 0.1, size=chunk_samples) * (1 << 23)).astype(numpy.int32)
+        if fmt == 'S16_LE':
+            chunks.append((samples >> 8).astype('<i2').tostring())
+        elif fmt == 'S24_LE':
+            chunks.append(samples.astype('<i4').tostring())
+        elif fmt == 'S24_3LE':
+            chunks.append(samples.astype('<i4').view(numpy.uint8).reshape((-1, 4))[:, :3].tostring())
+        elif fmt == 'S32_LE':
+            chunks.append((samples.astype(numpy.int64) << 8).astype('<i4').tostring())
+        elif fmt == 'FLOAT_LE':
+            chunks.append((samples / float(1 << 24)).astype('<f4').tostring())
+    return chunks
+
+def run(func, chunks, repeat):
+    best = None
+    for i in range(repeat):
+        start_time = monotonic_time()
+        for chunk in chunks:
+            func(chunk)
+        elapsed = monotonic_time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks sample format conversion')
+    parser.add_argument('--chunk', type=int, default=4096, help='Samples per chunk (all channels)')
+    parser.add_argument('--chunks', type=int, default=200)
+    parser.add_argument('--gain', type=float, default=0.5, help='Linear gain for the tests with gain')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    out = numpy.empty((args.chunk,), dtype=numpy.int32)
+    num_samples = args.chunk * args.chunks
+    print '%d chunks of %d samples' % (args.chunks, args.chunk)
+    print '  %-9s %-14s %10s %10s' % ('format', 'method', 'Msamples/s', 'MB/s in')
+    for fmt in sorted(FORMATS.keys()):
+        chunks = make_chunks(fmt, args.chunks, args.chunk)
+        converter = SampleConverter(fmt)
+        tests = [
+            ('unity', lambda x: converter.convert(x, 1.0, out)),
+            ('gain', lambda x: converter.convert(x, args.gain, out)),
+        ]
+        if legacy_convert(chunks[0], fmt, 1.0) is not None:
+            tests.append(('legacy gain', lambda x: legacy_convert(x, fmt, args.gain)))
+        for (label, func) in tests:
+            elapsed = run(func, chunks, args.repeat)
+            print '  %-9s %-14s %10.1f %10.1f' % (fmt, label, num_samples / elapsed / 1e6, num_samples * SAMPLE_BYTES[fmt] / elapsed / 1e6)
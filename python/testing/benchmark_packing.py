@@ -0,0 +1,85 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    benchmark_packing.py: Compares the time taken to build AUD_FIFO_WRITE
+    commands with AudioPacker (modules/packing.py) and with the previous
+    byteswap/tostring conversion in ModuleBase.audio_write.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import argparse
+import numpy
+
+from backends.da_platform import DAPlatformBackend
+from modules.packing import AudioPacker, frame_words
+from utils import monotonic_time
+
+
+def legacy_pack(slot, data):
+    #   What ModuleBase.audio_write and prepare_cmd used to do
+    msg = numpy.fromstring(data.byteswap().tostring(), dtype=numpy.uint16).byteswap()
+    N = msg.shape[0]
+    checksum = numpy.sum(msg)
+    cmd = numpy.zeros((N + 6,), dtype=numpy.uint16)
+    cmd[0] = slot
+    cmd[1] = DAPlatformBackend.AUD_FIFO_WRITE
+    cmd[2] = N / 65536
+    cmd[3] = N % 65536
+    cmd[4:4 + N] = msg
+    cmd[4 + N] = checksum / 65536
+    cmd[5 + N] = checksum % 65536
+    return cmd
+
+def legacy_pack_float(slot, data):
+    return legacy_pack(slot, (data * (1 << 24)).astype(numpy.int32))
+
+def run(func, chunks, repeat):
+    #   Returns the best time over repeat passes through the chunks
+    best = None
+    for i in range(repeat):
+        start_time = monotonic_time()
+        for chunk in chunks:
+            func(chunk)
+        elapsed = monotonic_time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks packing of audio into AUD_FIFO_WRITE commands')
+    parser.add_argument('--channels', type=int, default=8)
+    parser.add_argument('--rate', type=int, default=192000)
+    parser.add_argument('--chunk', type=int, default=4096, help='Samples per channel in each command')
+    parser.add_argument('--seconds', type=float, default=2.0, help='Amount of audio to pack per pass')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    num_chunks = int(args.seconds * args.rate / args.chunk)
+    chunk_samples = args.chunk * args.channels
+    float_chunks = [numpy.random.uniform(-0.5, 0.5, size=(args.chunk, args.channels)) for i in range(num_chunks)]
+    int_chunks = [(chunk * (1 << 24)).astype(numpy.int32) for chunk in float_chunks]
+
+    packer = AudioPacker()
+    out = numpy.empty((frame_words(chunk_samples),), dtype=numpy.uint16)
+
+    #   Both versions must produce the same commands
+    assert numpy.array_equal(legacy_pack(1, int_chunks[0]), packer.pack(1, int_chunks[0], out))
+    assert numpy.array_equal(legacy_pack_float(1, float_chunks[0]), packer.pack_float(1, float_chunks[0], out))
+
+    print '%d chunks of %d samples x %d channels (%.1f s of audio at %d Hz)' % (num_chunks, args.chunk, args.channels, args.seconds, args.rate)
+    for (label, chunks, legacy_func, packer_func) in [
+            ('int32', int_chunks, lambda x: legacy_pack(1, x), lambda x: packer.pack(1, x, out)),
+            ('float', float_chunks, lambda x: legacy_pack_float(1, x), lambda x: packer.pack_float(1, x, out)),
+        ]:
+        results = {}
+        for (name, func) in [('legacy', legacy_func), ('packer', packer_func)]:
+            elapsed = run(func, chunks, args.repeat)
+            results[name] = elapsed
+            print '  %-6s %-8s %7.3f s: %7.1f us/chunk, %5.2f%% of real time' % (label, name, elapsed, elapsed / num_chunks * 1e6, elapsed / args.seconds * 100)
+        print '  %-6s speedup: %.1fx' % (label, results['legacy'] / results['packer'])
@@ -0,0 +1,161 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    benchmark_parser.py: Compares the throughput of the incremental report
+    parser (backends/parser.py) with the previous concatenate-per-packet parser,
+    on synthetic report streams or on recorded USB traffic.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import argparse
+import sys
+import numpy
+
+from backends.da_platform import DAPlatformBackend
+from backends.emulator import FPGAEmulator
+from backends.parser import ReportParser
+from backends.recorder import read_traffic, DIR_IN
+from utils import monotonic_time
+
+
+class LegacyParser(object):
+    #   The parser used by DAPlatformBackend before ReportParser, for comparison
+
+    def __init__(self):
+        self.report_unparsed = numpy.array([], dtype=numpy.uint16)
+        self.num_frames = 0
+
+    def parse_msg(self, slot_id, report_id, msg):
+        self.num_frames += 1
+
+    def parse_report(self, new_packet):
+        all_packets = numpy.concatenate([self.report_unparsed, new_packet])
+        cur_index = 0
+        N = all_packets.shape[0]
+        parsing_valid = True
+        while parsing_valid:
+            parsing_valid = False
+            if N > cur_index + 2:
+                slot_id = all_packets[cur_index]
+                report_id = all_packets[cur_index + 1]
+                msg_length = (all_packets[cur_index + 2] << 16) + all_packets[cur_index + 3]
+                if N < cur_index + 6 + msg_length:
+                    break
+                msg = all_packets[cur_index + 4:cur_index + 4 + msg_length]
+                checksum = (all_packets[cur_index + 4 + msg_length] << 16) + all_packets[cur_index + 5 + msg_length]
+                self.parse_msg(slot_id, report_id, msg)
+                cur_index += 6 + msg_length
+                parsing_valid = True
+        self.report_unparsed = all_packets[cur_index:]
+
+
+class IncrementalParser(object):
+    #   ReportParser, used the same way as in DAPlatformBackend.parse_report
+    #   (the legacy parser didn't verify checksums; see --no-checksums)
+    check_checksums = True
+
+    def __init__(self):
+        self.parser = ReportParser(check_checksums=self.check_checksums)
+        self.num_frames = 0
+
+    def parse_msg(self, slot_id, report_id, msg):
+        self.num_frames += 1
+
+    def parse_report(self, new_packet):
+        self.parser.feed(new_packet)
+        for (slot_id, report_id, msg, checksum) in self.parser.frames():
+            self.parse_msg(slot_id, report_id, msg)
+
+
+def make_stream(workload):
+    #   Returns (list of packets as they would arrive over USB, number of reports)
+    fpga = FPGAEmulator()
+    if workload == 'audio':
+        #   Large recorded audio reports (64k samples), arriving in 4k-word transfers
+        (num_reports, packet_words) = (50, 4096)
+        for i in range(num_reports):
+            fpga.report(3, DAPlatformBackend.AUD_FIFO_REPORT, numpy.arange(1 << 17) & 0xFFFF)
+    elif workload == 'small':
+        #   Many small control reports, arriving in 512-byte packets
+        (num_reports, packet_words) = (30000, 256)
+        for i in range(num_reports / 3):
+            fpga.report(DAPlatformBackend.GLOBAL_TARGET_INDEX, DAPlatformBackend.DIRCHAN_REPORT, [0x35])
+            fpga.report(0, DAPlatformBackend.CMD_FIFO_REPORT, [DAPlatformBackend.SPI_REPORT, 0, i & 0xFF, 0, 0x12])
+            fpga.report(DAPlatformBackend.GLOBAL_TARGET_INDEX, DAPlatformBackend.FIFO_REPORT_STATUS, numpy.zeros((32,)))
+    else:
+        #   Audio blocks of 1024 samples with status reports in between
+        (num_reports, packet_words) = (8000, 2048)
+        for i in range(num_reports / 2):
+            fpga.report(3, DAPlatformBackend.AUD_FIFO_REPORT, numpy.arange(2048))
+            fpga.report(DAPlatformBackend.GLOBAL_TARGET_INDEX, DAPlatformBackend.FIFO_REPORT_STATUS, numpy.zeros((32,)))
+    stream = fpga.read_output(fpga.output_words)
+    packets = [stream[i:i + packet_words] for i in range(0, stream.shape[0], packet_words)]
+    return (packets, num_reports)
+
+def check_packet_sizes(packet_sizes=[1, 3, 64, 621, 4096]):
+    #   Corrupt one message word and check that the parser's counters and output are
+    #   the same however the stream is split into packets
+    fpga = FPGAEmulator()
+    for i in range(2):
+        for slot in range(4):
+            fpga.report(slot, DAPlatformBackend.AUD_FIFO_REPORT, numpy.arange(200) + slot)
+    stream = fpga.read_output(fpga.output_words)
+    #   A word in the message of slot 2's second report
+    stream[(4 + 2) * 206 + 100] ^= 0x0100
+
+    def parse(packet_words):
+        parser = ReportParser()
+        slots = []
+        for i in range(0, stream.shape[0], packet_words):
+            parser.feed(stream[i:i + packet_words])
+            slots += [slot_id for (slot_id, report_id, msg, checksum) in parser.frames()]
+        return (parser.counters, slots, parser.words_discarded)
+
+    expected = parse(stream.shape[0])
+    assert expected[0][(2, DAPlatformBackend.AUD_FIFO_REPORT)] == [1, 1, 0]
+    for packet_words in packet_sizes:
+        result = parse(packet_words)
+        if result != expected:
+            raise Exception('Parsing %d-word packets gave %s, expected %s' % (packet_words, result, expected))
+    print 'Counters match for packets of %s words' % packet_sizes
+
+def run(parser_class, packets):
+    parser = parser_class()
+    start_time = monotonic_time()
+    for packet in packets:
+        parser.parse_report(packet)
+    return (parser.num_frames, monotonic_time() - start_time)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks report parsing')
+    parser.add_argument('--file', help='Use the IN traffic from a recording (see backends/recorder.py)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-checksums', action='store_true', help='Skip checksum verification in the incremental parser')
+    parser.add_argument('--check', action='store_true', help='Only check that corrupted reports are counted the same way for any packet size')
+    args = parser.parse_args()
+    IncrementalParser.check_checksums = not args.no_checksums
+
+    if args.check:
+        check_packet_sizes()
+        sys.exit(0)
+
+    if args.file:
+        workloads = [(args.file, [data for (timestamp, direction, data) in read_traffic(args.file) if direction == DIR_IN])]
+    else:
+        workloads = [(name, make_stream(name)[0]) for name in ['audio', 'small', 'mixed']]
+
+    for (name, packets) in workloads:
+        num_words = sum([packet.shape[0] for packet in packets])
+        print '%s: %d packets, %d words' % (name, len(packets), num_words)
+        results = {}
+        for (label, parser_class) in [('legacy', LegacyParser), ('incremental', IncrementalParser)]:
+            (num_frames, elapsed) = min([run(parser_class, packets) for i in range(args.repeat)], key=lambda x: x[1])
+            results[label] = elapsed
+            print '  %-12s %8d frames in %7.3f s: %10.0f frames/s, %8.2f MB/s' % (label, num_frames, elapsed, num_frames / elapsed, num_words * 2 / elapsed / 1e6)
+        print '  Speedup: %.1fx' % (results['legacy'] / results['incremental'])
@@ -0,0 +1,82 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    benchmark_routing.py: Measures the per-chunk cost of distributing audio
+    to DAC slots with ChannelRouter (streaming/routing.py) for a few
+    topologies, compared with the strided copies previously done in
+    play_stream.py and play_stream_4ch.py.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import argparse
+import numpy
+
+from streaming.routing import ChannelRouter, split_routes
+from utils import monotonic_time
+
+
+def legacy_stereo_to_dac8(data):
+    #   What play_stream.py used to do for the AD1934 (channels 1,2 and 7,8)
+    orig_size = data.shape[0]
+    data_exp = numpy.zeros((orig_size * 4,), dtype=numpy.int32)
+    data_exp[::8] = data[::2]
+    data_exp[1::8] = data[1::2]
+    data_exp[6::8] = data[::2]
+    data_exp[7::8] = data[1::2]
+    return [(0, data_exp)]
+
+def legacy_4ch_to_2_dac2(data):
+    #   What play_stream_4ch.py used to do
+    orig_size = data.shape[0]
+    data_slot0 = numpy.zeros((orig_size / 2), dtype=numpy.int32)
+    data_slot1 = numpy.zeros((orig_size / 2), dtype=numpy.int32)
+    data_slot0[::2] = data[::4]
+    data_slot0[1::2] = data[1::4]
+    data_slot1[::2] = data[2::4]
+    data_slot1[1::2] = data[3::4]
+    return [(0, data_slot0), (1, data_slot1)]
+
+#   name: (number of inputs, slot_channels, routes, legacy function or None)
+TOPOLOGIES = [
+    ('stereo -> DAC8', 2, {0: 8}, [(0, 0, 0), (1, 0, 1), (0, 0, 6), (1, 0, 7)], legacy_stereo_to_dac8),
+    ('4ch -> 2 x DAC2', 4, {0: 2, 1: 2}, split_routes(4, [(0, 2), (1, 2)]), legacy_4ch_to_2_dac2),
+    ('8ch -> 4 x DAC2', 8, {0: 2, 1: 2, 2: 2, 3: 2}, split_routes(8, [(0, 2), (1, 2), (2, 2), (3, 2)]), None),
+    ('stereo mix -> DAC2', 2, {0: 2}, [(0, 0, 0, 0.7), (1, 0, 0, 0.3), (0, 0, 1, 0.3), (1, 0, 1, 0.7)], None),
+    ('4ch mix -> 2 x DAC2', 4, {0: 2, 1: 2}, [(0, 0, 0, 0.5), (2, 0, 0, 0.5), (1, 0, 1, 0.5), (3, 0, 1, 0.5), (0, 1, 0), (1, 1, 1)], None),
+]
+
+def run(func, chunks, repeat):
+    best = None
+    for i in range(repeat):
+        start_time = monotonic_time()
+        for chunk in chunks:
+            func(chunk)
+        elapsed = monotonic_time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks channel routing')
+    parser.add_argument('--frames', type=int, default=1024, help='Frames per chunk')
+    parser.add_argument('--chunks', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print '%d chunks of %d frames' % (args.chunks, args.frames)
+    print '  %-22s %-8s %8s %12s' % ('topology', 'method', 'us/chunk', 'Mframes/s')
+    for (name, num_inputs, slot_channels, routes, legacy_func) in TOPOLOGIES:
+        chunks = [(numpy.random.normal(0, 0.1, size=args.frames * num_inputs) * (1 << 23)).astype(numpy.int32) for i in range(args.chunks)]
+        router = ChannelRouter(num_inputs, slot_channels, routes, max_frames=args.frames)
+        tests = [('copies' if router.use_copies else 'matrix', router.route)]
+        if legacy_func is not None:
+            tests.append(('legacy', legacy_func))
+        for (label, func) in tests:
+            elapsed = run(func, chunks, args.repeat)
+            print '  %-22s %-8s %8.1f %12.2f' % (name, label, elapsed / args.chunks * 1e6, args.chunks * args.frames / elapsed / 1e6)
@@ -0,0 +1,79 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    benchmark_workers.py: Measures FIR filtering throughput with the work
+    spread across different numbers of worker processes (streaming/workers.py),
+    compared with filtering every channel in one process.
+
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import argparse
+import multiprocessing
+import numpy
+
+from streaming.convolution import PartitionedConvolver
+from streaming.workers import DSPWorkerPool
+from utils import monotonic_time
+
+
+def filter_maker(filters, block_frames, channels):
+    def make_process():
+        return PartitionedConvolver(filters[:, channels], block_frames).process
+    return make_process
+
+def run_pool(pool, blocks):
+    pool.start()
+    start_time = monotonic_time()
+    for block in blocks:
+        if pool.pending() == pool.depth:
+            pool.collect()
+        pool.submit(block)
+    while pool.pending() > 0:
+        pool.collect()
+    elapsed = monotonic_time() - start_time
+    pool.stop()
+    return elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks FIR filtering in worker processes')
+    parser.add_argument('-c', '--channels', type=int, default=8)
+    parser.add_argument('-r', '--rate', type=int, default=96000)
+    parser.add_argument('--taps', type=int, default=8192)
+    parser.add_argument('--block', type=int, default=512)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--seconds', type=float, default=2.0, help='Seconds of audio to filter for each test')
+    args = parser.parse_args()
+
+    filters = numpy.random.normal(0, 0.01, size=(args.taps, args.channels))
+    num_blocks = max(int(args.seconds * args.rate / args.block), 1)
+    blocks = [(numpy.random.normal(0, 0.1, size=(args.block, args.channels)) * (1 << 23)).astype(numpy.int32) for i in range(16)]
+    blocks = [blocks[i % len(blocks)] for i in range(num_blocks)]
+    audio_time = num_blocks * args.block / float(args.rate)
+
+    print '%d channels at %d Hz, %d taps, %d-frame blocks, %d CPUs' % (args.channels, args.rate, args.taps, args.block, multiprocessing.cpu_count())
+    print '  %-16s %12s %14s' % ('method', 'us/block', 'x real time')
+
+    conv = PartitionedConvolver(filters, args.block)
+    out = numpy.empty_like(blocks[0])
+    start_time = monotonic_time()
+    for block in blocks:
+        conv.process(block, out)
+    elapsed = monotonic_time() - start_time
+    print '  %-16s %12.1f %14.2f' % ('in process', elapsed / num_blocks * 1e6, audio_time / elapsed)
+
+    for num_workers in args.workers:
+        bounds = numpy.linspace(0, args.channels, num_workers + 1).astype(int)
+        groups = []
+        for i in range(num_workers):
+            channels = range(bounds[i], bounds[i + 1])
+            if len(channels) > 0:
+                groups.append((channels, len(channels), filter_maker(filters, args.block, channels)))
+        pool = DSPWorkerPool(groups, args.block, args.channels)
+        elapsed = run_pool(pool, blocks)
+        print '  %-16s %12.1f %14.2f' % ('%d worker%s' % (len(groups), 's' if len(groups) > 1 else ''), elapsed / num_blocks * 1e6, audio_time / elapsed)
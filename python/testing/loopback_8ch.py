@@ -27,12 +27,14 @@ from matplotlib import pyplot
 import pickle
 
 from backends.da_platform import DAPlatformBackend
+from backends.emulator import EmulatorBackend
 from modules.base import ModuleBase
 
 from modules.ak4490 import AK4490Module
 from modules.ak4458 import AK4458Module
 from modules.ak5578 import AK5578Module
 from modules.ak5572 import AK5572Module
+from streaming.duplex import DuplexEngine
 from utils import get_color
 
 SLOT_ADC = 3
@@ -51,73 +53,32 @@ def run_loopback(x, t, dac, adc, display=False, debug_plot=False, main_channel=0
 
     time_start = datetime.now()
 
-    adc.start_recording(SLOT_ADC)
-    
     #   4/4/2018 debug
     """
+    adc.start_recording(SLOT_ADC)
     for i in range(10):
         adc.fifo_status(display=True)
     adc.stop_recording(SLOT_ADC)
     
     pdb.set_trace()
     """
-    samples_written = 0
-    samples_read = 0
-    do_record = True
-    start_flag = False
-    chunk_size = (1 << 13)
+    #   Stream the samples through the DAC and record the ADC at the same time.
+    #   Blocks are kept small since the engine's latency is a few blocks, and the
+    #   analysis below skips only the first 4096 samples.
+    chunk_size = (1 << 10)
     rec_data = []
+    engine = DuplexEngine(adc, {SLOT_DAC: NUM_CHANNELS_DAC}, {SLOT_ADC: NUM_CHANNELS_ADC}, block_frames=chunk_size, float_format=False)
 
-    #print adc.get_dirchan()
-    #print 'N = %d, sample shape = %s' % (N, x_st_int.shape)
-
-    #   TODO: Make this loop until DAC has read all of the samples we wrote.
-    while samples_written < N:
-        
+    def process(inputs, outputs):
+        samples_written = engine.blocks_processed * chunk_size
         chunk = x_st_int[samples_written:samples_written+chunk_size]
-        this_chunk_size = chunk.shape[0]
-        """
-        dac.audio_write(SLOT_DAC, chunk.flatten())
-
-        samples_written += this_chunk_size
-        if display: print 'Wrote %d samples' % samples_written
-
-        if do_record:
-            data = adc.audio_read(SLOT_ADC, chunk_size * NUM_CHANNELS_ADC, timeout=100)
-            rec_data.append(data)
-            samples_read += data.shape[0]
-            if display: print 'samples_read = %d' % samples_read
-        """
-        #"""
-        #   11/18 - NO REALLY, YOU GET DROPOUTS IF YOU DON'T DO THIS
-        #   Delay first read so that we don't get a buffer underrun
-        if start_flag:
-            samples_to_read = chunk_size * NUM_CHANNELS_ADC
-        else:
-            samples_to_read = 0
-            
-        #   (self, slot_dac, slot_adc, data, timeout=100):
-        data_read = adc.audio_read_write(SLOT_DAC, SLOT_ADC, chunk.flatten(), samples_to_read, timeout=1000)
-        rec_data.append(data_read)
-        #   print 'Data size = %s' % data_read.shape
-        samples_read += data_read.shape[0]
-        samples_written += chunk.shape[0]
-        if display: print 'samples_read = %d, samples_written = %d' % (samples_read, samples_written)
-        
-        if start_flag == False:
-            start_flag = True
-        #"""
-    
-    #   Wait for DAC to flush its buffer
-    time.sleep(chunk_size / F_s)
-    adc.stop_recording(SLOT_ADC)
+        outputs[SLOT_DAC][:chunk.shape[0]] = chunk
+        rec_data.append(inputs[SLOT_ADC].flatten())
+        if display: print 'samples_read = %d, samples_written = %d' % ((engine.blocks_processed + 1) * chunk_size, samples_written + chunk.shape[0])
 
-    #   Get FIFO status and then retrieve any lingering samples
-    status = adc.fifo_status(display=display)
-    leftover_samples = status[4+SLOT_ADC][0] - status[4+SLOT_ADC][1]
-    leftover_samples -= (leftover_samples % 2)
-    if display: print 'Retrieving %d leftover samples' % leftover_samples
-    rec_data.append(adc.audio_read(SLOT_ADC, leftover_samples, perform_update=True, timeout=1000))
+    #   Keep going until the end of the signal has come back from the ADC
+    num_blocks = (N + chunk_size - 1) / chunk_size + engine.prefill_blocks
+    engine.run(process, num_blocks)
     
     time_elapsed = datetime.now() - time_start
     time_float = time_elapsed.seconds + 1e-6 * time_elapsed.microseconds
@@ -397,7 +358,11 @@ def test_single_tone(dac, adc):
     print sine_loopback(1000, -0.1, dac, adc, 0.5, display=False, debug_plot=True, freq_spread=1.2, main_channel=0)
 
 if __name__ == '__main__':
-    backend = DAPlatformBackend(reset=True)
+    #   Run with --emulate to use the FPGA emulator (ADC recording the DAC) instead of hardware
+    if '--emulate' in sys.argv[1:]:
+        backend = EmulatorBackend(reset=True, loopback={SLOT_ADC: SLOT_DAC})
+    else:
+        backend = DAPlatformBackend(reset=True)
 
     if NUM_CHANNELS_DAC == 8:
         dac = AK4458Module(backend)
@@ -0,0 +1,65 @@
+"""
+    Open-source digital audio platform
+    Copyright (C) 2009--2018 Michael Price
+
+    replay_traffic.py: Benchmark/profile the report parsing and receive state
+    code on USB traffic recorded with backends.recorder.TrafficRecorder.
+    
+    Warning: Use and distribution of this code is restricted.
+    This software code is distributed under the terms of the GNU General Public
+    License, version 3.  Other files in this project may be subject to
+    different licenses.  Please see the LICENSE file in the top level project
+    directory for more information.
+"""
+
+import sys
+import argparse
+import cProfile
+import pstats
+
+from backends.da_platform import DAPlatformBackend
+from backends.recorder import ReplayBackend, read_traffic, replay_reports
+from utils import monotonic_time
+
+parser = argparse.ArgumentParser(description='Replays recorded USB traffic into the backend')
+parser.add_argument('filename')
+parser.add_argument('--realtime', action='store_true', help='Keep the original timing instead of running as fast as possible')
+parser.add_argument('--mode', choices=['parse', 'receive'], default='parse',
+    help='parse: call parse_report() on each recorded transfer; receive: read it back through update_receive_state()')
+parser.add_argument('--ring', action='store_true', help='In receive mode, use the read ring')
+parser.add_argument('--profile', action='store_true')
+args = parser.parse_args()
+
+backend = ReplayBackend(args.filename, realtime=args.realtime)
+records = read_traffic(args.filename)
+
+def run_replay():
+    if args.mode == 'parse':
+        return replay_reports(records, backend, realtime=args.realtime)
+
+    if args.ring:
+        backend.start_read_ring()
+    num_words = 0
+    start_time = monotonic_time()
+    while not backend.replay_done():
+        num_words += backend.update_receive_state()
+    #   Collect anything still held by completed transfers
+    num_words += backend.update_receive_state(timeout=10)
+    elapsed = monotonic_time() - start_time
+    if args.ring:
+        backend.stop_read_ring()
+    return (len(backend.traffic.records), num_words, elapsed)
+
+if args.profile:
+    profiler = cProfile.Profile()
+    (num_records, num_words, elapsed) = profiler.runcall(run_replay)
+else:
+    (num_records, num_words, elapsed) = run_replay()
+
+print 'Replayed %d IN transfers, %d words in %.3f s: %.1f transfers/s, %.2f MB/s' % (num_records, num_words, elapsed, num_records / elapsed, num_words * 2 / elapsed / 1e6)
+print 'Global reports: %s' % dict((hex(k), len(v)) for (k, v) in backend.receive_state_global.items())
+for (slot, state) in enumerate(backend.receive_state_slots):
+    print 'Slot %d: %d audio words, %d CMD reports' % (slot, backend.audio_words_available(slot), len(state[DAPlatformBackend.CMD_FIFO_REPORT]))
+
+if args.profile:
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
@@ -142,7 +142,8 @@ if __name__ == '__main__':
     time.sleep(0.01)
     chunk = x[:N]
     x_st = numpy.array([chunk, chunk]).T.flatten()
-    x_int = tester.audio_write_float(1, x_st)
+    x_int = (x_st * (1 << 24)).astype(numpy.int32)
+    tester.audio_write(1, x_int)
     samples_read = 0
     chunk_size = 512
     rec_data = []
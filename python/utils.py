@@ -12,10 +12,25 @@
 """
 
 from datetime import datetime
+import time
+import ctypes
+import ctypes.util
 
 import numpy
 from matplotlib import colors
 
+#   clock_gettime(CLOCK_MONOTONIC), since Python 2 has no time.monotonic()
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+    clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6', use_errno=True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+except (OSError, AttributeError):
+    clock_gettime = None
+
 def get_elapsed_time(time_start):
     time_end = datetime.now()
     time_diff = time_end - time_start
@@ -28,3 +43,11 @@ def get_color(N, i):
     trace_color.shape = (3,)
     return trace_color
 
+def monotonic_time():
+    #   Seconds from an arbitrary starting point; unaffected by changes to the system clock
+    if clock_gettime is None:
+        return time.time()
+    t = timespec()
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        return time.time()
+    return t.tv_sec + 1e-9 * t.tv_nsec
@@ -3,7 +3,13 @@
     Copyright (C) 2009--2018 Michael Price
 
     controls.py: API for controlling runtime parameters of DA platform.
-    
+
+    The current values live in a small memory-mapped file shared by every
+    process that imports this module (e.g. the web controller and a streaming
+    script), so reading them is a memory access.  They are saved to an sqlite
+    database in the background, and loaded from it when the shared file is
+    first created.
+
     Warning: Use and distribution of this code is restricted.
     This software code is distributed under the terms of the GNU General Public
     License, version 3.  Other files in this project may be subject to
@@ -11,15 +17,27 @@
     directory for more information.
 """
 
+import atexit
+import ctypes
+import mmap
+import os
 import os.path
 import sqlite3
+import threading
 
 DEFAULT_VOLUME = -40.0
 
+#   Parameters in the shared block (in this order), and their defaults
+PARAMETERS = ['volume']
+DEFAULTS = {'volume': DEFAULT_VOLUME}
+
 DB_FILE = '%s/settings.db' % os.path.dirname(os.path.abspath(__file__))
+PARAMS_FILE = '%s/settings.mmap' % os.path.dirname(os.path.abspath(__file__))
 
-conn = sqlite3.connect(DB_FILE)
+conn = sqlite3.connect(DB_FILE, check_same_thread=False)
 cursor = conn.cursor()
+#   Held while using the connection, which is shared with the write-behind thread
+db_lock = threading.RLock()
 
 def table_exists(tablename):
     statement = "SELECT name FROM sqlite_master WHERE type='table';"
@@ -29,21 +47,146 @@ def table_exists(tablename):
         return False
 
 def init():
-    if not table_exists('settings'):
-        cursor.execute('CREATE TABLE IF NOT EXISTS settings (name VARCHAR(80) PRIMARY KEY, value VARCHAR(80))')
-        cursor.execute('INSERT OR REPLACE INTO settings (name, value) VALUES ("volume", ?)', (DEFAULT_VOLUME,))
+    with db_lock:
+        if not table_exists('settings'):
+            cursor.execute('CREATE TABLE IF NOT EXISTS settings (name VARCHAR(80) PRIMARY KEY, value VARCHAR(80))')
+            cursor.execute('INSERT OR REPLACE INTO settings (name, value) VALUES ("volume", ?)', (DEFAULT_VOLUME,))
+            conn.commit()
+
+def load_setting(name):
+    #   Saved value of a parameter, or its default
+    with db_lock:
+        init()
+        cursor.execute('SELECT value FROM settings WHERE name = ?', (name,))
+        r = cursor.fetchone()
+    if r is None:
+        return DEFAULTS[name]
+    return float(r[0])
+
+def save_settings(values):
+    with db_lock:
+        for (name, val) in values.items():
+            cursor.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, val))
         conn.commit()
 
+
+class ParameterBlock(object):
+    """ Parameter values (as doubles) in a memory-mapped file, preceded by a
+        header of 32-bit words: [version, magic, number of parameters, unused].
+        The version is incremented before and after each write, so it is odd
+        while a write is in progress and readers can tell when to retry (a
+        sequence lock).  This assumes there is one writer at a time.  A writer
+        that died during a write would leave the version odd, so an odd version
+        makes the block invalid when it is opened, and readers only retry a
+        limited number of times.
+    """
+
+    MAGIC = 0xDA9A3A75
+    HEADER_WORDS = 4
+    MAX_READ_RETRIES = 1000
+
+    def __init__(self, filename, names):
+        self.names = list(names)
+        self.index = dict((name, i) for (i, name) in enumerate(self.names))
+        size = self.HEADER_WORDS * 4 + len(self.names) * 8
+        f = open(filename, 'a+b')
+        if os.fstat(f.fileno()).st_size < size:
+            f.truncate(size)
+        self.mmap = mmap.mmap(f.fileno(), size)
+        f.close()
+        #   (ctypes arrays are the quickest to index from Python)
+        self.header = (ctypes.c_uint32 * self.HEADER_WORDS).from_buffer(self.mmap)
+        self.values = (ctypes.c_double * len(self.names)).from_buffer(self.mmap, self.HEADER_WORDS * 4)
+
+    def valid(self):
+        return self.header[1] == self.MAGIC and self.header[2] == len(self.names) and (self.header[0] & 1) == 0
+
+    def increment_version(self):
+        self.header[0] = (self.header[0] + 1) & 0xFFFFFFFF
+
+    def load(self, values):
+        #   Fill in the block (e.g. when it was just created)
+        if self.header[0] & 1:
+            #   Left over from an interrupted write
+            self.increment_version()
+        self.increment_version()
+        for (name, val) in values.items():
+            self.values[self.index[name]] = val
+        self.header[2] = len(self.names)
+        self.header[1] = self.MAGIC
+        self.increment_version()
+
+    def version(self):
+        return self.header[0]
+
+    def read(self, name):
+        i = self.index[name]
+        retries = 0
+        while retries < self.MAX_READ_RETRIES:
+            version = self.header[0]
+            if (version & 1) == 0:
+                val = self.values[i]
+                if self.header[0] == version:
+                    return val
+            retries += 1
+        #   The writer is stuck (or gone); a double is written in one store, so
+        #   the current value is still a value that was written
+        return self.values[i]
+
+    def write(self, name, val):
+        i = self.index[name]
+        self.increment_version()
+        self.values[i] = val
+        self.increment_version()
+
+
+#   Values waiting to be saved to the database by the write-behind thread
+pending = {}
+pending_lock = threading.Lock()
+pending_event = threading.Event()
+writer_thread = None
+
+def write_behind():
+    while True:
+        pending_event.wait()
+        flush()
+
+def flush():
+    #   Save any pending values now
+    with pending_lock:
+        values = pending.copy()
+        pending.clear()
+        pending_event.clear()
+    if len(values) > 0:
+        save_settings(values)
+
+def queue_save(name, val):
+    global writer_thread
+    with pending_lock:
+        pending[name] = val
+        pending_event.set()
+        if writer_thread is None:
+            writer_thread = threading.Thread(target=write_behind)
+            writer_thread.daemon = True
+            writer_thread.start()
+
+atexit.register(flush)
+
+params = ParameterBlock(PARAMS_FILE, PARAMETERS)
+if not params.valid():
+    params.load(dict((name, load_setting(name)) for name in PARAMETERS))
+
+def version():
+    """ Changes whenever a parameter is set, so callers can skip re-reading them.  """
+    return params.version()
+
 def set_volume(val):
-    cursor.execute('UPDATE settings SET value = ? WHERE name = "volume"', (val,))
-    conn.commit()
+    params.write('volume', val)
+    queue_save('volume', val)
 
 def get_volume():
-    cursor.execute('SELECT value FROM settings WHERE name = "volume"')
-    r = cursor.fetchone()
-    return float(r[0])
+    return params.read('volume')
 
 if __name__ == '__main__':
     init()
     print get_volume()
-